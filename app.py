@@ -1,11 +1,18 @@
 import time
 
 import streamlit as st
-from split_experiment.main import SplittingTest
+
+
+@st.cache_resource
+def get_splitting_test(splitter: str):
+    # imported here and cached across reruns, so the page renders before langchain and the clients load
+    from split_experiment.main import SplittingTest
+
+    return SplittingTest(splitter)
 
 
 def response_generator(splitter: str, query: str):
-    test = SplittingTest(splitter)
+    test = get_splitting_test(splitter)
     response, topk = test.query_documents(query)
 
     for word in response.split():
@@ -1,16 +1,19 @@
 from dotenv import load_dotenv
 
+# imported and built eagerly on purpose: gunicorn preloads this module and warms the engine once in the
+# master process before forking (gunicorn.conf.py); only the APISpec is deferred to first use
 from ask_viridium_ai.routes import MainRoutes
 
 load_dotenv()
 
-from flask import Flask, jsonify, redirect
+import time
+from functools import lru_cache
+
+from flask import Flask, Response, g, jsonify, redirect, request
 from flask_cors import CORS
-from apispec import APISpec
 from flask_swagger_ui import get_swaggerui_blueprint
-from apispec.ext.marshmallow import MarshmallowPlugin
-from apispec_webframeworks.flask import FlaskPlugin
 
+from ask_viridium_ai import metrics
 from global_constants import GlobalConstants
 
 global_constants = GlobalConstants
@@ -19,24 +22,42 @@ app = Flask(__name__)
 CORS(app)
 
 main_routes = MainRoutes()
+# under gunicorn.conf.py this runs once in the master process, before the workers are forked
+main_routes.warm_up()
 app.register_blueprint(main_routes.blueprint, url_prefix=GlobalConstants.api_version)
 
 swagger_endpoint = global_constants.swagger_endpoint
-# Swagger and APISpec setup
-spec = APISpec(
-    title=global_constants.apispec_config.title,
-    version=global_constants.apispec_config.version,
-    openapi_version=global_constants.apispec_config.openapi_version,
-    plugins=[FlaskPlugin(), MarshmallowPlugin()],
-)
 
-with app.test_request_context():
-    for view in [
-        main_routes.home,
-        main_routes.ask_viridium_ai,
-        main_routes.health_check,
-    ]:
-        spec.path(view=view)
+
+@lru_cache(maxsize=None)
+def build_spec():
+    """APISpec of the views, built on the first request for it instead of at startup."""
+    from apispec import APISpec
+    from apispec.ext.marshmallow import MarshmallowPlugin
+    from apispec_webframeworks.flask import FlaskPlugin
+
+    spec = APISpec(
+        title=global_constants.apispec_config.title,
+        version=global_constants.apispec_config.version,
+        openapi_version=global_constants.apispec_config.openapi_version,
+        plugins=[FlaskPlugin(), MarshmallowPlugin()],
+    )
+
+    with app.test_request_context():
+        for view in [
+            main_routes.home,
+            main_routes.ask_viridium_ai,
+            main_routes.ask_viridium_ai_stream,
+            main_routes.ask_viridium_ai_follow_up,
+            main_routes.ask_viridium_ai_batch,
+            main_routes.create_job,
+            main_routes.get_job,
+            main_routes.results,
+            main_routes.health_check,
+            main_routes.readiness_check,
+        ]:
+            spec.path(view=view)
+    return spec.to_dict()
 
 swaggerui_blueprint = get_swaggerui_blueprint(
     swagger_endpoint,
@@ -54,33 +75,46 @@ def root():
 
 @app.route(global_constants.api_swagger_json)
 def create_swagger_spec():
-    return jsonify(spec.to_dict())
+    return jsonify(build_spec())
+
+
+@app.route(global_constants.metrics_endpoint)
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype=metrics.registry.content_type)
 
 
 @app.before_request
 def log_request_info():
     # logger.info(f"API REQUEST : {request.method} {request.path}")
-    pass
+    g.request_started = time.perf_counter()
+    metrics.http_requests_in_flight.inc()
 
 
 @app.after_request
 def log_response_info(response):
     # logger.info(f"API RESPONSE : {response.status}")
+    # label by URL rule rather than path so job ids etc. do not create new series
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.http_requests.inc(route=route, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        metrics.http_request_duration.observe(
+            time.perf_counter() - g.request_started, route=route, method=request.method
+        )
     return response
 
 
-# Create 20 threads to process waiting api calls
-# threads = threading_tool.create_and_start_threads(
-#     process_waiting_api_calls,
-#     num_threads=global_constants.no_of_threads,
-#     daemon=True,
-# )
+@app.teardown_request
+def release_request(exception=None):
+    if "request_started" in g:
+        metrics.http_requests_in_flight.dec()
+
 
 if __name__ == "__main__":
-    # Main thread will serve the api calls
+    # Development server, production runs gunicorn with gunicorn.conf.py (see startup.txt)
+    main_routes.start_job_workers()
     app.run(
         threaded=True,
-        debug=True,
+        debug=global_constants.flask_debug,
         port=global_constants.flask_app_port,
         host=global_constants.flask_host,
     )
@@ -1,50 +1,232 @@
+import asyncio
 import dotenv
+import importlib
 import json
-from typing import Optional, List
+import threading
+from typing import Optional
 import time
 
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.utils.function_calling import convert_to_openai_function
 from langchain_openai import AzureChatOpenAI
 from langchain_core.output_parsers.openai_functions import JsonOutputFunctionsParser
-from langchain_community.callbacks import get_openai_callback
 
-from askviridium.app.global_constants import GlobalConstants
-from askviridium.app.models import ChemicalComposition, MaterialInfo
-from .tracking import Logger
+from global_constants import GlobalConstants
+from models import ChemicalComposition, MaterialInfo, MaterialScreening
+from utils.exceptions import TokenBudgetExceededException
+from utils.scheduler import awith_retry, get_budget, scheduler_callback, with_retry
+from .cache import ResultCache, make_key, normalize
+from .consensus import vote
+from .metrics import observe_tokens, reference_index_lookups, track_stage
+from .constants import AskViridiumConstants
+from .reference_index import ReferenceIndex, material_info
+from .results_store import ResultStore
+from .sessions import SessionStore
+from .singleflight import SingleFlight
+from .tokens import count_message_tokens, count_text_tokens, estimate_cost, trim_text_to_tokens
+from .tracking import TelemetrySink
 
 dotenv.load_dotenv()
 
 
-class AskViridium:
-    def __init__(self):
-        self.logger = Logger()
+class AskViridiumResult:
+    """State of a single query. Created per request so the engine itself can be shared between threads."""
+
+    def __init__(self, material_name, manufacturer_name, work_content, additional_info=None, mode=AskViridiumConstants.candidate_modes["fast"], pipeline=AskViridiumConstants.pipelines["two_step"]):
+        self.material_name = material_name
+        self.manufacturer_name = manufacturer_name
+        self.work_content = work_content
+        self.additional_info = additional_info
+        self.mode = mode
+        self.pipeline = pipeline
+        self.time = time.time()
+
+        self.chemical_composition = None
+        self.chemicals_list = []
+        self.result = dict()
+        self.pfas = None
         self.loginfo = dict()
+        self.cached = False
+        self.coalesced = False
+        self.usage = dict()
+        # "llm" or "reference_index", once the analysis has been computed for this query
+        self.analysis_source = None
+        self.predicted_tokens = dict()
+        self.cache_key = None
+
+
+class AskViridium:
+    """
+    Process-wide engine. Prompts, function schemas, bound chains and the Azure client are built once in
+    __init__ and never modified afterwards; everything that belongs to a request lives in AskViridiumResult.
+    """
+
+    def __init__(self, llm=None):
         self.constants = GlobalConstants()
+        self.logger = TelemetrySink(
+            self.constants.telemetry_path,
+            flush_size=self.constants.telemetry_flush_size,
+            flush_interval=self.constants.telemetry_flush_interval,
+            buffer_size=self.constants.telemetry_buffer_size,
+        )
         self.model_name = self.constants.model_name
         self.deployment_name = self.constants.deployment_name
 
-        self.llm = AzureChatOpenAI(
-            deployment_name=self.deployment_name,
-            temperature=0,
-            max_tokens=800,
-            n=3
+        # paces every call of self.llm to the deployment's quotas, shared by all engines of the process
+        self.budget = get_budget(
+            self.deployment_name,
+            self.constants.azure_requests_per_minute,
+            self.constants.azure_tokens_per_minute,
+            self.constants.scheduler_headroom,
         )
+        self.retry_kwargs = {
+            "max_attempts": self.constants.llm_max_attempts,
+            "base_delay": self.constants.llm_retry_base_delay,
+            "max_delay": self.constants.llm_retry_max_delay,
+        }
+        self.llm = llm or self.create_llm()
+        self.llm.callbacks = list(self.llm.callbacks or []) + [
+            scheduler_callback(self.budget, self.count_request_tokens, self.constants.llm_max_tokens)
+        ]
+        # the async client of self.llm keeps its connection pool on the event loop that first used it, so
+        # synchronous callers run their coroutines on this one long-lived loop, see run_async()
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
 
         self.cheminfo_prompt = self.prompt1_init()
         self.analysis_prompt = self.prompt2_init()
-        self.cheminfo_function, self.analysis_function = self.openai_functions_creation()
-        self.cheminfo_model, self.analysis_model = self.bind_function()
+        self.fused_prompt = self.prompt3_init()
+        self.cheminfo_function, self.analysis_function, self.fused_function = self.openai_functions_creation()
+        self.cheminfo_model, self.analysis_model, self.fused_model = self.bind_function()
+        # consensus mode asks for several choices of the analysis and votes on them
+        self.consensus_kwargs = {
+            "functions": self.analysis_function,
+            "function_call": {"name": "MaterialInfo"},
+            "n": self.constants.consensus_candidates,
+        }
+        self.fused_consensus_kwargs = {
+            "functions": self.fused_function,
+            "function_call": {"name": "MaterialScreening"},
+            "n": self.constants.consensus_candidates,
+            "max_tokens": self.constants.fused_max_tokens,
+        }
         self.parser = JsonOutputFunctionsParser()
+        # the schemas are sent with every call, count them once
+        self.cheminfo_function_tokens = count_text_tokens(json.dumps(self.cheminfo_function), self.model_name)
+        self.analysis_function_tokens = count_text_tokens(json.dumps(self.analysis_function), self.model_name)
+        self.fused_function_tokens = count_text_tokens(json.dumps(self.fused_function), self.model_name)
         self.cheminfo_chain = self.cheminfo_prompt | self.cheminfo_model | self.parser
         self.analysis_chain = self.analysis_prompt | self.analysis_model | self.parser
-        self.chemical_composition = None
-        self.pfas = None
+        self.fused_chain = self.fused_prompt | self.fused_model | self.parser
+
+        self.sessions = SessionStore(self.constants.session_max_entries, self.constants.session_ttl_seconds)
+        self.single_flight = SingleFlight(self.constants.single_flight_lock_dir)
+        self.result_store = ResultStore(self.constants.results_store_path)
+        self.result_store.import_json(self.constants.legacy_results_path)
+        self.reference_index = ReferenceIndex(self.constants.reference_index_path)
+
+        # anything that changes the answer for the same inputs is part of the cache key
+        self.cache_version = make_key(
+            self.cheminfo_prompt.messages[0].prompt.template,
+            self.analysis_prompt.messages[0].prompt.template,
+            self.deployment_name,
+            self.cheminfo_function,
+            self.analysis_function,
+        )
+        self.fused_cache_version = make_key(
+            self.fused_prompt.messages[0].prompt.template,
+            self.deployment_name,
+            self.fused_function,
+        )
+        self.composition_cache_version = make_key(
+            self.cheminfo_prompt.messages[0].prompt.template,
+            self.deployment_name,
+            self.cheminfo_function,
+        )
+        self.composition_cache = ResultCache(
+            self.constants.cache_path,
+            table="compositions",
+            ttl_seconds=self.constants.cache_ttl_seconds,
+            max_entries=self.constants.cache_max_entries,
+        )
+        self.result_cache = ResultCache(
+            self.constants.cache_path,
+            table="results",
+            ttl_seconds=self.constants.cache_ttl_seconds,
+            max_entries=self.constants.cache_max_entries,
+        )
+
+    def create_llm(self):
+        # ChatModelFactory ("module:callable") swaps in another chat model, e.g. the benchmark stub
+        if self.constants.chat_model_factory:
+            module_name, _, factory_name = self.constants.chat_model_factory.partition(":")
+            return getattr(importlib.import_module(module_name), factory_name)()
+
+        return AzureChatOpenAI(
+            deployment_name=self.deployment_name,
+            temperature=0,
+            max_tokens=self.constants.llm_max_tokens,
+            n=1,
+            # retried by call_llm instead, with backoff that also pauses the scheduler
+            max_retries=0,
+        )
+
+    def count_request_tokens(self, messages, invocation_params):
+        return count_message_tokens(messages, self.model_name, invocation_params.get("functions"))
+
+    def call_llm(self, fn):
+        return with_retry(fn, self.budget, **self.retry_kwargs)
+
+    async def acall_llm(self, coroutine_fn):
+        return await awith_retry(coroutine_fn, self.budget, **self.retry_kwargs)
+
+    def event_loop(self):
+        """The process's background event loop, started on first use and again in a forked worker."""
+        with self.loop_lock:
+            if self.loop_thread is None or not self.loop_thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, name="askviridium-event-loop",
+                                                    daemon=True)
+                self.loop_thread.start()
+            return self.loop
 
-        self.result = str()
+    def run_async(self, coroutine):
+        """Runs a coroutine on the background event loop and waits for its result, from any thread."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.event_loop()).result()
+
+    def warm_up(self):
+        """
+        Primes what is otherwise built on the first request: the tiktoken encoding, prompt formatting and
+        the SQLite caches. Run before forking, so that every worker process starts warm.
+        """
+        default = AskViridiumConstants.default_input_value
+        query_result = AskViridiumResult("warm-up", default, default)
+        query_result.chemicals_list = ["warm-up"]
+        self.preflight_cheminfo(query_result)
+        self.preflight_analysis(query_result)
+        self.preflight_fused(query_result)
+        self.result_cache.stats()
+        self.composition_cache.stats()
+
+    def before_fork(self):
+        """Closes connections and threads that must not be shared with forked worker processes."""
+        self.logger.close()
+        self.result_cache.close()
+        self.composition_cache.close()
+        self.result_store.close()
+        self.reference_index.close()
+
+    def after_fork(self):
+        """Reopens in the forked worker process what before_fork() closed."""
+        self.result_cache.connect()
+        self.composition_cache.connect()
+        self.result_store.connect()
+        self.reference_index.connect()
+        self.logger.start()
 
     def prompt1_init(self):
-        with open('ask_viridium_ai/findchemicals_prompt.txt', 'r') as file:
+        with open(AskViridiumConstants.prompt_files["cheminfo"], 'r') as file:
             cheminfo_system_prompt = file.read()
 
         prompt = ChatPromptTemplate.from_messages([
@@ -54,7 +236,7 @@ class AskViridium:
         return prompt
 
     def prompt2_init(self):
-        with open('ask_viridium_ai/newprompt.txt', 'r') as file:
+        with open(AskViridiumConstants.prompt_files["analysis"], 'r') as file:
             analysis_system_prompt = file.read()
 
         prompt = ChatPromptTemplate.from_messages([
@@ -64,12 +246,32 @@ class AskViridium:
         ])
         return prompt
 
+    def prompt3_init(self):
+        # the instructions of both stages back to back, so the fused pipeline stays in step with the prompt files
+        with open(AskViridiumConstants.prompt_files["cheminfo"], 'r') as file:
+            cheminfo_system_prompt = file.read().replace("{example}", "{composition_example}")
+        with open(AskViridiumConstants.prompt_files["analysis"], 'r') as file:
+            analysis_system_prompt = file.read().replace("{example}", "{analysis_example}")
+
+        prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             "Step 1: " + cheminfo_system_prompt
+             + "\n\nStep 2: using the chemical composition found in step 1, do the following analysis.\n"
+             + analysis_system_prompt
+             + "\n\nReturn both results in a single MaterialScreening function call: the output of step 1 as "
+               "chemical_composition and the output of step 2 as analysis."),
+            ("human",
+             "Material Name: {material}, manufactured by {manufacturer}. CONTEXT: used as {usecase}. Additional info: {additional_info}")
+        ])
+        return prompt
+
     def openai_functions_creation(self):
         cheminfo_function = [convert_to_openai_function(ChemicalComposition)]
 
         # convert MaterialInfo into an OpenAI function to use for function calling.
         analysis_function = [convert_to_openai_function(MaterialInfo)]
-        return [cheminfo_function, analysis_function]
+        fused_function = [convert_to_openai_function(MaterialScreening)]
+        return [cheminfo_function, analysis_function, fused_function]
 
     def bind_function(self):
         cheminfo_model = self.llm.bind_functions(
@@ -81,74 +283,552 @@ class AskViridium:
             functions=self.analysis_function,
             function_call={"name": "MaterialInfo"}
         )
-        return [cheminfo_model, analysis_model]
-
-    def log(self, time, material_name, manufacturer_name, tokens_for_cheminfo, tokens_for_analysis, cost_cheminfo, cost_analysis, chemlist):
-        self.loginfo["time"] = time
-        self.loginfo["material_name"] = material_name
-        self.loginfo["manufacturer_name"] = manufacturer_name
-        self.loginfo["tokens_used_for_chemical_composition"] = tokens_for_cheminfo
-        self.loginfo["cost_chemical_composition"] = cost_cheminfo
-        self.loginfo["tokens_used_for_analysis"] = tokens_for_analysis
-        self.loginfo["cost_analysis"] = cost_analysis
-        self.loginfo["total_cost"] = cost_analysis + cost_cheminfo
-        self.loginfo["chemical_composition"] = str(chemlist)
-        self.loginfo["PFAS_status"] = self.pfas
-        self.loginfo["user_id"] = "umesh" # placeholder
-
-        self.logger.log(info=self.loginfo)
-
-    def query(self, material_name, manufacturer_name: Optional[str] = "Not Available", work_content: Optional[str] = "Not Available", additional_info: Optional[str] = None):
-        material = material_name
-        manufacturer = manufacturer_name
-        work_content = work_content
-        rn = time.time()
-
-        with get_openai_callback() as cb:
-            self.chemical_composition = self.cheminfo_chain.invoke(
-                {"material": material, "example": self.constants.chemical_composition_example})
-            chemicals_list = [chemical["name"] for chemical in self.chemical_composition["chemicals"]]
-            tokens_for_cheminfo = cb.total_tokens
-            cost_for_cheminfo = cb.total_cost
-
-        with get_openai_callback() as cb:
-            self.result = self.analysis_chain.invoke(
-                {"material": material, "manufacturer": manufacturer, "usecase": work_content,
-                 "chemical_composition": chemicals_list, "example": self.constants.analysis_example, 
-                 "additional_info": None})
-            tokens_for_analysis = cb.total_tokens
-            cost_for_analysis = cb.total_cost
-            self.pfas = self.result["decision"]
-
-        self.log(rn, material_name, manufacturer_name, tokens_for_cheminfo, tokens_for_analysis, cost_for_cheminfo, cost_for_analysis, chemicals_list)
+        fused_model = self.llm.bind_functions(
+            functions=self.fused_function,
+            function_call={"name": "MaterialScreening"},
+            max_tokens=self.constants.fused_max_tokens,
+        )
+        return [cheminfo_model, analysis_model, fused_model]
+
+    def log(self, query_result, tokens_for_cheminfo, tokens_for_analysis, cost_cheminfo, cost_analysis):
+        loginfo = query_result.loginfo
+        loginfo["time"] = query_result.time
+        loginfo["material_name"] = query_result.material_name
+        loginfo["manufacturer_name"] = query_result.manufacturer_name
+        loginfo["tokens_used_for_chemical_composition"] = tokens_for_cheminfo
+        loginfo["cost_chemical_composition"] = cost_cheminfo
+        loginfo["tokens_used_for_analysis"] = tokens_for_analysis
+        loginfo["cost_analysis"] = cost_analysis
+        loginfo["total_cost"] = cost_analysis + cost_cheminfo
+        loginfo["chemical_composition"] = str(query_result.chemicals_list)
+        loginfo["PFAS_status"] = query_result.pfas
+        loginfo["user_id"] = "umesh" # placeholder
+        loginfo["mode"] = query_result.mode
+        loginfo["pipeline"] = query_result.pipeline
+        loginfo["analysis_source"] = query_result.analysis_source
+
+        query_result.usage = {
+            "mode": query_result.mode,
+            "pipeline": query_result.pipeline,
+            "analysis_source": query_result.analysis_source,
+            "tokens_used_for_chemical_composition": tokens_for_cheminfo,
+            "tokens_used_for_analysis": tokens_for_analysis,
+            "total_tokens": tokens_for_cheminfo + tokens_for_analysis,
+            "total_cost": cost_analysis + cost_cheminfo,
+        }
+
+        self.logger.log(info=loginfo)
+
+    def cheminfo_input(self, material):
+        return {"material": material, "example": self.constants.chemical_composition_example}
+
+    def analysis_input(self, query_result):
+        return {"material": query_result.material_name, "manufacturer": query_result.manufacturer_name,
+                "usecase": query_result.work_content, "chemical_composition": query_result.chemicals_list,
+                "example": self.constants.analysis_example, "additional_info": query_result.additional_info}
+
+    def fused_input(self, query_result):
+        return {"material": query_result.material_name, "manufacturer": query_result.manufacturer_name,
+                "usecase": query_result.work_content, "additional_info": query_result.additional_info,
+                "composition_example": self.constants.chemical_composition_example,
+                "analysis_example": self.constants.analysis_example}
+
+    def result_cache_key(self, query_result):
+        # computed once from the inputs as received, before the preflight may trim them
+        if query_result.cache_key is None:
+            query_result.cache_key = self.make_result_cache_key(query_result)
+        return query_result.cache_key
+
+    def make_result_cache_key(self, query_result):
+        fused = query_result.pipeline == AskViridiumConstants.pipelines["fused"]
+        return make_key(
+            self.fused_cache_version if fused else self.cache_version,
+            # read per query, so that reloading a list with the CLI takes effect without a restart
+            self.reference_index.version() if self.constants.reference_index_enabled and not fused else None,
+            normalize(query_result.material_name),
+            normalize(query_result.manufacturer_name),
+            normalize(query_result.work_content),
+            normalize(query_result.additional_info),
+            query_result.mode,
+        )
+
+    @staticmethod
+    def result_payload(query_result):
+        return {"chemical_composition": query_result.chemical_composition, "result": query_result.result}
+
+    def set_result_payload(self, query_result, payload):
+        self.set_chemical_composition(query_result, payload["chemical_composition"])
+        query_result.result = payload["result"]
+        query_result.pfas = query_result.result["decision"]
+
+    def load_cached_result(self, query_result):
+        cached = self.result_cache.get(self.result_cache_key(query_result))
+        if cached is None:
+            return False
+
+        self.set_result_payload(query_result, cached)
+        query_result.cached = True
+        self.log(query_result, 0, 0, 0, 0)
+        return True
+
+    def set_coalesced_result(self, query_result, payload):
+        self.set_result_payload(query_result, payload)
+        query_result.coalesced = True
+        self.log(query_result, 0, 0, 0, 0)
+
+    def save_cached_result(self, query_result):
+        self.result_cache.set(self.result_cache_key(query_result), self.result_payload(query_result))
+
+    def budget_exceeded(self, stage, predicted, details=None):
+        details = dict(details or {}, stage=stage, predicted_tokens=predicted,
+                       context_window=self.constants.context_window)
+        raise TokenBudgetExceededException(details=details)
+
+    def fit_additional_info(self, query_result):
+        if not query_result.additional_info:
+            return
+        limit = self.constants.additional_info_max_tokens
+        tokens = count_text_tokens(query_result.additional_info, self.model_name)
+        if tokens <= limit:
+            return
+        if self.constants.token_budget_policy != "trim":
+            self.budget_exceeded("additional_info", tokens, {"additional_info_max_tokens": limit})
+        query_result.additional_info = trim_text_to_tokens(query_result.additional_info, limit, self.model_name)
+
+    def preflight_cheminfo(self, query_result):
+        """Local token count of the stage 1 prompt, before anything is sent to Azure."""
+        # checked here as well so that an over-long additional_info is rejected before the first call
+        self.fit_additional_info(query_result)
+        messages = self.cheminfo_prompt.format_messages(**self.cheminfo_input(query_result.material_name))
+        prompt_tokens = count_message_tokens(messages, self.model_name) + self.cheminfo_function_tokens
+        if prompt_tokens + self.constants.llm_max_tokens > self.constants.context_window:
+            self.budget_exceeded("cheminfo", prompt_tokens)
+        query_result.predicted_tokens["cheminfo_prompt"] = prompt_tokens
+        query_result.predicted_tokens["cheminfo_max_completion"] = self.constants.llm_max_tokens
+
+    def count_analysis_prompt(self, query_result):
+        messages = self.analysis_prompt.format_messages(**self.analysis_input(query_result))
+        return count_message_tokens(messages, self.model_name) + self.analysis_function_tokens
+
+    def preflight_analysis(self, query_result):
+        """
+        Local token count of the stage 2 prompt. Depending on the policy, over-budget additional_info and
+        chemical lists are trimmed or the request is rejected with TokenBudgetExceededException.
+        """
+        trim = self.constants.token_budget_policy == "trim"
+        self.fit_additional_info(query_result)
+
+        if len(query_result.chemicals_list) > self.constants.max_chemicals:
+            if not trim:
+                self.budget_exceeded("analysis", None, {"chemicals": len(query_result.chemicals_list),
+                                                        "max_chemicals": self.constants.max_chemicals})
+            query_result.chemicals_list = query_result.chemicals_list[:self.constants.max_chemicals]
+
+        candidates = self.constants.consensus_candidates \
+            if query_result.mode == AskViridiumConstants.candidate_modes["consensus"] else 1
+        max_completion = self.constants.llm_max_tokens * candidates
+        budget = self.constants.context_window - max_completion
+
+        prompt_tokens = self.count_analysis_prompt(query_result)
+        while prompt_tokens > budget:
+            if not trim:
+                self.budget_exceeded("analysis", prompt_tokens, {"max_completion": max_completion})
+            if query_result.additional_info:
+                overflow = prompt_tokens - budget
+                remaining = count_text_tokens(query_result.additional_info, self.model_name) - overflow
+                query_result.additional_info = trim_text_to_tokens(
+                    query_result.additional_info, max(remaining, 0), self.model_name
+                ) or None
+            elif len(query_result.chemicals_list) > 1:
+                query_result.chemicals_list = query_result.chemicals_list[:len(query_result.chemicals_list) // 2]
+            else:
+                self.budget_exceeded("analysis", prompt_tokens, {"max_completion": max_completion})
+            prompt_tokens = self.count_analysis_prompt(query_result)
+
+        query_result.predicted_tokens["analysis_prompt"] = prompt_tokens
+        query_result.predicted_tokens["analysis_max_completion"] = max_completion
+        query_result.predicted_tokens["total"] = sum(
+            query_result.predicted_tokens.get(key, 0)
+            for key in ("cheminfo_prompt", "cheminfo_max_completion", "analysis_prompt", "analysis_max_completion")
+        )
+
+    def count_fused_prompt(self, query_result):
+        messages = self.fused_prompt.format_messages(**self.fused_input(query_result))
+        return count_message_tokens(messages, self.model_name) + self.fused_function_tokens
+
+    def preflight_fused(self, query_result):
+        """Local token count of the single prompt of the fused pipeline; only additional_info can be trimmed."""
+        self.fit_additional_info(query_result)
+        candidates = self.constants.consensus_candidates \
+            if query_result.mode == AskViridiumConstants.candidate_modes["consensus"] else 1
+        max_completion = self.constants.fused_max_tokens * candidates
+        budget = self.constants.context_window - max_completion
+
+        prompt_tokens = self.count_fused_prompt(query_result)
+        if prompt_tokens > budget and query_result.additional_info \
+                and self.constants.token_budget_policy == "trim":
+            remaining = count_text_tokens(query_result.additional_info, self.model_name) - (prompt_tokens - budget)
+            query_result.additional_info = trim_text_to_tokens(
+                query_result.additional_info, max(remaining, 0), self.model_name
+            ) or None
+            prompt_tokens = self.count_fused_prompt(query_result)
+        if prompt_tokens > budget:
+            self.budget_exceeded("fused", prompt_tokens, {"max_completion": max_completion})
+
+        query_result.predicted_tokens["fused_prompt"] = prompt_tokens
+        query_result.predicted_tokens["fused_max_completion"] = max_completion
+        query_result.predicted_tokens["total"] = prompt_tokens + max_completion
+
+    def composition_cache_key(self, material):
+        return make_key(self.composition_cache_version, normalize(material))
+
+    def set_chemical_composition(self, query_result, chemical_composition):
+        query_result.chemical_composition = chemical_composition
+        query_result.chemicals_list = [chemical["name"] for chemical in chemical_composition["chemicals"]]
+
+    def find_chemical_composition(self, query_result, bypass_cache: bool = False):
+        """
+        Stage 1: chemical composition of the material. It does not depend on manufacturer or use case, so it is
+        memoized per material and reused across those. Returns the tokens and cost spent.
+        """
+        key = self.composition_cache_key(query_result.material_name)
+        cached = None if bypass_cache else self.composition_cache.get(key)
+        if cached is not None:
+            self.set_chemical_composition(query_result, cached)
+            return 0, 0
+
+        self.preflight_cheminfo(query_result)
+        with track_stage("cheminfo") as cb:
+            cheminfo_input = self.cheminfo_input(query_result.material_name)
+            self.set_chemical_composition(query_result, self.call_llm(lambda: self.cheminfo_chain.invoke(cheminfo_input)))
+        self.composition_cache.set(key, query_result.chemical_composition)
+        return cb.total_tokens, cb.total_cost
+
+    async def afind_chemical_composition(self, query_result, bypass_cache: bool = False):
+        key = self.composition_cache_key(query_result.material_name)
+        cached = None if bypass_cache else self.composition_cache.get(key)
+        if cached is not None:
+            self.set_chemical_composition(query_result, cached)
+            return 0, 0
+
+        self.preflight_cheminfo(query_result)
+        with track_stage("cheminfo") as cb:
+            cheminfo_input = self.cheminfo_input(query_result.material_name)
+            self.set_chemical_composition(query_result, await self.acall_llm(lambda: self.cheminfo_chain.ainvoke(cheminfo_input)))
+        self.composition_cache.set(key, query_result.chemical_composition)
+        return cb.total_tokens, cb.total_cost
+
+    def analyse_from_reference_index(self, query_result):
+        """
+        Stage 2 without the LLM: when the composition is confident and every chemical in it has a known
+        status in the reference index, the MaterialInfo is built from the index. Returns False otherwise.
+        """
+        if not self.constants.reference_index_enabled:
+            return False
+        composition = query_result.chemical_composition or dict()
+        confidence = float(composition.get("confidence") or 0)
+        # some completions report the confidence as a percentage
+        if confidence > 1:
+            confidence /= 100
+        if confidence < self.constants.reference_index_min_confidence:
+            reference_index_lookups.inc(outcome="low_confidence")
+            return False
+
+        matches = self.reference_index.resolve(composition.get("chemicals"))
+        if matches is None:
+            reference_index_lookups.inc(outcome="unresolved")
+            return False
+
+        reference_index_lookups.inc(outcome="resolved")
+        query_result.result = material_info(query_result.material_name, matches)
+        query_result.pfas = query_result.result["decision"]
+        query_result.analysis_source = "reference_index"
+        return True
+
+    def run_analysis(self, query_result):
+        """Stage 2. Returns the tokens and cost spent."""
+        query_result.analysis_source = "llm"
+        self.preflight_analysis(query_result)
+        with track_stage("analysis", query_result.mode) as cb:
+            if query_result.mode == AskViridiumConstants.candidate_modes["consensus"]:
+                messages = self.analysis_prompt.format_messages(**self.analysis_input(query_result))
+                llm_result = self.call_llm(lambda: self.llm.generate([messages], **self.consensus_kwargs))
+                query_result.result = self.vote(llm_result)
+            else:
+                analysis_input = self.analysis_input(query_result)
+                query_result.result = self.call_llm(lambda: self.analysis_chain.invoke(analysis_input))
+            query_result.pfas = query_result.result["decision"]
+        return cb.total_tokens, cb.total_cost
+
+    async def arun_analysis(self, query_result):
+        query_result.analysis_source = "llm"
+        self.preflight_analysis(query_result)
+        with track_stage("analysis", query_result.mode) as cb:
+            if query_result.mode == AskViridiumConstants.candidate_modes["consensus"]:
+                messages = self.analysis_prompt.format_messages(**self.analysis_input(query_result))
+                llm_result = await self.acall_llm(lambda: self.llm.agenerate([messages], **self.consensus_kwargs))
+                query_result.result = self.vote(llm_result)
+            else:
+                analysis_input = self.analysis_input(query_result)
+                query_result.result = await self.acall_llm(lambda: self.analysis_chain.ainvoke(analysis_input))
+            query_result.pfas = query_result.result["decision"]
+        return cb.total_tokens, cb.total_cost
+
+    def set_fused_result(self, query_result, screening):
+        self.set_chemical_composition(query_result, screening["chemical_composition"])
+        query_result.result = screening["analysis"]
+        query_result.pfas = query_result.result["decision"]
+
+    def run_fused(self, query_result):
+        """Composition and analysis from one MaterialScreening completion. Returns the tokens and cost spent."""
+        query_result.analysis_source = "llm"
+        self.preflight_fused(query_result)
+        with track_stage("fused", query_result.mode) as cb:
+            if query_result.mode == AskViridiumConstants.candidate_modes["consensus"]:
+                messages = self.fused_prompt.format_messages(**self.fused_input(query_result))
+                llm_result = self.call_llm(lambda: self.llm.generate([messages], **self.fused_consensus_kwargs))
+                self.set_fused_result(query_result, self.vote_fused(llm_result))
+            else:
+                fused_input = self.fused_input(query_result)
+                self.set_fused_result(query_result, self.call_llm(lambda: self.fused_chain.invoke(fused_input)))
+        return cb.total_tokens, cb.total_cost
+
+    async def arun_fused(self, query_result):
+        query_result.analysis_source = "llm"
+        self.preflight_fused(query_result)
+        with track_stage("fused", query_result.mode) as cb:
+            if query_result.mode == AskViridiumConstants.candidate_modes["consensus"]:
+                messages = self.fused_prompt.format_messages(**self.fused_input(query_result))
+                llm_result = await self.acall_llm(lambda: self.llm.agenerate([messages], **self.fused_consensus_kwargs))
+                self.set_fused_result(query_result, self.vote_fused(llm_result))
+            else:
+                fused_input = self.fused_input(query_result)
+                self.set_fused_result(query_result, await self.acall_llm(lambda: self.fused_chain.ainvoke(fused_input)))
+        return cb.total_tokens, cb.total_cost
+
+    def vote_fused(self, llm_result):
+        # vote on the analyses, and keep the composition of the candidate the voted analysis came from
+        candidates = [self.parser.parse_result([generation]) for generation in llm_result.generations[0]]
+        analysis = vote([candidate["analysis"] for candidate in candidates])
+        decision = normalize(analysis.get("decision"))
+        composition = next(
+            candidate["chemical_composition"] for candidate in candidates
+            if normalize(candidate["analysis"].get("decision")) == decision
+        )
+        return {"chemical_composition": composition, "analysis": analysis}
+
+    def vote(self, llm_result):
+        # every choice of the n completions is a MaterialInfo function call
+        candidates = [self.parser.parse_result([generation]) for generation in llm_result.generations[0]]
+        return vote(candidates)
+
+    def query(self, material_name, manufacturer_name: Optional[str] = "Not Available", work_content: Optional[str] = "Not Available", additional_info: Optional[str] = None, bypass_cache: bool = False, mode: str = AskViridiumConstants.candidate_modes["fast"], pipeline: str = AskViridiumConstants.pipelines["two_step"]):
+        query_result = AskViridiumResult(material_name, manufacturer_name, work_content, additional_info, mode, pipeline)
+        if not bypass_cache and self.load_cached_result(query_result):
+            return query_result
+
+        # identical queries arriving while this one is in flight wait for it instead of calling Azure again
+        key = self.result_cache_key(query_result)
+        payload, shared = self.single_flight.do(
+            key,
+            lambda: self.run_pipeline(query_result, bypass_cache),
+            recheck=None if bypass_cache else lambda: self.result_cache.peek(key),
+        )
+        if shared:
+            self.set_coalesced_result(query_result, payload)
+        return query_result
+
+    def run_pipeline(self, query_result, bypass_cache: bool = False):
+        if query_result.pipeline == AskViridiumConstants.pipelines["fused"]:
+            # one completion; its tokens are reported under the analysis
+            tokens_for_cheminfo, cost_for_cheminfo = 0, 0
+            tokens_for_analysis, cost_for_analysis = self.run_fused(query_result)
+        else:
+            tokens_for_cheminfo, cost_for_cheminfo = self.find_chemical_composition(query_result, bypass_cache)
+            if self.analyse_from_reference_index(query_result):
+                tokens_for_analysis, cost_for_analysis = 0, 0
+            else:
+                tokens_for_analysis, cost_for_analysis = self.run_analysis(query_result)
+
+        self.log(query_result, tokens_for_cheminfo, tokens_for_analysis, cost_for_cheminfo, cost_for_analysis)
         self.logger.save()
+        self.save_cached_result(query_result)
+
+        self.store(query_result)
+
+        return self.result_payload(query_result)
+
+    async def aquery(self, material_name, manufacturer_name: Optional[str] = "Not Available", work_content: Optional[str] = "Not Available", additional_info: Optional[str] = None, bypass_cache: bool = False, mode: str = AskViridiumConstants.candidate_modes["fast"], pipeline: str = AskViridiumConstants.pipelines["two_step"]):
+        """Same pipeline as query(), awaiting the network calls so many materials can share one thread."""
+        query_result = AskViridiumResult(material_name, manufacturer_name, work_content, additional_info, mode, pipeline)
+        if not bypass_cache and self.load_cached_result(query_result):
+            return query_result
+
+        key = self.result_cache_key(query_result)
+        payload, shared = await self.single_flight.ado(
+            key,
+            lambda: self.arun_pipeline(query_result, bypass_cache),
+            recheck=None if bypass_cache else lambda: self.result_cache.peek(key),
+        )
+        if shared:
+            self.set_coalesced_result(query_result, payload)
+        return query_result
 
-        store = self.store()
-        print(store)
+    async def arun_pipeline(self, query_result, bypass_cache: bool = False):
+        if query_result.pipeline == AskViridiumConstants.pipelines["fused"]:
+            tokens_for_cheminfo, cost_for_cheminfo = 0, 0
+            tokens_for_analysis, cost_for_analysis = await self.arun_fused(query_result)
+        else:
+            tokens_for_cheminfo, cost_for_cheminfo = await self.afind_chemical_composition(query_result, bypass_cache)
+            if self.analyse_from_reference_index(query_result):
+                tokens_for_analysis, cost_for_analysis = 0, 0
+            else:
+                tokens_for_analysis, cost_for_analysis = await self.arun_analysis(query_result)
 
-        return self.result
+        self.log(query_result, tokens_for_cheminfo, tokens_for_analysis, cost_for_cheminfo, cost_for_analysis)
+        self.save_cached_result(query_result)
 
-    def handle_user_query(self, additional_info, material, manufacturer, work_content, chemicals_list):
-        with get_openai_callback() as cb:
-            self.result = self.analysis_chain.invoke(
-                {"material": material, "manufacturer": manufacturer, "usecase": work_content,
-                 "chemical_composition": chemicals_list, "example": self.constants.analysis_example,
-                 "additional_info": additional_info})
-    def store(self):
-        # Read existing data from the file
-        try:
-            with open("data.json", 'r') as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            data = []
+        self.store(query_result)
 
-        # Append the new result
-        data.append(self.result)
+        return self.result_payload(query_result)
+
+    async def abatch_query(self, items, max_concurrency: int = GlobalConstants.batch_max_concurrency):
+        """
+        Run the two-stage pipeline for a list of materials concurrently.
+
+        Args:
+            items (list): dicts with material_name and optionally manufacturer_name / work_content.
+            max_concurrency (int): maximum number of materials in flight at once.
+
+        Returns:
+            list: one entry per item, in input order, with either a result or an error.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        input_parameters = AskViridiumConstants.input_parameters
+
+        async def run(index, item):
+            async with semaphore:
+                try:
+                    query_result = await self.aquery(
+                        item[input_parameters["material_name"]],
+                        item.get(input_parameters["manufacturer_name"]) or AskViridiumConstants.default_input_value,
+                        item.get(input_parameters["work_content"]) or AskViridiumConstants.default_input_value,
+                        bypass_cache=bool(item.get(input_parameters["bypass_cache"], False)),
+                        mode=item.get(input_parameters["mode"]) or AskViridiumConstants.candidate_modes["fast"],
+                        pipeline=item.get(input_parameters["pipeline"]) or AskViridiumConstants.pipelines["two_step"],
+                    )
+                except Exception as e:
+                    return {"index": index, "status": "error", "error": f"{type(e).__name__}: {e}"}
+            return {"index": index, "status": "success", "result": query_result.result, "cached": query_result.cached,
+                    "usage": query_result.usage, "predicted_tokens": query_result.predicted_tokens}
+
+        results = await asyncio.gather(*(run(index, item) for index, item in enumerate(items)))
+
+        # the results are stored by arun_pipeline as they come in; the log is saved once for the whole batch
+        self.logger.save()
+        return results
 
-        # Write the updated data back to the file
-        with open("data.json", 'w') as file:
-            json.dump(data, file, indent=4)
+    def stream_query(self, material_name, manufacturer_name: Optional[str] = "Not Available", work_content: Optional[str] = "Not Available", additional_info: Optional[str] = None, bypass_cache: bool = False):
+        """
+        Generator version of query() yielding (event, data) pairs as soon as they are available:
+        "composition" after stage 1, "analysis" with the partially parsed MaterialInfo while it is generated,
+        and "done" with the final result and token / cost totals.
+        """
+        # a streamed completion only carries one choice, so streaming is always the fast mode
+        query_result = AskViridiumResult(material_name, manufacturer_name, work_content, additional_info)
+        self.result_cache_key(query_result)
+        if not bypass_cache and self.load_cached_result(query_result):
+            yield "composition", query_result.chemical_composition
+            yield "analysis", query_result.result
+            yield "done", {"result": query_result.result, "cached": True, "total_tokens": 0, "total_cost": 0}
+            return
+
+        tokens_for_cheminfo, cost_for_cheminfo = self.find_chemical_composition(query_result, bypass_cache)
+        yield "composition", query_result.chemical_composition
+
+        if self.analyse_from_reference_index(query_result):
+            yield "analysis", query_result.result
+            tokens_for_analysis, cost_for_analysis = 0, 0
+        else:
+            query_result.analysis_source = "llm"
+            self.preflight_analysis(query_result)
+            analysis_input = self.analysis_input(query_result)
+            with track_stage("analysis", "stream"):
+                for partial in self.analysis_chain.stream(analysis_input):
+                    query_result.result = partial
+                    yield "analysis", partial
+            query_result.pfas = query_result.result.get("decision")
+
+            # usage is not reported for streamed completions, so the analysis stage is counted locally
+            prompt_tokens = query_result.predicted_tokens["analysis_prompt"]
+            completion_tokens = count_text_tokens(json.dumps(query_result.result), self.model_name)
+            tokens_for_analysis = prompt_tokens + completion_tokens
+            cost_for_analysis = estimate_cost(self.model_name, prompt_tokens, completion_tokens)
+            observe_tokens("analysis", prompt_tokens, completion_tokens, cost_for_analysis)
+
+        self.log(query_result, tokens_for_cheminfo, tokens_for_analysis, cost_for_cheminfo, cost_for_analysis)
+        self.logger.save()
+        self.save_cached_result(query_result)
+        self.store(query_result)
+
+        yield "done", {
+            "result": query_result.result,
+            "cached": False,
+            "total_tokens": tokens_for_cheminfo + tokens_for_analysis,
+            "total_cost": cost_for_cheminfo + cost_for_analysis,
+            "predicted_tokens": query_result.predicted_tokens,
+        }
+
+    def handle_user_query(self, additional_info, material, manufacturer, work_content, chemicals_list=None, mode: str = AskViridiumConstants.candidate_modes["fast"]):
+        query_result = AskViridiumResult(material, manufacturer, work_content, additional_info, mode)
+        if chemicals_list is None:
+            # follow-ups reuse the memoized stage 1 result instead of asking for the composition again
+            self.find_chemical_composition(query_result)
+        else:
+            query_result.chemicals_list = chemicals_list
+
+        tokens_for_analysis, cost_for_analysis = self.run_analysis(query_result)
+        self.log(query_result, 0, tokens_for_analysis, 0, cost_for_analysis)
+        self.logger.save()
+        self.store(query_result)
+        return query_result
+
+    def start_session(self, query_result):
+        """Keep the composition and first-pass result of an analysis for follow-up questions."""
+        return self.sessions.create({
+            "material_name": query_result.material_name,
+            "manufacturer_name": query_result.manufacturer_name,
+            "work_content": query_result.work_content,
+            "mode": query_result.mode,
+            "chemical_composition": query_result.chemical_composition,
+            "result": query_result.result,
+        })
+
+    def follow_up(self, session_id, additional_info):
+        """
+        Re-run only the analysis stage of a previous query with extra information from the user.
+
+        Returns:
+            AskViridiumResult, or None when the session is unknown or expired.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+
+        query_result = self.handle_user_query(
+            additional_info,
+            session["material_name"],
+            session["manufacturer_name"],
+            session["work_content"],
+            chemicals_list=[chemical["name"] for chemical in session["chemical_composition"]["chemicals"]],
+            mode=session["mode"],
+        )
+        query_result.chemical_composition = session["chemical_composition"]
+        self.sessions.update(session_id, dict(session, result=query_result.result))
+        return query_result
 
+    def store(self, query_result):
+        self.result_store.append(query_result)
         return "results saved"
 
 
@@ -0,0 +1,397 @@
+"""
+PFAS screening of a whole bill of materials from the command line.
+
+Rows are streamed from a CSV or XLSX file, identical materials (same normalised material, manufacturer
+and work content) are analysed once, and at most --concurrency materials are in flight at a time. Every
+finished material is recorded in a SQLite checkpoint, so an interrupted run (crash, quota errors) resumes
+with the materials that are still missing. The output has one row per input row, as CSV or Parquet, and
+the token and cost totals are printed at the end.
+
+Run from the askviridium directory:
+    python -m ask_viridium_ai.bulk materials.xlsx --output results.parquet --concurrency 8
+
+Reading .xlsx files needs openpyxl and writing .parquet files needs pyarrow.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from global_constants import GlobalConstants
+from models import MaterialInfo
+from .ask_viridium_ai import AskViridium
+from .cache import make_key, normalize
+from .constants import AskViridiumConstants
+
+RESULT_COLUMNS = list(MaterialInfo.__fields__)
+OUTPUT_COLUMNS = [
+    "row", "material_name", "manufacturer_name", "work_content", "status", "error", "cached",
+    "total_tokens", "total_cost", "chemicals",
+] + RESULT_COLUMNS
+
+
+class BulkCheckpoint:
+    """
+    Outcome of every distinct material of a bulk run, keyed like the result cache. Materials with status
+    "done" are skipped when a run is resumed, failed ones are tried again.
+
+    Args:
+        path (str): SQLite database file.
+    """
+
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS materials (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                result TEXT,
+                chemicals TEXT,
+                error TEXT,
+                cached INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                total_cost REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def done_keys(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT key FROM materials WHERE status = ?", (self.DONE,)).fetchall()
+        return {row[0] for row in rows}
+
+    def save(self, key, status, result=None, chemicals=None, error=None, cached=False, total_tokens=0, total_cost=0.0):
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT INTO materials (key, status, result, chemicals, error, cached, total_tokens, total_cost,
+                                       attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    status = excluded.status, result = excluded.result, chemicals = excluded.chemicals,
+                    error = excluded.error, cached = excluded.cached, total_tokens = excluded.total_tokens,
+                    total_cost = excluded.total_cost, attempts = attempts + 1, updated_at = excluded.updated_at
+                """,
+                (key, status, json.dumps(result) if result is not None else None,
+                 json.dumps(chemicals) if chemicals is not None else None, error, int(cached), total_tokens,
+                 total_cost, time.time()),
+            )
+            self.connection.commit()
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        found = dict()
+        with self.lock:
+            # stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.connection.execute(
+                    "SELECT key, status, result, chemicals, error, cached, total_tokens, total_cost FROM materials "
+                    f"WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, status, result, chemicals, error, cached, total_tokens, total_cost in rows:
+                    found[key] = {
+                        "status": status,
+                        "result": json.loads(result) if result else None,
+                        "chemicals": json.loads(chemicals) if chemicals else None,
+                        "error": error,
+                        "cached": bool(cached),
+                        "total_tokens": total_tokens,
+                        "total_cost": total_cost,
+                    }
+        return found
+
+
+def read_rows(path, sheet=None):
+    """Yields every data row of a CSV or XLSX file as a dict keyed by the header row."""
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            from openpyxl import load_workbook
+        except ImportError as e:
+            raise ImportError("Reading .xlsx files needs openpyxl (pip install openpyxl)") from e
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = (workbook[sheet] if sheet else workbook.active).iter_rows(values_only=True)
+            header = [str(value).strip() if value is not None else "" for value in next(rows, ())]
+            for values in rows:
+                yield dict(zip(header, ("" if value is None else str(value) for value in values)))
+        finally:
+            workbook.close()
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            yield from csv.DictReader(file)
+
+
+class CsvOutput:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=OUTPUT_COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetOutput:
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Writing .parquet files needs pyarrow (pip install pyarrow)") from e
+
+        self.pa = pa
+        types = {"row": pa.int64(), "cached": pa.bool_(), "total_tokens": pa.int64(), "total_cost": pa.float64(),
+                 "confidence": pa.float64()}
+        self.schema = pa.schema([(column, types.get(column, pa.string())) for column in OUTPUT_COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_output(path):
+    return ParquetOutput(path) if path.lower().endswith(".parquet") else CsvOutput(path)
+
+
+class BulkRun:
+    """
+    Args:
+        ask_vai (AskViridium): engine the materials are analysed with.
+        checkpoint (BulkCheckpoint): where finished materials are recorded.
+        columns (dict): input column holding each of material_name, manufacturer_name and work_content.
+        mode (str): candidate mode of every analysis.
+        pipeline (str): two_step or fused.
+        concurrency (int): maximum number of materials in flight at once.
+        chunk_size (int): materials scheduled together; results are stored and progress reported per chunk.
+        max_consecutive_errors (int): stop the run after this many failures in a row, e.g. an exhausted quota.
+        bypass_cache (bool): analyse again even when the result cache has an answer.
+    """
+
+    def __init__(self, ask_vai, checkpoint, columns, mode, pipeline, concurrency, chunk_size, max_consecutive_errors,
+                 bypass_cache=False):
+        self.ask_vai = ask_vai
+        self.checkpoint = checkpoint
+        self.columns = columns
+        self.mode = mode
+        self.pipeline = pipeline
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_consecutive_errors = max_consecutive_errors
+        self.bypass_cache = bypass_cache
+        self.consecutive_errors = 0
+        self.aborted = False
+
+    def item(self, row):
+        default = AskViridiumConstants.default_input_value
+        return {
+            name: (row.get(column) or "").strip() or (None if name == "material_name" else default)
+            for name, column in self.columns.items()
+        }
+
+    def key(self, item):
+        parts = [normalize(item["material_name"]), normalize(item["manufacturer_name"]),
+                 normalize(item["work_content"]), self.mode]
+        # two_step keys stay as they were, so checkpoints of earlier runs still resume
+        if self.pipeline != AskViridiumConstants.pipelines["two_step"]:
+            parts.append(self.pipeline)
+        return make_key(*parts)
+
+    def pending(self, rows):
+        """Distinct materials of the input that the checkpoint has no result for yet, in input order."""
+        done = self.checkpoint.done_keys()
+        pending = dict()
+        stats = {"rows": 0, "invalid": 0, "distinct": 0, "already_done": 0}
+        seen = set()
+        for row in rows:
+            stats["rows"] += 1
+            item = self.item(row)
+            if not item["material_name"]:
+                stats["invalid"] += 1
+                continue
+            key = self.key(item)
+            if key in seen:
+                continue
+            seen.add(key)
+            if key in done:
+                stats["already_done"] += 1
+            else:
+                pending[key] = item
+        stats["distinct"] = len(seen)
+        return pending, stats
+
+    async def analyse(self, semaphore, key, item):
+        async with semaphore:
+            if self.aborted:
+                return
+            try:
+                query_result = await self.ask_vai.aquery(
+                    item["material_name"], item["manufacturer_name"], item["work_content"],
+                    bypass_cache=self.bypass_cache, mode=self.mode, pipeline=self.pipeline,
+                )
+            except Exception as e:
+                self.checkpoint.save(key, BulkCheckpoint.FAILED, error=f"{type(e).__name__}: {e}")
+                self.consecutive_errors += 1
+                if self.consecutive_errors >= self.max_consecutive_errors:
+                    self.aborted = True
+                return
+
+        self.consecutive_errors = 0
+        usage = query_result.usage or dict()
+        self.checkpoint.save(
+            key, BulkCheckpoint.DONE, result=query_result.result, chemicals=query_result.chemicals_list,
+            cached=query_result.cached or query_result.coalesced,
+            total_tokens=usage.get("total_tokens", 0), total_cost=usage.get("total_cost", 0.0),
+        )
+
+    async def process(self, pending):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        items = list(pending.items())
+        processed = 0
+        for start in range(0, len(items), self.chunk_size):
+            chunk = items[start:start + self.chunk_size]
+            # every computed result is already in the result store, see AskViridium.arun_pipeline
+            await asyncio.gather(*(self.analyse(semaphore, key, item) for key, item in chunk))
+            self.ask_vai.logger.save()
+            processed += len(chunk)
+            print(f"{processed}/{len(items)} materials processed")
+            if self.aborted:
+                print(f"Stopped after {self.consecutive_errors} consecutive errors, run again to resume")
+                return
+
+    def output_row(self, index, item, outcome):
+        outcome = outcome or {"status": "pending"}
+        result = outcome.get("result") or dict()
+        row = {
+            "row": index,
+            "material_name": item["material_name"],
+            "manufacturer_name": item["manufacturer_name"],
+            "work_content": item["work_content"],
+            "status": outcome["status"] if item["material_name"] else "invalid",
+            "error": outcome.get("error"),
+            "cached": outcome.get("cached"),
+            "total_tokens": outcome.get("total_tokens"),
+            "total_cost": outcome.get("total_cost"),
+            "chemicals": json.dumps(outcome["chemicals"]) if outcome.get("chemicals") is not None else None,
+        }
+        for column in RESULT_COLUMNS:
+            value = result.get(column)
+            if column == "confidence":
+                try:
+                    value = float(value) if value is not None else None
+                except (TypeError, ValueError):
+                    value = None
+            elif isinstance(value, (list, dict)):
+                value = json.dumps(value)
+            elif value is not None:
+                value = str(value)
+            row[column] = value
+        return row
+
+    def write_output(self, rows, output):
+        """Joins the checkpoint back onto every input row and returns token and cost totals."""
+        totals = {"done": 0, "failed": 0, "pending": 0, "total_tokens": 0, "total_cost": 0.0}
+        counted = set()
+
+        def flush(chunk):
+            outcomes = self.checkpoint.get_many(key for _, _, key in chunk if key)
+            written = []
+            for index, item, key in chunk:
+                outcome = outcomes.get(key)
+                written.append(self.output_row(index, item, outcome))
+                if key is None or key in counted:
+                    continue
+                counted.add(key)
+                status = outcome["status"] if outcome else "pending"
+                totals[status] = totals.get(status, 0) + 1
+                if outcome:
+                    totals["total_tokens"] += outcome["total_tokens"]
+                    totals["total_cost"] += outcome["total_cost"]
+            output.write(written)
+
+        chunk = []
+        for index, row in enumerate(rows, start=1):
+            item = self.item(row)
+            chunk.append((index, item, self.key(item) if item["material_name"] else None))
+            if len(chunk) >= self.chunk_size:
+                flush(chunk)
+                chunk = []
+        flush(chunk)
+        return totals
+
+
+def main():
+    input_parameters = AskViridiumConstants.input_parameters
+    parser = argparse.ArgumentParser(description="PFAS screening of a CSV or XLSX bill of materials.")
+    parser.add_argument("input", help="CSV or XLSX file with one material per row")
+    parser.add_argument("--output", help="CSV or .parquet file, defaults to <input>.results.csv")
+    parser.add_argument("--sheet", help="worksheet of an XLSX file, defaults to the active one")
+    parser.add_argument("--checkpoint", default=GlobalConstants.bulk_checkpoint_path)
+    parser.add_argument("--concurrency", type=int, default=GlobalConstants.batch_max_concurrency)
+    parser.add_argument("--chunk-size", type=int, default=GlobalConstants.bulk_chunk_size)
+    parser.add_argument("--max-consecutive-errors", type=int, default=20)
+    parser.add_argument("--mode", default=AskViridiumConstants.candidate_modes["fast"],
+                        choices=sorted(AskViridiumConstants.candidate_modes.values()))
+    parser.add_argument("--pipeline", default=AskViridiumConstants.pipelines["two_step"],
+                        choices=sorted(AskViridiumConstants.pipelines.values()))
+    parser.add_argument("--bypass-cache", action="store_true")
+    parser.add_argument("--material-column", default=input_parameters["material_name"])
+    parser.add_argument("--manufacturer-column", default=input_parameters["manufacturer_name"])
+    parser.add_argument("--work-content-column", default=input_parameters["work_content"])
+    args = parser.parse_args()
+
+    output_path = args.output or f"{os.path.splitext(args.input)[0]}.results.csv"
+    columns = {
+        "material_name": args.material_column,
+        "manufacturer_name": args.manufacturer_column,
+        "work_content": args.work_content_column,
+    }
+    run = BulkRun(AskViridium(), BulkCheckpoint(args.checkpoint), columns, args.mode, args.pipeline,
+                  max(args.concurrency, 1), max(args.chunk_size, 1), args.max_consecutive_errors, args.bypass_cache)
+
+    pending, stats = run.pending(read_rows(args.input, args.sheet))
+    print(f"{stats['rows']} rows, {stats['distinct']} distinct materials, {stats['already_done']} already done, "
+          f"{len(pending)} to process, {stats['invalid']} rows without a material name")
+    if pending:
+        asyncio.run(run.process(pending))
+
+    output = open_output(output_path)
+    try:
+        totals = run.write_output(read_rows(args.input, args.sheet), output)
+    finally:
+        output.close()
+    run.ask_vai.logger.close()
+
+    print(f"Results written to {output_path}")
+    print(f"{totals['done']} done, {totals['failed']} failed, {totals['pending']} pending, "
+          f"{totals['total_tokens']} tokens, ${totals['total_cost']:.4f}")
+    if totals["failed"] or totals["pending"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+
+def normalize(value):
+    """Case- and whitespace-insensitive form of a user supplied input, used for cache keys."""
+    if value is None:
+        return ""
+    return re.sub(r"\s+", " ", str(value)).strip().lower()
+
+
+def make_key(*parts):
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent key/value cache backed by SQLite with TTL expiry and LRU eviction.
+
+    Args:
+        path (str): SQLite database file, shared with other caches using a different table.
+        table (str): table holding this cache's entries.
+        ttl_seconds (int): entries older than this are treated as misses and removed. 0 disables expiry.
+        max_entries (int): least recently used entries are evicted above this size.
+        touch_interval (float): a hit only rewrites last_access when it is older than this, so that repeated
+            hits on a hot entry stay reads instead of each taking SQLite's write lock.
+    """
+
+    def __init__(self, path, table="results", ttl_seconds=0, max_entries=10000, touch_interval=60.0):
+        self.path = path
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.connect()
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_last_access ON {table} (last_access)")
+        self.connection.commit()
+
+    def connect(self):
+        """(Re)opens the connection, e.g. in a worker process forked after close()."""
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT value, created_at, last_access FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self.connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if now - row[2] >= self.touch_interval:
+                self.connection.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+                self.connection.commit()
+        return json.loads(row[0])
+
+    def peek(self, key):
+        """Like get(), but neither counted as a hit or miss nor refreshing the entry's LRU position."""
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (self.ttl_seconds and time.time() - row[1] > self.ttl_seconds):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # caller holds the lock
+        count = self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute(f"DELETE FROM {self.table}")
+            self.connection.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": size,
+        }
@@ -0,0 +1,31 @@
+from collections import Counter
+
+from .cache import normalize
+
+
+def vote(candidates):
+    """
+    Combine several MaterialInfo candidates into one answer.
+
+    The majority decision wins (ties go to the candidate that came first). The returned result is the most
+    confident candidate with that decision, with the evidence of every agreeing candidate merged into it and
+    an agreement_score: the share of candidates that reached the majority decision.
+    """
+    if not candidates:
+        raise ValueError("No candidates to vote on")
+
+    decisions = [normalize(candidate.get("decision")) for candidate in candidates]
+    counts = Counter(decisions)
+    majority = max(counts, key=lambda decision: (counts[decision], -decisions.index(decision)))
+    agreeing = [candidate for candidate, decision in zip(candidates, decisions) if decision == majority]
+
+    result = dict(max(agreeing, key=lambda candidate: candidate.get("confidence") or 0))
+    evidence = []
+    for candidate in agreeing:
+        for item in candidate.get("evidence") or []:
+            if item not in evidence:
+                evidence.append(item)
+    result["evidence"] = evidence
+    result["agreement_score"] = counts[majority] / len(candidates)
+    result["candidates"] = len(candidates)
+    return result
@@ -1,6 +1,35 @@
+import os
+
+
 class AskViridiumConstants:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
     input_parameters = {
         "material_name": "material_name",
         "manufacturer_name": "manufacturer_name",
-        "work_content": "work_content"
+        "work_content": "work_content",
+        "bypass_cache": "bypass_cache",
+        "mode": "mode",
+        "additional_info": "additional_info",
+        "session_id": "session_id",
+        "pipeline": "pipeline",
     }
+
+    # fast: a single completion. consensus: GlobalConstants.consensus_candidates completions, majority vote
+    candidate_modes = {
+        "fast": "fast",
+        "consensus": "consensus",
+    }
+
+    # two_step: composition, then analysis. fused: both from a single MaterialScreening function call
+    pipelines = {
+        "two_step": "two_step",
+        "fused": "fused",
+    }
+
+    prompt_files = {
+        "cheminfo": os.path.join(base_dir, "findchemicals_prompt.txt"),
+        "analysis": os.path.join(base_dir, "newprompt.txt"),
+    }
+
+    default_input_value = "Not Available"
@@ -0,0 +1,214 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from utils.exceptions import QueueFullException
+
+
+class JobQueue:
+    """
+    Persistent queue of analyses, drained by a fixed pool of worker threads.
+
+    Jobs live in SQLite so queued work survives a restart. A running job holds a lease that its worker renews
+    while the handler runs; when the worker dies or is recycled the lease runs out and any worker of any
+    process claims the job again, up to max_attempts claims in all: a job that keeps taking its worker down
+    is failed instead of being retried forever.
+
+    Args:
+        path (str): SQLite database file.
+        handler (callable): called with the job payload by a worker, returns a JSON serialisable result.
+        max_depth (int): enqueue() raises QueueFullException once this many jobs are waiting.
+        poll_interval (float): how long an idle worker sleeps before checking the database again.
+        lease_seconds (float): how long a running job stays claimed without its worker renewing the lease.
+        max_attempts (int): claims of one job before it is failed when its lease runs out again.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path, handler, max_depth=1000, poll_interval=1.0, lease_seconds=300.0, max_attempts=3):
+        self.path = path
+        self.handler = handler
+        self.max_depth = max_depth
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.lock = threading.Lock()
+        self.job_available = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+
+        self.connect()
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                lease_expires_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created_at ON jobs (status, created_at);
+            """
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")]
+        if "lease_expires_at" not in columns:
+            # running jobs of a database from before leases have none and are claimed again right away
+            self.connection.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+        if "attempts" not in columns:
+            self.connection.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def connect(self):
+        """(Re)opens the connection, e.g. in a worker process forked after close()."""
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def depth(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (self.QUEUED,)
+            ).fetchone()[0]
+
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            depth = self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (self.QUEUED,)).fetchone()[0]
+            if depth >= self.max_depth:
+                raise QueueFullException(details={"depth": depth, "max_depth": self.max_depth})
+            self.connection.execute(
+                "INSERT INTO jobs (id, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, self.QUEUED, json.dumps(payload), now, now),
+            )
+            self.job_available.notify()
+        return job_id
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, status, result, error, created_at, updated_at, attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "result": json.loads(row[2]) if row[2] else None,
+            "error": row[3],
+            "created_at": row[4],
+            "updated_at": row[5],
+            "attempts": row[6],
+        }
+
+    def claim(self):
+        """
+        Atomically move the oldest queued job, or a running one whose lease ran out, to running. A job whose
+        lease ran out after max_attempts claims is failed instead. Returns (job_id, payload) or None.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                while True:
+                    row = self.connection.execute(
+                        "SELECT id, payload, attempts FROM jobs "
+                        "WHERE status = ? OR (status = ? AND (lease_expires_at IS NULL OR lease_expires_at < ?)) "
+                        "ORDER BY created_at LIMIT 1",
+                        (self.QUEUED, self.RUNNING, now),
+                    ).fetchone()
+                    if row is None or row[2] < self.max_attempts:
+                        break
+                    self.connection.execute(
+                        "UPDATE jobs SET status = ?, error = ?, updated_at = ?, lease_expires_at = NULL WHERE id = ?",
+                        (self.FAILED, f"Worker lost {row[2]} times, not retried again", now, row[0]),
+                    )
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET status = ?, updated_at = ?, lease_expires_at = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (self.RUNNING, now, now + self.lease_seconds, row[0]),
+                    )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def renew(self, job_id):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ?",
+                (time.time() + self.lease_seconds, job_id, self.RUNNING),
+            )
+
+    def keep_leased(self, job_id, finished):
+        """Renews the lease of a running job until finished is set."""
+        while not finished.wait(self.lease_seconds / 3):
+            try:
+                self.renew(job_id)
+            except sqlite3.Error:
+                # retried on the next beat; the lease is long enough to miss one
+                continue
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, lease_expires_at = NULL "
+                "WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+
+    def wait_for_job(self):
+        with self.job_available:
+            self.job_available.wait(self.poll_interval)
+
+    def stop(self):
+        """Let workers finish the job they are running and exit instead of claiming new ones."""
+        self.stopped.set()
+        with self.job_available:
+            self.job_available.notify_all()
+
+    def process_waiting_api_calls(self, index):
+        """Worker loop, meant to be started with ThreadingTool.create_and_start_threads."""
+        while not self.stopped.is_set():
+            job = self.claim()
+            if job is None:
+                self.wait_for_job()
+                continue
+
+            job_id, payload = job
+            finished = threading.Event()
+            threading.Thread(target=self.keep_leased, args=(job_id, finished), name=f"job-lease-{index}",
+                             daemon=True).start()
+            try:
+                result = self.handler(payload)
+            except Exception as e:
+                self.finish_safely(job_id, self.FAILED, error=f"{type(e).__name__}: {e}")
+            else:
+                self.finish_safely(job_id, self.DONE, result=result)
+            finally:
+                finished.set()
+
+    def finish_safely(self, job_id, status, result=None, error=None):
+        # an error here must not end the worker thread: e.g. a result that is not JSON serialisable fails the
+        # job, and if even that cannot be written the lease runs out and the job is retried
+        try:
+            self.finish(job_id, status, result=result, error=error)
+        except Exception as e:
+            try:
+                self.finish(job_id, self.FAILED, error=f"Could not store the result: {type(e).__name__}: {e}")
+            except Exception:
+                pass
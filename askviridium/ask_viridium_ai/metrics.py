@@ -0,0 +1,74 @@
+import time
+from contextlib import contextmanager
+
+from langchain_community.callbacks import get_openai_callback
+
+from utils.metrics import MetricsRegistry
+
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter(
+    "askviridium_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status")
+)
+http_request_duration = registry.histogram(
+    "askviridium_http_request_duration_seconds", "Time to produce the HTTP response, by route.", ("route", "method")
+)
+http_requests_in_flight = registry.gauge(
+    "askviridium_http_requests_in_flight", "HTTP requests currently being handled."
+)
+
+stage_duration = registry.histogram(
+    "askviridium_stage_duration_seconds", "Latency of the LLM stages (cheminfo, analysis, fused).", ("stage", "mode")
+)
+stage_in_flight = registry.gauge(
+    "askviridium_stage_in_flight", "LLM calls currently in flight, by stage.", ("stage",)
+)
+prompt_tokens = registry.histogram(
+    "askviridium_prompt_tokens", "Prompt tokens per LLM stage call.", ("stage",), TOKEN_BUCKETS
+)
+completion_tokens = registry.histogram(
+    "askviridium_completion_tokens", "Completion tokens per LLM stage call.", ("stage",), TOKEN_BUCKETS
+)
+llm_cost = registry.counter(
+    "askviridium_llm_cost_usd_total", "Estimated Azure OpenAI cost in USD, by stage.", ("stage",)
+)
+llm_errors = registry.counter(
+    "askviridium_stage_errors_total", "LLM stage calls that raised, by stage and exception.", ("stage", "exception")
+)
+
+reference_index_lookups = registry.counter(
+    "askviridium_reference_index_lookups_total",
+    "Compositions looked up in the PFAS reference index, by outcome (resolved, unresolved, low_confidence).",
+    ("outcome",),
+)
+
+
+def observe_tokens(stage, prompt, completion, cost):
+    prompt_tokens.observe(prompt, stage=stage)
+    completion_tokens.observe(completion, stage=stage)
+    llm_cost.inc(cost, stage=stage)
+
+
+@contextmanager
+def track_stage(stage, mode="fast"):
+    """
+    Wraps an LLM stage: records latency, in-flight calls and errors, and yields the openai callback handler
+    whose token counts are recorded once the stage finishes. Streamed completions report no usage, their
+    tokens are recorded by the caller with observe_tokens().
+    """
+    stage_in_flight.inc(stage=stage)
+    started = time.perf_counter()
+    try:
+        with get_openai_callback() as cb:
+            yield cb
+    except Exception as e:
+        llm_errors.inc(stage=stage, exception=type(e).__name__)
+        raise
+    finally:
+        stage_in_flight.dec(stage=stage)
+
+    stage_duration.observe(time.perf_counter() - started, stage=stage, mode=mode)
+    if cb.total_tokens:
+        observe_tokens(stage, cb.prompt_tokens, cb.completion_tokens, cb.total_cost)
@@ -0,0 +1,270 @@
+"""
+Local reference index of substances with a known PFAS status, looked up by CAS number or name.
+
+When every chemical of a material's composition is in the index, the analysis is built from it directly
+instead of asking the LLM. The index is a SQLite file filled from CSV exports of regulatory lists, e.g.
+the EPA CompTox PFAS lists or the OECD PFAS list. Lists that only hold PFAS (or only non-PFAS) substances
+and have no status column are loaded with --status:
+    python -m ask_viridium_ai.reference_index load epa_pfasmaster.csv --list-name "EPA PFASMASTER" \
+        --cas-column CASRN --name-column PREFERRED_NAME --status pfas
+    python -m ask_viridium_ai.reference_index load inert_substances.csv --list-name "Inert gases" --status no
+    python -m ask_viridium_ai.reference_index lookup 335-67-1
+
+When lists disagree about a substance, it is kept as PFAS.
+"""
+import argparse
+import csv
+import re
+import sqlite3
+import threading
+import time
+
+from global_constants import GlobalConstants
+from models import MaterialInfo
+from .cache import make_key, normalize
+
+CAS_PATTERN = re.compile(r"^(\d{2,7})-(\d{2})-(\d)$")
+PFAS_VALUES = {"yes", "y", "true", "1", "pfas", "pfas (yes)"}
+NON_PFAS_VALUES = {"no", "n", "false", "0", "non-pfas", "not pfas", "pfas (no)"}
+
+
+def normalize_cas(value):
+    """CAS registry number in its canonical form, or None when it is malformed or fails the check digit."""
+    if value is None:
+        return None
+    digits = re.sub(r"[^0-9]", "", str(value))
+    if not 5 <= len(digits) <= 10:
+        return None
+    cas = f"{int(digits[:-3])}-{digits[-3:-1]}-{digits[-1]}"
+    match = CAS_PATTERN.match(cas)
+    if not match:
+        return None
+    body = match.group(1) + match.group(2)
+    check = sum(position * int(digit) for position, digit in enumerate(reversed(body), 1)) % 10
+    return cas if check == int(match.group(3)) else None
+
+
+def parse_status(value):
+    """True for PFAS, False for non-PFAS and None when the value says neither."""
+    value = normalize(value)
+    if value in PFAS_VALUES:
+        return True
+    if value in NON_PFAS_VALUES:
+        return False
+    return None
+
+
+class ReferenceIndex:
+    """
+    Substances with a known PFAS status, keyed by canonical CAS number ("cas:<cas>") and by normalised name
+    ("name:<name>"). Lookups hit the primary key, so they stay fast however long the lists are.
+
+    Args:
+        path (str): SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connect()
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS substances (
+                key TEXT PRIMARY KEY,
+                pfas INTEGER NOT NULL,
+                name TEXT,
+                cas_no TEXT,
+                list_name TEXT,
+                source TEXT
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS loads (
+                list_name TEXT PRIMARY KEY, path TEXT, count INTEGER NOT NULL, loaded_at REAL NOT NULL
+            );
+            """
+        )
+        self.connection.commit()
+
+    def connect(self):
+        """(Re)opens the connection, e.g. in a worker process forked after close()."""
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def version(self):
+        """Changes whenever a list is (re)loaded, so that results derived from an older index are not reused."""
+        with self.lock:
+            loads = self.connection.execute("SELECT list_name, count, loaded_at FROM loads ORDER BY list_name").fetchall()
+        return make_key(loads)
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM substances").fetchone()[0]
+            lists = self.connection.execute("SELECT COUNT(*) FROM loads").fetchone()[0]
+        return {"entries": entries, "lists": lists}
+
+    def add_many(self, substances, list_name, path=None):
+        """
+        Args:
+            substances (iterable): (cas_no, name, pfas, source) tuples; cas_no or name may be empty.
+            list_name (str): regulatory list the substances come from.
+
+        Returns:
+            int: substances added.
+        """
+        rows = []
+        count = 0
+        for cas_no, name, pfas, source in substances:
+            cas_no = normalize_cas(cas_no)
+            name = normalize(name)
+            if cas_no is None and not name:
+                continue
+            count += 1
+            for key in ([f"cas:{cas_no}"] if cas_no else []) + ([f"name:{name}"] if name else []):
+                rows.append((key, int(pfas), name or None, cas_no, list_name, source or None))
+
+        with self.lock:
+            # a substance that any list calls PFAS stays PFAS
+            self.connection.executemany(
+                """
+                INSERT INTO substances (key, pfas, name, cas_no, list_name, source) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    pfas = MAX(pfas, excluded.pfas),
+                    list_name = CASE WHEN excluded.pfas >= pfas THEN excluded.list_name ELSE list_name END,
+                    source = CASE WHEN excluded.pfas >= pfas THEN excluded.source ELSE source END
+                """,
+                rows,
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO loads (list_name, path, count, loaded_at) VALUES (?, ?, ?, ?)",
+                (list_name, path, count, time.time()),
+            )
+            self.connection.commit()
+        return count
+
+    def load_csv(self, path, list_name, cas_column="cas_no", name_column="name", status_column="pfas",
+                 source_column="source", status=None):
+        """
+        Args:
+            status (bool): status of every row, for lists without a status column. Rows whose status column
+                holds neither a PFAS nor a non-PFAS value are skipped.
+        """
+        def substances():
+            with open(path, newline="", encoding="utf-8-sig") as file:
+                for row in csv.DictReader(file):
+                    pfas = status if status is not None else parse_status(row.get(status_column))
+                    if pfas is not None:
+                        yield row.get(cas_column), row.get(name_column), pfas, row.get(source_column)
+
+        return self.add_many(substances(), list_name, path)
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT pfas, name, cas_no, list_name, source FROM substances WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"pfas": bool(row[0]), "name": row[1], "cas_no": row[2], "list_name": row[3], "source": row[4]}
+
+    def lookup(self, cas_no=None, name=None):
+        """
+        Entry of one chemical. The CAS number decides; the name is used when there is no valid CAS number,
+        and a name entry that contradicts the CAS entry makes the chemical unresolved (None), since the
+        CAS number returned by the LLM may belong to a different substance.
+        """
+        cas_no = normalize_cas(cas_no)
+        by_cas = self.get(f"cas:{cas_no}") if cas_no else None
+        by_name = self.get(f"name:{normalize(name)}") if normalize(name) else None
+        if by_cas is not None:
+            if by_name is not None and by_name["pfas"] != by_cas["pfas"]:
+                return None
+            return dict(by_cas, matched_by="cas")
+        if by_name is not None and cas_no is None:
+            return dict(by_name, matched_by="name")
+        return None
+
+    def resolve(self, chemicals):
+        """
+        Args:
+            chemicals (list): ChemicalInfo dicts of a composition.
+
+        Returns:
+            list: one index entry per chemical, or None when a chemical is not in the index.
+        """
+        if not chemicals:
+            return None
+        matches = []
+        for chemical in chemicals:
+            entry = self.lookup(chemical.get("cas_no"), chemical.get("name"))
+            if entry is None:
+                return None
+            matches.append(dict(entry, chemical=chemical.get("name")))
+        return matches
+
+
+def material_info(material_name, matches):
+    """MaterialInfo of a material whose chemicals all resolved in the reference index."""
+    pfas = [match for match in matches if match["pfas"]]
+    lists = sorted({match["list_name"] for match in matches if match["list_name"]})
+
+    def describe(match):
+        return f"{match['chemical']} (CAS {match['cas_no'] or 'n/a'}): " \
+               f"{'PFAS' if match['pfas'] else 'not PFAS'} according to {match['list_name'] or 'the reference index'}"
+
+    if pfas:
+        decision = "PFAS (Yes)"
+        primary_reason = "Contains substances listed as PFAS: " + ", ".join(match["chemical"] for match in pfas) + "."
+        recommendation = "Treat the material as PFAS-containing and review alternatives or exemptions."
+    else:
+        decision = "PFAS (No)"
+        primary_reason = "Every identified substance is listed as not PFAS."
+        recommendation = "No further investigation is needed as the identified substances are not PFAS."
+
+    info = MaterialInfo(
+        analyzed_material=material_name,
+        composition=", ".join(match["chemical"] for match in matches),
+        analysis_method="Lookup of the identified substances in the local PFAS reference index",
+        decision=decision,
+        confidence=0.95,
+        primary_reason=primary_reason,
+        secondary_reason="Reference lists: " + (", ".join(lists) or "reference index") + ".",
+        evidence=[describe(match) for match in matches],
+        health_problems=[],
+        confidence_level="High",
+        recommendation=recommendation,
+        suggestion="Confirm the composition with the manufacturer's safety data sheet.",
+        limitations_and_uncertainties="The decision relies on the identified chemical composition; substances "
+                                      "missing from it are not assessed.",
+    )
+    return info.dict()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local PFAS reference index.")
+    parser.add_argument("--index", default=GlobalConstants.reference_index_path)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load", help="add the substances of a CSV list")
+    load.add_argument("csv")
+    load.add_argument("--list-name", required=True)
+    load.add_argument("--cas-column", default="cas_no")
+    load.add_argument("--name-column", default="name")
+    load.add_argument("--status-column", default="pfas")
+    load.add_argument("--source-column", default="source")
+    load.add_argument("--status", choices=["pfas", "yes", "no"], help="status of every row of the list")
+
+    lookup = commands.add_parser("lookup", help="print the entry of a CAS number or name")
+    lookup.add_argument("value")
+    args = parser.parse_args()
+
+    index = ReferenceIndex(args.index)
+    if args.command == "load":
+        status = None if args.status is None else args.status != "no"
+        added = index.load_csv(args.csv, args.list_name, args.cas_column, args.name_column, args.status_column,
+                               args.source_column, status)
+        print(f"Added {added} substances from {args.csv}, index now has {index.stats()['entries']} keys")
+    else:
+        print(index.lookup(cas_no=args.value) or index.lookup(name=args.value))
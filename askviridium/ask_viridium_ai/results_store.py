@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from global_constants import GlobalConstants
+from .cache import normalize
+
+
+class ResultStore:
+    """
+    Append-only store of analysis results in SQLite (WAL mode), replacing the read-modify-write of data.json.
+
+    Every append is a single INSERT, so the cost no longer grows with the number of stored results, and
+    concurrent request threads cannot lose each other's writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connect()
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                material_name TEXT,
+                manufacturer_name TEXT,
+                work_content TEXT,
+                decision TEXT,
+                result TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_results_material ON results (material_name);
+            CREATE INDEX IF NOT EXISTS idx_results_manufacturer ON results (manufacturer_name);
+            CREATE INDEX IF NOT EXISTS idx_results_decision ON results (decision);
+            CREATE INDEX IF NOT EXISTS idx_results_created_at ON results (created_at);
+            CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY, imported_at REAL NOT NULL, count INTEGER);
+            """
+        )
+        self.connection.commit()
+
+    def connect(self):
+        """(Re)opens the connection, e.g. in a worker process forked after close()."""
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @staticmethod
+    def row(result, material_name=None, manufacturer_name=None, work_content=None, created_at=None):
+        return (
+            created_at or time.time(),
+            normalize(material_name or result.get("analyzed_material")),
+            normalize(manufacturer_name),
+            work_content,
+            result.get("decision"),
+            json.dumps(result),
+        )
+
+    def append_many(self, rows):
+        """
+        Args:
+            rows (list): tuples built with ResultStore.row().
+        """
+        if not rows:
+            return 0
+        with self.lock:
+            self.connection.executemany(
+                "INSERT INTO results (created_at, material_name, manufacturer_name, work_content, decision, result) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.commit()
+        return len(rows)
+
+    def append(self, query_result):
+        return self.append_many([
+            self.row(query_result.result, query_result.material_name, query_result.manufacturer_name,
+                     query_result.work_content, query_result.time)
+        ])
+
+    def query(self, material_name=None, manufacturer_name=None, decision=None, since=None, until=None, limit=100):
+        conditions, params = [], []
+        if material_name:
+            conditions.append("material_name = ?")
+            params.append(normalize(material_name))
+        if manufacturer_name:
+            conditions.append("manufacturer_name = ?")
+            params.append(normalize(manufacturer_name))
+        if decision:
+            conditions.append("decision = ?")
+            params.append(decision)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(float(since))
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(float(until))
+
+        sql = "SELECT id, created_at, work_content, result FROM results"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(int(limit))
+
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        return [
+            {"id": row[0], "created_at": row[1], "work_content": row[2], "result": json.loads(row[3])}
+            for row in rows
+        ]
+
+    def import_json(self, path):
+        """One-time import of a legacy data.json list. Importing the same file again is a no-op."""
+        source = os.path.abspath(path)
+        if not os.path.exists(source):
+            return 0
+        with open(source, 'r') as file:
+            data = json.load(file)
+        created_at = os.path.getmtime(source)
+        rows = [self.row(result, created_at=created_at) for result in data if isinstance(result, dict)]
+
+        # check, rows and bookkeeping in one write transaction, so neither a crash halfway nor a second
+        # process importing at the same time can import the file twice
+        with self.lock:
+            try:
+                self.connection.execute("BEGIN IMMEDIATE")
+                done = self.connection.execute("SELECT 1 FROM imports WHERE source = ?", (source,)).fetchone()
+                if done:
+                    self.connection.rollback()
+                    return 0
+                self.connection.executemany(
+                    "INSERT INTO results (created_at, material_name, manufacturer_name, work_content, decision, result) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self.connection.execute(
+                    "INSERT INTO imports (source, imported_at, count) VALUES (?, ?, ?)", (source, time.time(), len(rows))
+                )
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a legacy data.json file into the results store.")
+    parser.add_argument("source", nargs="?", default="data.json")
+    parser.add_argument("--store", default=GlobalConstants.results_store_path)
+    args = parser.parse_args()
+
+    imported = ResultStore(args.store).import_json(args.source)
+    print(f"Imported {imported} results from {args.source}")
@@ -1,8 +1,16 @@
-from flask import Blueprint, jsonify, render_template, request
+import json
+import threading
+import time
+
+from flask import Blueprint, Response, jsonify, render_template, request, stream_with_context
 
 from global_constants import GlobalConstants
+from utils.exceptions import QueueFullException, TokenBudgetExceededException
+from utils.threading_tools import ThreadingTool
 from .ask_viridium_ai import AskViridium
 from .constants import AskViridiumConstants
+from .jobs import JobQueue
+from .metrics import registry
 
 
 class MainRoutes:
@@ -11,6 +19,21 @@ class MainRoutes:
         # self.logger = logger
         self.global_constants = GlobalConstants
         self.constants = AskViridiumConstants
+        # built once per process and shared by all request threads
+        self.ask_vai = AskViridium()
+        # drained by the worker threads of start_job_workers()
+        self.job_queue = JobQueue(
+            self.global_constants.job_queue_path,
+            handler=self.run_job,
+            max_depth=self.global_constants.job_queue_max_depth,
+            lease_seconds=self.global_constants.job_lease_seconds,
+            max_attempts=self.global_constants.job_max_attempts,
+        )
+        self.job_threads = []
+        # set once this process is warmed up and serving, cleared while it drains
+        self.ready = threading.Event()
+
+        self.register_metrics()
 
         self.blueprint.add_url_rule(
             "/",
@@ -24,7 +47,129 @@ class MainRoutes:
             methods=[self.global_constants.rest_api_methods.post],
         )
 
+        self.blueprint.add_url_rule(
+            "/ask-viridium-ai/stream",
+            view_func=self.ask_viridium_ai_stream,
+            methods=[self.global_constants.rest_api_methods.post],
+        )
+
+        self.blueprint.add_url_rule(
+            "/ask-viridium-ai/<session_id>/follow-up",
+            view_func=self.ask_viridium_ai_follow_up,
+            methods=[self.global_constants.rest_api_methods.post],
+        )
+
+        self.blueprint.add_url_rule(
+            "/ask-viridium-ai/batch",
+            view_func=self.ask_viridium_ai_batch,
+            methods=[self.global_constants.rest_api_methods.post],
+        )
+
+        self.blueprint.add_url_rule(
+            "/jobs",
+            view_func=self.create_job,
+            methods=[self.global_constants.rest_api_methods.post],
+        )
+
+        self.blueprint.add_url_rule(
+            "/jobs/<job_id>",
+            view_func=self.get_job,
+            methods=[self.global_constants.rest_api_methods.get_api],
+        )
+
+        self.blueprint.add_url_rule(
+            "/results",
+            view_func=self.results,
+            methods=[self.global_constants.rest_api_methods.get_api],
+        )
+
         self.blueprint.add_url_rule("/health", view_func=self.health_check)
+        self.blueprint.add_url_rule("/ready", view_func=self.readiness_check)
+
+    def warm_up(self):
+        self.ask_vai.warm_up()
+
+    def before_fork(self):
+        self.ask_vai.before_fork()
+        self.job_queue.close()
+
+    def after_fork(self):
+        self.job_queue.connect()
+        self.ask_vai.after_fork()
+
+    def start_job_workers(self):
+        """Starts this process's job worker threads and marks it ready. Threads do not survive a fork."""
+        self.job_threads = ThreadingTool.create_and_start_threads(
+            self.job_queue.process_waiting_api_calls,
+            num_threads=self.global_constants.no_of_threads,
+            daemon=True,
+        )
+        self.ready.set()
+
+    def drain(self, timeout):
+        """Stops taking jobs, waits up to timeout seconds for running ones and flushes the telemetry."""
+        self.ready.clear()
+        self.job_queue.stop()
+        deadline = time.monotonic() + timeout
+        for thread in self.job_threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.ask_vai.logger.close()
+
+    # cumulative fields of RateBudget.stats(), exported as counters rather than with the window values
+    scheduler_totals = {
+        "waits": "Azure OpenAI calls that waited for the rate budget, since start.",
+        "wait_seconds": "Seconds spent waiting for the rate budget, since start.",
+        "throttled": "Times Azure OpenAI throttled a call and the rate budget was paused, since start.",
+    }
+
+    def register_metrics(self):
+        caches = {
+            "results": self.ask_vai.result_cache,
+            "compositions": self.ask_vai.composition_cache,
+        }
+        registry.callback_counter(
+            "askviridium_cache_lookups_total", "Cache lookups since start, by cache and outcome.", ("cache", "outcome"),
+            lambda: {
+                key: value
+                for name, cache in caches.items()
+                for key, value in (((name, "hit"), cache.hits), ((name, "miss"), cache.misses))
+            },
+        )
+        registry.callback_gauge(
+            "askviridium_cache_hit_ratio", "Share of cache lookups that were hits.", ("cache",),
+            lambda: {(name,): cache.stats()["hit_ratio"] for name, cache in caches.items()},
+        )
+        registry.callback_counter(
+            "askviridium_coalesced_queries_total",
+            "Single-flight leaders, followers and leaders that found the value on recheck, since start.", ("role",),
+            lambda: {
+                (role,): value for role, value in self.ask_vai.single_flight.stats().items() if role != "in_flight"
+            },
+        )
+        registry.callback_gauge(
+            "askviridium_coalesced_queries_in_flight", "Single-flight calls currently in flight.", (),
+            lambda: {(): self.ask_vai.single_flight.stats()["in_flight"]},
+        )
+        registry.callback_gauge(
+            "askviridium_llm_scheduler", "Azure OpenAI pacing: current window usage and limits.", ("stat",),
+            lambda: {
+                (stat,): value for stat, value in self.ask_vai.budget.stats().items()
+                if stat not in self.scheduler_totals
+            },
+        )
+        for stat, documentation in self.scheduler_totals.items():
+            registry.callback_counter(
+                f"askviridium_llm_scheduler_{stat}_total", documentation, (),
+                lambda stat=stat: {(): self.ask_vai.budget.stats()[stat]},
+            )
+        registry.callback_gauge(
+            "askviridium_jobs_queued", "Jobs waiting in the queue.", (),
+            lambda: {(): self.job_queue.depth()},
+        )
+        registry.callback_gauge(
+            "askviridium_telemetry_records", "Telemetry sink records by state.", ("state",),
+            lambda: {(state,): value for state, value in self.ask_vai.logger.stats().items()},
+        )
 
     def return_api_response(self, status, message, result=None, additional_data=None):
         response_data = {
@@ -45,6 +190,28 @@ class MainRoutes:
             return False, missing_params
         return True, None
 
+    def validate_mode(self, request_data):
+        mode = request_data.get(self.constants.input_parameters["mode"]) or self.constants.candidate_modes["fast"]
+        return mode in self.constants.candidate_modes.values(), mode
+
+    def validate_pipeline(self, request_data):
+        pipeline = request_data.get(self.constants.input_parameters["pipeline"]) or self.constants.pipelines["two_step"]
+        return pipeline in self.constants.pipelines.values(), pipeline
+
+    def invalid_pipeline_response(self, pipeline):
+        return self.return_api_response(
+            self.global_constants.api_status_codes.bad_request,
+            self.global_constants.api_response_messages.invalid_pipeline,
+            f"{pipeline!r} is not one of {list(self.constants.pipelines.values())}",
+        )
+
+    def invalid_mode_response(self, mode):
+        return self.return_api_response(
+            self.global_constants.api_status_codes.bad_request,
+            self.global_constants.api_response_messages.invalid_mode,
+            f"{mode!r} is not one of {list(self.constants.candidate_modes.values())}",
+        )
+
     def home(self):
         return render_template("pages/index.html")
 
@@ -63,14 +230,441 @@ class MainRoutes:
                 self.global_constants.api_response_messages.missing_required_parameters,
                 f"{self.global_constants.api_response_parameters.missing_parameters}: {missing_params}",
             )
+        valid_mode, mode = self.validate_mode(request_data)
+        if not valid_mode:
+            return self.invalid_mode_response(mode)
+        valid_pipeline, pipeline = self.validate_pipeline(request_data)
+        if not valid_pipeline:
+            return self.invalid_pipeline_response(pipeline)
+
+        try:
+            query_result = self.ask_vai.query(
+                request_data[self.constants.input_parameters["material_name"]],
+                request_data.get(self.constants.input_parameters["manufacturer_name"], self.constants.default_input_value),
+                request_data.get(self.constants.input_parameters["work_content"], self.constants.default_input_value),
+                bypass_cache=bool(request_data.get(self.constants.input_parameters["bypass_cache"], False)),
+                mode=mode,
+                pipeline=pipeline,
+            )
+        except TokenBudgetExceededException as e:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.payload_too_large,
+                self.global_constants.api_response_messages.token_budget_exceeded,
+                e.details,
+            )
+
+        return self.return_api_response(
+            self.global_constants.api_status_codes.ok,
+            self.global_constants.api_response_messages.success,
+            query_result.result,
+            {
+                self.constants.input_parameters["session_id"]: self.ask_vai.start_session(query_result),
+                "cached": query_result.cached,
+                "coalesced": query_result.coalesced,
+                "usage": query_result.usage,
+                "predicted_tokens": query_result.predicted_tokens,
+            },
+        )
+
+    def ask_viridium_ai_stream(self):
+        """
+        ---
+        post:
+          summary: Ask Viridium AI with Server-Sent Events
+          description: >
+            Emits a "composition" event once the chemical composition is known, "analysis" events with the
+            partially generated MaterialInfo, and a final "done" event with token and cost totals.
+          requestBody:
+            required: true
+            content:
+              application/json:
+                schema:
+                  type: object
+                  properties:
+                    material_name:
+                      type: string
+                    manufacturer_name:
+                      type: string
+                    work_content:
+                      type: string
+                    bypass_cache:
+                      type: boolean
+          responses:
+            200:
+              description: text/event-stream of analysis events
+            400:
+              description: Missing required parameters
+        """
+        request_data = request.get_json()
+        required_params = [
+            self.constants.input_parameters["material_name"],
+        ]
+
+        valid_request, missing_params = self.validate_request_data(
+            request_data, required_params
+        )
+        if not valid_request:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.missing_required_parameters,
+                f"{self.global_constants.api_response_parameters.missing_parameters}: {missing_params}",
+            )
+
+        events = self.ask_vai.stream_query(
+            request_data[self.constants.input_parameters["material_name"]],
+            request_data.get(self.constants.input_parameters["manufacturer_name"], self.constants.default_input_value),
+            request_data.get(self.constants.input_parameters["work_content"], self.constants.default_input_value),
+            bypass_cache=bool(request_data.get(self.constants.input_parameters["bypass_cache"], False)),
+        )
+
+        def generate():
+            try:
+                for event, data in events:
+                    yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': f'{type(e).__name__}: {e}'})}\n\n"
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    def ask_viridium_ai_follow_up(self, session_id):
+        """
+        ---
+        post:
+          summary: Continue a previous analysis with additional information
+          description: >
+            Reuses the chemical composition of the analysis identified by session_id and runs only the
+            analysis stage again with the extra information.
+          parameters:
+            - in: path
+              name: session_id
+              required: true
+              schema:
+                type: string
+          requestBody:
+            required: true
+            content:
+              application/json:
+                schema:
+                  type: object
+                  properties:
+                    additional_info:
+                      type: string
+          responses:
+            200:
+              description: Updated analysis
+            400:
+              description: Missing required parameters
+            404:
+              description: Unknown or expired session
+        """
+        request_data = request.get_json()
+        required_params = [
+            self.constants.input_parameters["additional_info"],
+        ]
+
+        valid_request, missing_params = self.validate_request_data(
+            request_data, required_params
+        )
+        if not valid_request:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.missing_required_parameters,
+                f"{self.global_constants.api_response_parameters.missing_parameters}: {missing_params}",
+            )
+
+        try:
+            query_result = self.ask_vai.follow_up(
+                session_id, request_data[self.constants.input_parameters["additional_info"]]
+            )
+        except TokenBudgetExceededException as e:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.payload_too_large,
+                self.global_constants.api_response_messages.token_budget_exceeded,
+                e.details,
+            )
+        if query_result is None:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.not_found,
+                self.global_constants.api_response_messages.session_not_found,
+            )
+
+        return self.return_api_response(
+            self.global_constants.api_status_codes.ok,
+            self.global_constants.api_response_messages.success,
+            query_result.result,
+            {
+                self.constants.input_parameters["session_id"]: session_id,
+                "usage": query_result.usage,
+                "predicted_tokens": query_result.predicted_tokens,
+            },
+        )
+
+    def ask_viridium_ai_batch(self):
+        """
+        ---
+        post:
+          summary: Analyse a bill of materials
+          description: Runs the composition and analysis stages for every item concurrently.
+          requestBody:
+            required: true
+            content:
+              application/json:
+                schema:
+                  type: object
+                  properties:
+                    items:
+                      type: array
+                      items:
+                        type: object
+                        properties:
+                          material_name:
+                            type: string
+                          manufacturer_name:
+                            type: string
+                          work_content:
+                            type: string
+                          mode:
+                            type: string
+                            enum: [fast, consensus]
+                          pipeline:
+                            type: string
+                            enum: [two_step, fused]
+                    max_concurrency:
+                      type: integer
+          responses:
+            200:
+              description: Per-item results and errors, in request order
+            400:
+              description: Invalid request data
+        """
+        request_data = request.get_json()
+        items = request_data.get("items") if isinstance(request_data, dict) else None
+        if not isinstance(items, list) or not items:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.invalid_batch,
+            )
+        if len(items) > self.global_constants.batch_max_items:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.batch_too_large,
+                f"Maximum is {self.global_constants.batch_max_items}",
+            )
+
+        required_params = [self.constants.input_parameters["material_name"]]
+        for index, item in enumerate(items):
+            valid_item, missing_params = self.validate_request_data(
+                item if isinstance(item, dict) else {}, required_params
+            )
+            if not valid_item:
+                return self.return_api_response(
+                    self.global_constants.api_status_codes.bad_request,
+                    self.global_constants.api_response_messages.missing_required_parameters,
+                    f"Item {index}: {self.global_constants.api_response_parameters.missing_parameters}: {missing_params}",
+                )
+            valid_mode, mode = self.validate_mode(item)
+            if not valid_mode:
+                return self.invalid_mode_response(mode)
+            valid_pipeline, pipeline = self.validate_pipeline(item)
+            if not valid_pipeline:
+                return self.invalid_pipeline_response(pipeline)
+
+        try:
+            max_concurrency = int(request_data.get("max_concurrency", self.global_constants.batch_max_concurrency))
+        except (TypeError, ValueError):
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.invalid_request_data,
+                f"max_concurrency must be an integer, got {request_data.get('max_concurrency')!r}",
+            )
+        max_concurrency = min(max(max_concurrency, 1), self.global_constants.batch_max_concurrency)
+        # on the engine's long-lived loop: a loop per request would strand the shared client's connections
+        results = self.ask_vai.run_async(self.ask_vai.abatch_query(items, max_concurrency=max_concurrency))
+
+        return self.return_api_response(
+            self.global_constants.api_status_codes.ok,
+            self.global_constants.api_response_messages.success,
+            results,
+        )
+
+    def run_job(self, payload):
+        query_result = self.ask_vai.query(
+            payload[self.constants.input_parameters["material_name"]],
+            payload.get(self.constants.input_parameters["manufacturer_name"], self.constants.default_input_value),
+            payload.get(self.constants.input_parameters["work_content"], self.constants.default_input_value),
+            bypass_cache=bool(payload.get(self.constants.input_parameters["bypass_cache"], False)),
+            mode=payload.get(self.constants.input_parameters["mode"]) or self.constants.candidate_modes["fast"],
+            pipeline=payload.get(self.constants.input_parameters["pipeline"]) or self.constants.pipelines["two_step"],
+        )
+        return query_result.result
+
+    def create_job(self):
+        """
+        ---
+        post:
+          summary: Queue an analysis
+          description: Returns immediately with a job id; poll GET /jobs/{job_id} for the result.
+          requestBody:
+            required: true
+            content:
+              application/json:
+                schema:
+                  type: object
+                  properties:
+                    material_name:
+                      type: string
+                    manufacturer_name:
+                      type: string
+                    work_content:
+                      type: string
+                    bypass_cache:
+                      type: boolean
+                    mode:
+                      type: string
+                      enum: [fast, consensus]
+                    pipeline:
+                      type: string
+                      enum: [two_step, fused]
+          responses:
+            202:
+              description: Job accepted
+            400:
+              description: Missing required parameters
+            429:
+              description: Queue is full
+        """
+        request_data = request.get_json()
+        required_params = [
+            self.constants.input_parameters["material_name"],
+        ]
+
+        valid_request, missing_params = self.validate_request_data(
+            request_data, required_params
+        )
+        if not valid_request:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.missing_required_parameters,
+                f"{self.global_constants.api_response_parameters.missing_parameters}: {missing_params}",
+            )
+        valid_mode, mode = self.validate_mode(request_data)
+        if not valid_mode:
+            return self.invalid_mode_response(mode)
+        valid_pipeline, pipeline = self.validate_pipeline(request_data)
+        if not valid_pipeline:
+            return self.invalid_pipeline_response(pipeline)
+
+        payload = {
+            param: request_data[param]
+            for param in self.constants.input_parameters.values()
+            if param in request_data
+        }
+        try:
+            job_id = self.job_queue.enqueue(payload)
+        except QueueFullException as e:
+            response, status = self.return_api_response(
+                self.global_constants.api_status_codes.rate_limit_exceeded,
+                self.global_constants.api_response_messages.job_queue_full,
+                e.details,
+            )
+            response.headers["Retry-After"] = "30"
+            return response, status
 
-        ask_vai = AskViridium()
-        ask_vai.query(request_data[self.constants.input_parameters["material_name"]], request_data[self.constants.input_parameters["manufacturer_name"]], request_data[self.constants.input_parameters["work_content"]])
+        return self.return_api_response(
+            self.global_constants.api_status_codes.accepted,
+            self.global_constants.api_response_messages.accepted,
+            {self.global_constants.api_response_parameters.id: job_id},
+        )
+
+    def get_job(self, job_id):
+        """
+        ---
+        get:
+          summary: Status or result of a queued analysis
+          parameters:
+            - in: path
+              name: job_id
+              required: true
+              schema:
+                type: string
+          responses:
+            200:
+              description: Job status, with the result once it is done
+            404:
+              description: Unknown job id
+        """
+        job = self.job_queue.get(job_id)
+        if job is None:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.not_found,
+                self.global_constants.api_response_messages.not_found,
+            )
+        return self.return_api_response(
+            self.global_constants.api_status_codes.ok,
+            self.global_constants.api_response_messages.success,
+            job,
+        )
 
+    def results(self):
+        """
+        ---
+        get:
+          summary: Query stored analysis results
+          parameters:
+            - in: query
+              name: material_name
+              schema:
+                type: string
+            - in: query
+              name: manufacturer_name
+              schema:
+                type: string
+            - in: query
+              name: decision
+              schema:
+                type: string
+            - in: query
+              name: since
+              description: Unix timestamp (inclusive)
+              schema:
+                type: number
+            - in: query
+              name: until
+              description: Unix timestamp (exclusive)
+              schema:
+                type: number
+            - in: query
+              name: limit
+              schema:
+                type: integer
+          responses:
+            200:
+              description: Matching results, newest first
+        """
+        try:
+            results = self.ask_vai.result_store.query(
+                material_name=request.args.get("material_name"),
+                manufacturer_name=request.args.get("manufacturer_name"),
+                decision=request.args.get("decision"),
+                since=request.args.get("since", type=float),
+                until=request.args.get("until", type=float),
+                # SQLite reads a negative LIMIT as no limit at all
+                limit=min(max(request.args.get("limit", 100, type=int), 1), 1000),
+            )
+        except ValueError as e:
+            return self.return_api_response(
+                self.global_constants.api_status_codes.bad_request,
+                self.global_constants.api_response_messages.invalid_request_data,
+                str(e),
+            )
         return self.return_api_response(
             self.global_constants.api_status_codes.ok,
             self.global_constants.api_response_messages.success,
-            ask_vai.result,
+            results,
         )
 
     def health_check(self):
@@ -85,4 +679,40 @@ class MainRoutes:
         return self.return_api_response(
             self.global_constants.api_status_codes.ok,
             self.global_constants.api_response_messages.server_is_running,
+            additional_data={
+                "cache": {
+                    "results": self.ask_vai.result_cache.stats(),
+                    "compositions": self.ask_vai.composition_cache.stats(),
+                },
+                "telemetry": self.ask_vai.logger.stats(),
+                "queued_jobs": self.job_queue.depth(),
+                "sessions": len(self.ask_vai.sessions),
+                "single_flight": self.ask_vai.single_flight.stats(),
+                "scheduler": self.ask_vai.budget.stats(),
+                "reference_index": self.ask_vai.reference_index.stats(),
+                "ready": self.ready.is_set(),
+            },
+        )
+
+    def readiness_check(self):
+        """
+        ---
+        get:
+          summary: Readiness check for the load balancer
+          responses:
+            200:
+              description: Warmed up and accepting requests
+            503:
+              description: Starting up or draining
+        """
+        if not self.ready.is_set():
+            return self.return_api_response(
+                self.global_constants.api_status_codes.service_unavailable,
+                self.global_constants.api_response_messages.service_unavailable,
+                additional_data={"ready": False},
+            )
+        return self.return_api_response(
+            self.global_constants.api_status_codes.ok,
+            self.global_constants.api_response_messages.server_is_running,
+            additional_data={"ready": True},
         )
@@ -0,0 +1,61 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of finished analyses, so follow-up questions can reuse the chemical composition
+    and first-pass result instead of resubmitting the whole query.
+
+    Sessions expire ttl_seconds after their last use; beyond max_sessions the least recently used one is
+    evicted.
+    """
+
+    def __init__(self, max_sessions=1000, ttl_seconds=3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def evict_expired(self, now):
+        # caller holds the lock; the oldest entries are at the front
+        while self.sessions:
+            session_id, (last_used, _) = next(iter(self.sessions.items()))
+            if now - last_used <= self.ttl_seconds:
+                break
+            del self.sessions[session_id]
+
+    def create(self, data):
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.evict_expired(now)
+            self.sessions[session_id] = (now, data)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id
+
+    def get(self, session_id):
+        now = time.time()
+        with self.lock:
+            self.evict_expired(now)
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return None
+            self.sessions[session_id] = (now, entry[1])
+            self.sessions.move_to_end(session_id)
+            return entry[1]
+
+    def update(self, session_id, data):
+        with self.lock:
+            if session_id not in self.sessions:
+                return False
+            self.sessions[session_id] = (time.time(), data)
+            self.sessions.move_to_end(session_id)
+            return True
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, cross-process coalescing is disabled there
+    fcntl = None
+
+
+class _Call:
+    def __init__(self, loop=None):
+        self.event = threading.Event()
+        self.future = loop.create_future() if loop is not None else None
+        self.loop = loop
+        self.value = None
+        self.error = None
+
+    def resolve(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+        if self.future is not None and not self.future.done():
+            if error is not None:
+                self.future.set_exception(error)
+                # mark as retrieved, the leader re-raises it itself
+                self.future.exception()
+            else:
+                self.future.set_result(value)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller (leader) runs the computation and every
+    caller arriving while it is in flight (follower) waits for and shares its result.
+
+    Works for threads and asyncio tasks alike. When lock_dir is set, leaders of different worker processes
+    also serialise on a lock file per key. Every new leader first calls recheck, so that a caller that missed
+    the cache just before the previous leader stored its value (in this process, or in another one that
+    held the lock) picks that value up instead of computing it again. recheck should not count as a cache
+    lookup of its own, see ResultCache.peek().
+
+    Args:
+        lock_dir (str): directory for per-key lock files, removed again when the call finishes. None keeps
+            coalescing in-process only.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.leaders = 0
+        self.followers = 0
+        self.recheck_hits = 0
+
+    def join(self, key, loop=None):
+        """Returns (call, is_leader)."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.followers += 1
+                return call, False
+            call = self.calls[key] = _Call(loop)
+            self.leaders += 1
+            return call, True
+
+    def leave(self, key):
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def acquire_file_lock(self, key):
+        if not self.lock_dir:
+            return None
+        path = os.path.join(self.lock_dir, f"{key}.lock")
+        while True:
+            lock_file = open(path, "w")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # the previous holder unlinks the file before unlocking it, so a lock taken on a file that is no
+            # longer at the path guards nothing and is taken again on the new one
+            try:
+                if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    @staticmethod
+    def release_file_lock(lock_file):
+        if lock_file is not None:
+            try:
+                os.unlink(lock_file.name)
+            except FileNotFoundError:
+                pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    @staticmethod
+    def follower_error(error):
+        # a cancelled or interrupted leader must not cancel the callers that were only waiting for it
+        if isinstance(error, Exception):
+            return error
+        interrupted = RuntimeError(f"Coalesced call was interrupted: {type(error).__name__}")
+        interrupted.__cause__ = error
+        return interrupted
+
+    def recheck_after_lock(self, recheck):
+        if recheck is None:
+            return None
+        value = recheck()
+        if value is not None:
+            with self.lock:
+                self.recheck_hits += 1
+        return value
+
+    def do(self, key, fn, recheck=None):
+        """
+        Run fn() unless an identical call is already in flight.
+
+        Returns:
+            tuple: (value, shared), shared is True when the value came from another caller.
+        """
+        call, is_leader = self.join(key)
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        lock_file = None
+        try:
+            lock_file = self.acquire_file_lock(key)
+            value = self.recheck_after_lock(recheck)
+            shared = value is not None
+            if not shared:
+                value = fn()
+        except BaseException as e:
+            call.resolve(error=self.follower_error(e))
+            raise
+        else:
+            call.resolve(value)
+            return value, shared
+        finally:
+            self.release_file_lock(lock_file)
+            self.leave(key)
+
+    async def ado(self, key, coroutine_fn, recheck=None):
+        """Async version of do(); coroutine_fn is called without arguments and awaited."""
+        loop = asyncio.get_running_loop()
+        call, is_leader = self.join(key, loop)
+        if not is_leader:
+            if call.loop is loop:
+                return await asyncio.shield(call.future), True
+            # the leader runs on another thread or event loop
+            await asyncio.to_thread(call.event.wait)
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        lock_file = None
+        try:
+            lock_file = await asyncio.to_thread(self.acquire_file_lock, key) if self.lock_dir else None
+            value = self.recheck_after_lock(recheck)
+            shared = value is not None
+            if not shared:
+                value = await coroutine_fn()
+        except BaseException as e:
+            call.resolve(error=self.follower_error(e))
+            raise
+        else:
+            call.resolve(value)
+            return value, shared
+        finally:
+            self.release_file_lock(lock_file)
+            self.leave(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "recheck_hits": self.recheck_hits,
+                "in_flight": len(self.calls),
+            }
@@ -0,0 +1,52 @@
+import json
+
+import tiktoken
+from langchain_community.callbacks.openai_info import get_openai_token_cost_for_model
+
+# per-message overhead of the chat format, see the OpenAI cookbook on counting tokens
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def get_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name or "")
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base" if model_name and "4o" in model_name else "cl100k_base")
+
+
+def count_text_tokens(text, model_name=None):
+    return len(get_encoding(model_name).encode(text))
+
+
+def count_message_tokens(messages, model_name=None, functions=None):
+    """
+    Local estimate of the prompt tokens of a list of chat messages, including any function definitions.
+    Used where the API does not report usage (streaming) and before sending a request.
+    """
+    encoding = get_encoding(model_name)
+    tokens = TOKENS_PER_REPLY
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE + len(encoding.encode(str(message.content)))
+    if functions:
+        tokens += len(encoding.encode(json.dumps(functions)))
+    return tokens
+
+
+def estimate_cost(model_name, prompt_tokens, completion_tokens):
+    if not model_name:
+        return 0.0
+    try:
+        return (get_openai_token_cost_for_model(model_name, prompt_tokens)
+                + get_openai_token_cost_for_model(model_name, completion_tokens, is_completion=True))
+    except ValueError:
+        # unknown model name, langchain has no price for it
+        return 0.0
+
+
+def trim_text_to_tokens(text, max_tokens, model_name=None):
+    encoding = get_encoding(model_name)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
@@ -1,31 +1,109 @@
-import pandas as pd
+import atexit
+import csv
+import os
+import queue
+import threading
+import time
 
-class Logger:
 
-    def __init__(self):
-        self.columns = [
-            'time', 'user_id', 'material_name',
-            'tokens_used_for_chemical_composition', 'cost_chemical_composition',
-            'tokens_used_for_analysis', 'cost_analysis', 'total_cost', 'chemical_composition', 'PFAS_status'
-        ]
-        self.df = pd.DataFrame(columns=self.columns)
+class TelemetrySink:
+    """
+    Buffered, non-blocking replacement for the pandas based Logger.
+
+    log() only puts the record on a bounded in-memory queue. A background thread appends the records to a
+    CSV file in batches, whenever flush_size records are waiting or flush_interval seconds have passed.
+    When the buffer is full, records are dropped and counted instead of blocking the request. A file written
+    with other columns is renamed aside before the first write rather than appended to under a stale header.
+    """
+
+    columns = [
+        'time', 'user_id', 'material_name', 'manufacturer_name',
+        'tokens_used_for_chemical_composition', 'cost_chemical_composition',
+        'tokens_used_for_analysis', 'cost_analysis', 'total_cost', 'chemical_composition', 'PFAS_status',
+        'mode', 'pipeline', 'analysis_source'
+    ]
+
+    def __init__(self, path='ask_viridium_ai/log.csv', flush_size=100, flush_interval=5.0, buffer_size=10000):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        self.written = 0
+        self.flush_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.header_checked = False
+
+        self.start()
+        atexit.register(self.close)
+
+    def start(self):
+        """Starts the writer thread. Called again in a worker process forked after close()."""
+        self.stopped.clear()
+        self.flush_requested.clear()
+        self.thread = threading.Thread(target=self.run, name="telemetry-sink", daemon=True)
+        self.thread.start()
 
     def log(self, info):
-        time = info["time"]
-        user_id = info["user_id"]
-        material_name = info["material_name"]
-        tokens_used_for_chemical_composition = info["tokens_used_for_chemical_composition"]
-        cost_chemical_composition = info["cost_chemical_composition"]
-        tokens_used_for_analysis = info["tokens_used_for_analysis"]
-        cost_analysis = info["cost_analysis"]
-        total_cost = info["total_cost"]
-        chemical_composition = info["chemical_composition"]
-        pfas = info["PFAS_status"]
-
-        data = [time, user_id, material_name, tokens_used_for_chemical_composition, cost_chemical_composition,
-                tokens_used_for_analysis, cost_analysis, total_cost, chemical_composition, pfas]
-        tdf = pd.DataFrame(info, index=[0])
-        self.df = pd.concat([self.df, tdf])
+        try:
+            self.buffer.put_nowait(dict(info))
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.buffer.qsize() >= self.flush_size:
+            self.flush_requested.set()
 
     def save(self):
-        self.df.to_csv('ask_viridium_ai/log.csv', index=False)
+        """Ask the background thread to flush now. Does not wait for the write."""
+        self.flush_requested.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        records = []
+        while True:
+            try:
+                records.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        if not records:
+            return
+
+        if not self.header_checked:
+            self.rotate_if_stale()
+            self.header_checked = True
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=self.columns, extrasaction='ignore')
+            if write_header:
+                writer.writeheader()
+            writer.writerows(records)
+        self.written += len(records)
+
+    def rotate_if_stale(self):
+        """Moves a log written with a different header to <name>.<timestamp>.csv."""
+        try:
+            with open(self.path, newline='') as file:
+                header = next(csv.reader(file), None)
+            if header is not None and header != self.columns:
+                root, extension = os.path.splitext(self.path)
+                os.replace(self.path, f"{root}.{time.strftime('%Y%m%d-%H%M%S')}{extension}")
+        except FileNotFoundError:
+            # nothing written yet, or another worker process rotated it first
+            pass
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.flush_requested.set()
+        self.thread.join(timeout=self.flush_interval + 5)
+
+    def stats(self):
+        return {"buffered": self.buffer.qsize(), "written": self.written, "dropped": self.dropped}
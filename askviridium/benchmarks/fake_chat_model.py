@@ -0,0 +1,155 @@
+import asyncio
+import json
+import math
+import os
+import random
+import time
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from utils.scheduler import LocalQuota
+
+CHEMICAL_COMPOSITION = {
+    "product_name": "Nitrogen, Cryogenic Liquid",
+    "chemicals": [{"name": "Nitrogen", "cas_no": "7727-37-9",
+                   "source": "https://pubchem.ncbi.nlm.nih.gov/compound/Nitrogen"}],
+    "confidence": 1,
+}
+
+MATERIAL_INFO = {
+    "analyzed_material": "Nitrogen, Cryogenic Liquid",
+    "composition": "Nitrogen",
+    "analysis_method": "Literature review, chemical composition analysis",
+    "decision": "PFAS (No)",
+    "confidence": 0.95,
+    "primary_reason": "Nitrogen (N2) contains no carbon-fluorine bonds.",
+    "secondary_reason": "No fluorinated additives are used in industrial nitrogen.",
+    "evidence": ["Nitrogen is a diatomic molecule", "SDS lists nitrogen as the only component"],
+    "health_problems": ["Asphyxiation in confined spaces", "Cold burns"],
+    "confidence_level": "High",
+    "recommendation": "No further investigation needed.",
+    "suggestion": "None",
+    "limitations_and_uncertainties": "Canned response from the benchmark stub.",
+}
+
+CANNED_ARGUMENTS = {
+    "ChemicalComposition": CHEMICAL_COMPOSITION,
+    "MaterialInfo": MATERIAL_INFO,
+    "MaterialScreening": {"chemical_composition": CHEMICAL_COMPOSITION, "analysis": MATERIAL_INFO},
+}
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Offline stand-in for AzureChatOpenAI. Answers every function call with a canned ChemicalComposition,
+    MaterialInfo or MaterialScreening after a log-normally distributed delay, fails a configurable share of
+    calls and reports token usage the same way the OpenAI client does, so callbacks and cost accounting keep
+    working. With a quota set, calls above it fail with a 429 like the deployment would.
+    """
+
+    latency_ms: float = 800.0
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    model_name: str = "gpt-4o"
+    canned_arguments: dict = CANNED_ARGUMENTS
+    max_tokens: int = 800
+    quota: Optional[Any] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-azure-chat"
+
+    def bind_functions(self, functions, function_call=None, **kwargs):
+        return self.bind(functions=functions, function_call=function_call, **kwargs)
+
+    def sample_latency(self):
+        if self.latency_ms <= 0:
+            return 0.0
+        mu = math.log(self.latency_ms) - self.latency_sigma ** 2 / 2
+        return random.lognormvariate(mu, self.latency_sigma) / 1000
+
+    def check_quota(self, messages, kwargs):
+        # throttled calls are answered immediately, like the service does
+        if self.quota is not None:
+            prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+            self.quota.consume(prompt_tokens + (kwargs.get("n") or 1) * self.max_tokens)
+
+    def maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise RuntimeError("Simulated Azure OpenAI error")
+
+    def arguments_for(self, kwargs):
+        function_call = kwargs.get("function_call") or {}
+        name = function_call.get("name") if isinstance(function_call, dict) else None
+        if name not in self.canned_arguments:
+            name = "MaterialInfo"
+        return name, json.dumps(self.canned_arguments[name])
+
+    def make_result(self, messages, kwargs):
+        name, arguments = self.arguments_for(kwargs)
+        n = kwargs.get("n") or 1
+        generations = [
+            ChatGeneration(message=AIMessage(content="", additional_kwargs={
+                "function_call": {"name": name, "arguments": arguments}
+            }))
+            for _ in range(n)
+        ]
+        prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+        completion_tokens = n * len(arguments) // 4
+        return ChatResult(generations=generations, llm_output={
+            "token_usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "model_name": self.model_name,
+        })
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        self.check_quota(messages, kwargs)
+        time.sleep(self.sample_latency())
+        self.maybe_fail()
+        return self.make_result(messages, kwargs)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        self.check_quota(messages, kwargs)
+        await asyncio.sleep(self.sample_latency())
+        self.maybe_fail()
+        return self.make_result(messages, kwargs)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        name, arguments = self.arguments_for(kwargs)
+        latency = self.sample_latency()
+        chunks = [arguments[i:i + 16] for i in range(0, len(arguments), 16)]
+
+        # roughly a third of the time goes to the first token, the rest is spread over the chunks
+        self.check_quota(messages, kwargs)
+        time.sleep(latency / 3)
+        self.maybe_fail()
+        for index, chunk in enumerate(chunks):
+            function_call = {"arguments": chunk}
+            if index == 0:
+                function_call["name"] = name
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs={
+                "function_call": function_call
+            }))
+            time.sleep(latency * 2 / 3 / len(chunks))
+
+
+def create():
+    """ChatModelFactory entry point, configured through environment variables."""
+    requests_per_minute = int(os.getenv("FAKE_LLM_RPM", 0))
+    tokens_per_minute = int(os.getenv("FAKE_LLM_TPM", 0))
+    return FakeChatModel(
+        latency_ms=float(os.getenv("FAKE_LLM_LATENCY_MS", 800)),
+        latency_sigma=float(os.getenv("FAKE_LLM_LATENCY_SIGMA", 0.5)),
+        error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", 0)),
+        model_name=os.getenv("FAKE_LLM_MODEL_NAME", "gpt-4o"),
+        quota=LocalQuota(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None,
+    )
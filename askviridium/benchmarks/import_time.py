@@ -0,0 +1,129 @@
+"""
+Cold start benchmark: how long importing each entry point takes, and which packages that time goes to.
+
+Every target is imported in a fresh interpreter with `python -X importtime`, repeated a few times. The
+report has the median wall time per target and the slowest top-level packages by self time, so that an
+eager import of a heavy dependency shows up by name.
+
+askviridium:app still imports langchain, langchain_openai and tiktoken and builds the engine on import, on
+purpose: gunicorn preloads and warms it once in the master before forking (gunicorn.conf.py), so its wall
+time is mostly the engine and says little about what was made lazy. For every target the report therefore
+also checks the packages that are deferred to first use (DEFERRED) and lists any that were imported anyway.
+
+Run from the askviridium directory:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --target askviridium:app --top 20 --output import_time.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# "<directory relative to the repository>:<module>", imported with that directory as working directory
+DEFAULT_TARGETS = [
+    "askviridium:app",
+    "askviridium:ask_viridium_ai.ask_viridium_ai",
+    ".:split_experiment.sheets.sheets",
+    ".:split_experiment.main",
+]
+
+# packages each target only imports on first use; any of them in the import log is a regression
+DEFERRED = {
+    "askviridium:app": ["apispec", "apispec_webframeworks", "marshmallow"],
+    ".:split_experiment.sheets.sheets": ["google", "googleapiclient"],
+    ".:split_experiment.main": ["google", "googleapiclient", "cohere", "langchain_openai", "langchain_postgres",
+                                "langchain_community", "langchain_experimental", "langchain_text_splitters"],
+}
+
+
+def parse_importtime(stderr):
+    """Returns {module: (self_us, cumulative_us)} from the -X importtime output."""
+    modules = dict()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def import_once(directory, module):
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.join(REPO_DIR, directory),
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - started
+    error = None
+    if process.returncode != 0:
+        # the last line of the traceback, e.g. a missing dependency or credential
+        error = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f"exit code {process.returncode}"
+    return wall, parse_importtime(process.stderr), error
+
+
+def measure(target, repeat, top):
+    directory, _, module = target.partition(":")
+    walls = []
+    modules = dict()
+    error = None
+    for _ in range(repeat):
+        wall, modules, error = import_once(directory, module)
+        walls.append(wall)
+        if error:
+            break
+
+    by_package = defaultdict(int)
+    for name, (self_us, _) in modules.items():
+        by_package[name.split(".")[0]] += self_us
+    slowest = sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+    deferred = DEFERRED.get(target, [])
+
+    return {
+        "target": target,
+        "error": error,
+        "wall_seconds_median": statistics.median(walls),
+        "wall_seconds": walls,
+        "modules_imported": len(modules),
+        "import_seconds": modules[module][1] / 1e6 if module in modules else None,
+        "slowest_packages": [{"package": name, "self_seconds": us / 1e6} for name, us in slowest],
+        "deferred_packages": deferred,
+        # only meaningful when the import succeeded
+        "deferred_imported_eagerly": [name for name in deferred if name in by_package] if not error else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time per entry point, in fresh interpreters.")
+    parser.add_argument("--target", action="append", help="directory:module, may be repeated")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest packages to list per target")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    reports = [measure(target, args.repeat, args.top) for target in args.target or DEFAULT_TARGETS]
+    for report in reports:
+        print(f"{report['target']}: {report['wall_seconds_median']:.3f}s median wall, "
+              f"{report['modules_imported']} modules")
+        if report["error"]:
+            print(f"    failed: {report['error']}")
+        elif report["deferred_packages"]:
+            eager = report["deferred_imported_eagerly"]
+            print(f"    deferred packages imported eagerly: {', '.join(eager) if eager else 'none'}")
+        for package in report["slowest_packages"]:
+            print(f"    {package['self_seconds']:8.3f}s  {package['package']}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Offline load test of the Ask Viridium service.
+
+Starts app.py in a subprocess with the FakeChatModel from benchmarks/fake_chat_model.py instead of Azure
+OpenAI (no tokens are spent), drives POST /v1/ask-viridium-ai at increasing concurrency and writes latency
+percentiles, throughput and the server's CPU and memory use to a JSON file, so regressions in the request
+path can be compared across commits.
+
+Every file the server writes (caches, results, jobs, telemetry, reference index, bulk checkpoint, lock files)
+goes to a temporary directory, so a run leaves the working tree untouched and starts with an empty reference
+index. tiktoken downloads its encoding on first use: with --tokenizer auto the encoding is fetched once into
+TIKTOKEN_CACHE_DIR (or --tiktoken-cache) when there is network access, and without it the server counts
+tokens with ApproximateEncoding instead, which is noted in the report.
+
+Run from the askviridium directory:
+    python -m benchmarks.loadtest --concurrency 1 4 16 --requests 200 --latency-ms 300
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ApproximateEncoding:
+    """
+    Offline stand-in for a tiktoken encoding: one token per word or punctuation mark with its leading space,
+    which is close enough to BPE counts for the token preflight of a load test.
+    """
+
+    name = "approximate"
+    pattern = re.compile(r" ?\w+| ?[^\w\s]|\s+")
+
+    def __init__(self):
+        self.ids = dict()
+        self.pieces = []
+        self.lock = threading.Lock()
+
+    def encode(self, text, **kwargs):
+        tokens = []
+        for piece in self.pattern.findall(text):
+            token = self.ids.get(piece)
+            if token is None:
+                # request threads share the encoding, a new piece must get exactly one id
+                with self.lock:
+                    token = self.ids.get(piece)
+                    if token is None:
+                        token = self.ids[piece] = len(self.pieces)
+                        self.pieces.append(piece)
+            tokens.append(token)
+        return tokens
+
+    def decode(self, tokens):
+        return "".join(self.pieces[token] for token in tokens)
+
+
+def install_approximate_encoding():
+    """Replaces tiktoken's encoding lookups in the server process, before the app is imported."""
+    import tiktoken
+
+    encoding = ApproximateEncoding()
+    tiktoken.encoding_for_model = lambda model_name: encoding
+    tiktoken.get_encoding = lambda encoding_name: encoding
+
+
+def tiktoken_available(env, timeout=60):
+    """Loads the model's encoding in a subprocess with the server's environment, downloading it if needed."""
+    code = "import os; from ask_viridium_ai.tokens import get_encoding; get_encoding(os.getenv('AZURE_MODEL_NAME'))"
+    try:
+        process = subprocess.run([sys.executable, "-c", code], cwd=SERVICE_DIR, env=env, capture_output=True,
+                                 timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False
+    return process.returncode == 0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class ProcessSampler:
+    """Samples CPU time and resident memory of a process from /proc (Linux only, None elsewhere)."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.cpu_start = None
+        self.cpu_used = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def cpu_seconds(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat, counted after the "(comm)" field
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss_bytes(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss = self.rss_bytes()
+            if rss:
+                self.peak_rss = max(self.peak_rss, rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_rss = 0
+        self.cpu_start = self.cpu_seconds()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.stopped.clear()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        cpu_end = self.cpu_seconds()
+        self.cpu_used = cpu_end - self.cpu_start if cpu_end is not None and self.cpu_start is not None else None
+
+
+def server_env(args, state_dir):
+    env = dict(
+        os.environ,
+        ChatModelFactory="benchmarks.fake_chat_model:create",
+        FAKE_LLM_LATENCY_MS=str(args.latency_ms),
+        FAKE_LLM_LATENCY_SIGMA=str(args.latency_sigma),
+        FAKE_LLM_ERROR_RATE=str(args.error_rate),
+        FAKE_LLM_RPM=str(args.quota_rpm),
+        FAKE_LLM_TPM=str(args.quota_tpm),
+        AZURE_MODEL_NAME=os.getenv("AZURE_MODEL_NAME", "gpt-4o"),
+        CachePath=os.path.join(state_dir, "cache.sqlite3"),
+        ResultsStorePath=os.path.join(state_dir, "results.sqlite3"),
+        JobQueuePath=os.path.join(state_dir, "jobs.sqlite3"),
+        TelemetryPath=os.path.join(state_dir, "log.csv"),
+        ReferenceIndexPath=os.path.join(state_dir, "reference_index.sqlite3"),
+        BulkCheckpointPath=os.path.join(state_dir, "bulk.sqlite3"),
+        NoOfThreads="1",
+    )
+    if env.get("SingleFlightLockDir"):
+        env["SingleFlightLockDir"] = os.path.join(state_dir, "locks")
+    if args.tiktoken_cache:
+        env["TIKTOKEN_CACHE_DIR"] = args.tiktoken_cache
+    return env
+
+
+def start_server(port, args, env, tokenizer):
+    code = (
+        ("from benchmarks.loadtest import install_approximate_encoding; install_approximate_encoding(); "
+         if tokenizer == "approximate" else "")
+        + "import app; app.main_routes.start_job_workers(); "
+        f"app.app.run(host='127.0.0.1', port={port}, threaded=True, debug=False, use_reloader=False)"
+    )
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=SERVICE_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {server.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/health", timeout=1)
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server did not become healthy in time")
+
+
+def send_request(url, body, timeout):
+    data = json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        status = None
+    return time.perf_counter() - started, status
+
+
+def run_level(url, concurrency, requests, sampler, timeout, run_id):
+    bodies = [
+        {
+            "material_name": f"Benchmark material {run_id}-{concurrency}-{index}",
+            "manufacturer_name": "Benchmark Inc.",
+            "work_content": "Load test",
+        }
+        for index in range(requests)
+    ]
+    with sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(lambda body: send_request(url, body, timeout), bodies))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, status in outcomes if status == 200)
+    errors = sum(1 for _, status in outcomes if status != 200)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "duration_seconds": elapsed,
+        "requests_per_second": requests / elapsed if elapsed else None,
+        "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "server_cpu_seconds": sampler.cpu_used,
+        "server_cpu_percent": 100 * sampler.cpu_used / elapsed if sampler.cpu_used is not None else None,
+        "server_peak_rss_mb": sampler.peak_rss / 2 ** 20 if sampler.peak_rss else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SERVICE_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the Ask Viridium service.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--latency-ms", type=float, default=800, help="mean latency of one fake LLM call")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal sigma of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake LLM calls that fail")
+    parser.add_argument("--quota-rpm", type=int, default=0, help="requests per minute the fake deployment accepts")
+    parser.add_argument("--quota-tpm", type=int, default=0, help="tokens per minute the fake deployment accepts")
+    parser.add_argument("--endpoint", default="/v1/ask-viridium-ai")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results"))
+    parser.add_argument("--tokenizer", choices=["auto", "tiktoken", "approximate"], default="auto",
+                        help="auto uses tiktoken when its encoding can be loaded or downloaded")
+    parser.add_argument("--tiktoken-cache", help="TIKTOKEN_CACHE_DIR for the server, e.g. a pre-seeded copy")
+    args = parser.parse_args()
+
+    port = free_port()
+    run_id = int(time.time())
+    with tempfile.TemporaryDirectory() as state_dir:
+        env = server_env(args, state_dir)
+        tokenizer = args.tokenizer
+        if tokenizer == "auto":
+            tokenizer = "tiktoken" if tiktoken_available(env) else "approximate"
+            if tokenizer == "approximate":
+                print("tiktoken encoding not available offline, counting tokens approximately")
+        server = start_server(port, args, env, tokenizer)
+        try:
+            sampler = ProcessSampler(server.pid)
+            url = f"http://127.0.0.1:{port}{args.endpoint}"
+            levels = []
+            for concurrency in args.concurrency:
+                level = run_level(url, concurrency, args.requests, sampler, args.timeout, run_id)
+                levels.append(level)
+                print(f"c={concurrency:<3} rps={level['requests_per_second']:.1f} p50={level['p50_ms']} "
+                      f"p95={level['p95_ms']} p99={level['p99_ms']} errors={level['errors']}")
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    commit = git_commit()
+    report = {
+        "git_commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "endpoint": args.endpoint,
+            "requests_per_level": args.requests,
+            "fake_latency_ms": args.latency_ms,
+            "fake_latency_sigma": args.latency_sigma,
+            "fake_error_rate": args.error_rate,
+            "fake_quota_rpm": args.quota_rpm,
+            "fake_quota_tpm": args.quota_tpm,
+            "tokenizer": tokenizer,
+        },
+        "levels": levels,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"loadtest-{(commit or 'unknown')[:10]}-{run_id}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Offline comparison of the two_step and fused pipelines: latency, tokens, cost and how often the fused
+pipeline reaches the same PFAS decision as the two_step one.
+
+The comparison replays completions recorded from the real Azure deployment, so it is repeatable and
+spends no tokens. Record the fixtures once (this calls Azure OpenAI for every material and pipeline), and
+again whenever a prompt or function schema changes, since the recorded prompts then no longer match:
+    python -m benchmarks.pipeline_modes --record
+
+Then compare the pipelines from the recording, from the askviridium directory:
+    python -m benchmarks.pipeline_modes
+    python -m benchmarks.pipeline_modes --materials materials.csv --mode consensus3
+
+--materials is a CSV with material_name, manufacturer_name and work_content columns.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, List, Optional
+
+DEFAULT_FIXTURES = os.path.join("benchmarks", "fixtures", "pipeline_modes.json")
+
+DEFAULT_MATERIALS = [
+    {"material_name": "Nitrogen, Cryogenic Liquid", "manufacturer_name": "Linde", "work_content": "Purging"},
+    {"material_name": "Teflon PTFE tape", "manufacturer_name": "Chemours", "work_content": "Thread sealing"},
+    {"material_name": "Krytox GPL 205", "manufacturer_name": "Chemours", "work_content": "Vacuum pump lubrication"},
+    {"material_name": "Isopropyl alcohol 99%", "manufacturer_name": "Not Available", "work_content": "Cleaning"},
+    {"material_name": "Novec 7100", "manufacturer_name": "3M", "work_content": "Precision cleaning"},
+    {"material_name": "Loctite 243", "manufacturer_name": "Henkel", "work_content": "Thread locking"},
+    {"material_name": "Viton O-ring", "manufacturer_name": "Not Available", "work_content": "Chamber sealing"},
+    {"material_name": "Sodium hydroxide 50% solution", "manufacturer_name": "Not Available",
+     "work_content": "Wafer etching"},
+]
+
+
+def read_materials(path):
+    if not path:
+        return DEFAULT_MATERIALS
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        return [
+            {field: row.get(field) or "Not Available" for field in ("material_name", "manufacturer_name", "work_content")}
+            for row in csv.DictReader(file)
+            if row.get("material_name")
+        ]
+
+
+def fixture_key(messages, function_name):
+    from ask_viridium_ai.cache import make_key
+
+    return make_key(function_name, [str(message.content) for message in messages])
+
+
+def function_name_of(params):
+    function_call = (params or dict()).get("function_call") or dict()
+    return function_call.get("name") if isinstance(function_call, dict) else None
+
+
+def recording_callback(fixtures):
+    """Callback that stores every completion of the real model in fixtures, keyed like ReplayChatModel."""
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class RecordingCallback(BaseCallbackHandler):
+        def __init__(self):
+            self.started = dict()
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params=None, **kwargs):
+            name = function_name_of(invocation_params)
+            self.started[run_id] = (fixture_key(messages[0], name), time.perf_counter())
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            if run_id not in self.started:
+                return
+            key, started = self.started.pop(run_id)
+            fixtures[key] = {
+                "latency_seconds": time.perf_counter() - started,
+                "token_usage": (response.llm_output or dict()).get("token_usage", dict()),
+                "function_calls": [
+                    generation.message.additional_kwargs.get("function_call") for generation in response.generations[0]
+                ],
+            }
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self.started.pop(run_id, None)
+
+    return RecordingCallback()
+
+
+def replay_model(fixtures, speed):
+    """A FakeChatModel answering from recorded completions instead of canned ones."""
+    from langchain_core.messages import AIMessage, BaseMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    from benchmarks.fake_chat_model import FakeChatModel
+
+    class ReplayChatModel(FakeChatModel):
+        recordings: dict
+        speed: float = 1.0
+
+        def recording(self, messages, kwargs):
+            key = fixture_key(messages, function_name_of(kwargs))
+            if key not in self.recordings:
+                raise KeyError("No recorded completion for this prompt, record the fixtures again with --record")
+            return self.recordings[key]
+
+        def make_result(self, recording):
+            generations = [
+                ChatGeneration(message=AIMessage(content="", additional_kwargs={"function_call": function_call}))
+                for function_call in recording["function_calls"]
+            ]
+            return ChatResult(generations=generations, llm_output={
+                "token_usage": recording["token_usage"], "model_name": self.model_name,
+            })
+
+        def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                      **kwargs: Any) -> ChatResult:
+            recording = self.recording(messages, kwargs)
+            time.sleep(recording["latency_seconds"] / self.speed)
+            return self.make_result(recording)
+
+        async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                             **kwargs: Any) -> ChatResult:
+            recording = self.recording(messages, kwargs)
+            await asyncio.sleep(recording["latency_seconds"] / self.speed)
+            return self.make_result(recording)
+
+    return ReplayChatModel(recordings=fixtures, speed=speed, model_name=os.getenv("AZURE_MODEL_NAME", "gpt-4o"))
+
+
+def run_material(ask_vai, material, mode, pipeline):
+    started = time.perf_counter()
+    try:
+        query_result = ask_vai.query(material["material_name"], material["manufacturer_name"],
+                                     material["work_content"], bypass_cache=True, mode=mode, pipeline=pipeline)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}", "latency_seconds": time.perf_counter() - started}
+    return {
+        "error": None,
+        "latency_seconds": time.perf_counter() - started,
+        "decision": query_result.result.get("decision"),
+        "chemicals": query_result.chemicals_list,
+        "total_tokens": query_result.usage.get("total_tokens", 0),
+        "total_cost": query_result.usage.get("total_cost", 0),
+    }
+
+
+def summarize(runs, baseline):
+    ok = [run for run in runs if not run["error"]]
+    latencies = [run["latency_seconds"] for run in ok]
+    compared = [
+        (run, reference) for run, reference in zip(runs, baseline)
+        if not run["error"] and not reference["error"]
+    ]
+    agreeing = sum(1 for run, reference in compared if run["decision"] == reference["decision"])
+    return {
+        "materials": len(runs),
+        "errors": len(runs) - len(ok),
+        "latency_p50_seconds": statistics.median(latencies) if latencies else None,
+        "latency_mean_seconds": statistics.mean(latencies) if latencies else None,
+        "tokens_mean": statistics.mean(run["total_tokens"] for run in ok) if ok else None,
+        "cost_total": sum(run["total_cost"] for run in ok),
+        "decision_agreement_with_two_step": agreeing / len(compared) if compared else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the two_step and fused pipelines offline.")
+    parser.add_argument("--materials", help="CSV with material_name, manufacturer_name and work_content")
+    parser.add_argument("--mode", default="fast", help="candidate mode of every analysis")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--record", action="store_true", help="call Azure OpenAI and (re)write the fixtures")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay the recorded latencies this much faster")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results"))
+    args = parser.parse_args()
+
+    if not args.record and not os.path.exists(args.fixtures):
+        sys.exit(f"{args.fixtures} does not exist, record it first with --record (calls Azure OpenAI)")
+
+    # caches, result store and telemetry of the runs go to a scratch directory; the engine reads these paths
+    # at import, so they are set before it is imported
+    state_dir = tempfile.mkdtemp(prefix="pipeline-modes-")
+    os.environ.update(
+        CachePath=os.path.join(state_dir, "cache.sqlite3"),
+        ResultsStorePath=os.path.join(state_dir, "results.sqlite3"),
+        JobQueuePath=os.path.join(state_dir, "jobs.sqlite3"),
+        TelemetryPath=os.path.join(state_dir, "log.csv"),
+    )
+    from ask_viridium_ai.ask_viridium_ai import AskViridium
+    from ask_viridium_ai.constants import AskViridiumConstants
+
+    fixtures = dict()
+    if args.record:
+        ask_vai = AskViridium()
+        ask_vai.llm.callbacks.append(recording_callback(fixtures))
+    else:
+        with open(args.fixtures) as file:
+            fixtures = json.load(file)
+        ask_vai = AskViridium(llm=replay_model(fixtures, args.speed))
+
+    materials = read_materials(args.materials)
+    pipelines = [AskViridiumConstants.pipelines["two_step"], AskViridiumConstants.pipelines["fused"]]
+    runs = {pipeline: [run_material(ask_vai, material, args.mode, pipeline) for material in materials]
+            for pipeline in pipelines}
+    ask_vai.logger.close()
+
+    if args.record:
+        os.makedirs(os.path.dirname(args.fixtures) or ".", exist_ok=True)
+        with open(args.fixtures, "w") as file:
+            json.dump(fixtures, file, indent=4)
+        print(f"Recorded {len(fixtures)} completions to {args.fixtures}")
+
+    baseline = runs[AskViridiumConstants.pipelines["two_step"]]
+    summary = {pipeline: summarize(pipeline_runs, baseline) for pipeline, pipeline_runs in runs.items()}
+    for pipeline, stats in summary.items():
+        print(f"{pipeline:<9} p50={stats['latency_p50_seconds']} mean={stats['latency_mean_seconds']} "
+              f"tokens={stats['tokens_mean']} cost={stats['cost_total']:.4f} errors={stats['errors']} "
+              f"agreement={stats['decision_agreement_with_two_step']}")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {"mode": args.mode, "fixtures": args.fixtures, "recorded": args.record, "speed": args.speed},
+        "summary": summary,
+        "materials": [
+            dict(material, **{pipeline: runs[pipeline][index] for pipeline in pipelines})
+            for index, material in enumerate(materials)
+        ],
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"pipeline-modes-{int(time.time())}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Report written to {path}")
+
+
+if __name__ == "__main__":
+    main()
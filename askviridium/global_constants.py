@@ -22,10 +22,74 @@ class GlobalConstants(DotAccessDict):
     flask_host = "0.0.0.0"
     flask_app_port = os.getenv("WEBSITES_PORT", 8000)
     u = "u"
+    flask_debug = os.getenv("FlaskDebug", "false").lower() == "true"
+    # job worker threads per process
     no_of_threads = int(os.getenv("NoOfThreads", 20))
+    # gunicorn.conf.py: worker processes forked from the preloaded app, request threads per process
+    web_workers = int(os.getenv("WebWorkers", os.cpu_count() or 1))
+    web_threads = int(os.getenv("WebThreads", 16))
+    web_timeout = int(os.getenv("WebTimeout", 600))
+    # how long a stopping worker may finish in-flight requests and jobs
+    web_graceful_timeout = int(os.getenv("WebGracefulTimeout", 60))
+    llm_max_tokens = int(os.getenv("LLMMaxTokens", 800))
+    # the fused pipeline returns composition and analysis in one completion
+    fused_max_tokens = int(os.getenv("FusedMaxTokens", 1600))
+    # prompt + completion tokens the deployment accepts in one request
+    context_window = int(os.getenv("ContextWindow", 128000))
+    # trim: shorten additional_info / drop trailing chemicals until the prompt fits. reject: fail the request
+    token_budget_policy = os.getenv("TokenBudgetPolicy", "trim")
+    additional_info_max_tokens = int(os.getenv("AdditionalInfoMaxTokens", 1000))
+    max_chemicals = int(os.getenv("MaxChemicals", 50))
+    consensus_candidates = int(os.getenv("ConsensusCandidates", 3))
+    # quotas of the Azure OpenAI deployment, 0 disables pacing (see utils/scheduler.py)
+    azure_requests_per_minute = int(os.getenv("AzureRequestsPerMinute", 0))
+    azure_tokens_per_minute = int(os.getenv("AzureTokensPerMinute", 0))
+    scheduler_headroom = float(os.getenv("SchedulerHeadroom", 0.9))
+    # attempts per LLM call on throttling / server errors, with jittered exponential backoff
+    llm_max_attempts = int(os.getenv("LLMMaxAttempts", 6))
+    llm_retry_base_delay = float(os.getenv("LLMRetryBaseDelay", 1))
+    llm_retry_max_delay = float(os.getenv("LLMRetryMaxDelay", 30))
+    batch_max_concurrency = int(os.getenv("BatchMaxConcurrency", 8))
+    batch_max_items = int(os.getenv("BatchMaxItems", 500))
+
+    cache_path = os.getenv("CachePath", "ask_viridium_ai/cache.sqlite3")
+    cache_ttl_seconds = int(os.getenv("CacheTTLSeconds", 30 * 24 * 60 * 60))
+    cache_max_entries = int(os.getenv("CacheMaxEntries", 10000))
+
+    session_max_entries = int(os.getenv("SessionMaxEntries", 1000))
+    session_ttl_seconds = int(os.getenv("SessionTTLSeconds", 60 * 60))
+
+    # set to a directory shared by all worker processes to coalesce identical queries across them too
+    single_flight_lock_dir = os.getenv("SingleFlightLockDir")
+
+    # python -m ask_viridium_ai.reference_index: substances with a known PFAS status. Materials whose
+    # chemicals are all in it skip the analysis call, provided the composition is confident enough
+    reference_index_path = os.getenv("ReferenceIndexPath", "ask_viridium_ai/reference_index.sqlite3")
+    reference_index_enabled = os.getenv("ReferenceIndexEnabled", "true").lower() == "true"
+    reference_index_min_confidence = float(os.getenv("ReferenceIndexMinConfidence", 0.8))
+
+    results_store_path = os.getenv("ResultsStorePath", "ask_viridium_ai/results.sqlite3")
+    legacy_results_path = "data.json"
+
+    # python -m ask_viridium_ai.bulk: resumable record of every material a bulk run has processed
+    bulk_checkpoint_path = os.getenv("BulkCheckpointPath", "ask_viridium_ai/bulk.sqlite3")
+    bulk_chunk_size = int(os.getenv("BulkChunkSize", 200))
+
+    job_queue_path = os.getenv("JobQueuePath", "ask_viridium_ai/jobs.sqlite3")
+    job_queue_max_depth = int(os.getenv("JobQueueMaxDepth", 1000))
+    # a running job is claimed again when its worker has not renewed the lease for this long
+    job_lease_seconds = float(os.getenv("JobLeaseSeconds", 300))
+    # claims of a job whose worker keeps dying before it is failed
+    job_max_attempts = int(os.getenv("JobMaxAttempts", 3))
+
+    telemetry_path = os.getenv("TelemetryPath", "ask_viridium_ai/log.csv")
+    telemetry_flush_size = int(os.getenv("TelemetryFlushSize", 100))
+    telemetry_flush_interval = float(os.getenv("TelemetryFlushInterval", 5))
+    telemetry_buffer_size = int(os.getenv("TelemetryBufferSize", 10000))
     api_swagger_json = "/api/swagger.json"
     swagger_app_name = "Ask Viridium AI"
     swagger_endpoint = os.getenv("SwaggerEndpoint", "/api/docs")
+    metrics_endpoint = "/metrics"
 
     azure_deployment_name = "AZURE_CLIENT_SECRET"
     azure_enpoint = "AZURE_TENANT_ID"
@@ -73,6 +137,7 @@ class GlobalConstants(DotAccessDict):
     api_status_codes = {
         "ok": 200,
         "created": 201,
+        "accepted": 202,
         "no_content": 204,
         "bad_request": 400,
         "unauthorized": 401,
@@ -80,6 +145,7 @@ class GlobalConstants(DotAccessDict):
         "not_found": 404,
         "method_not_allowed": 405,
         "conflict": 409,
+        "payload_too_large": 413,
         "internal_server_error": 500,
         "service_unavailable": 503,
         "rate_limit_exceeded": 429,
@@ -101,6 +167,13 @@ class GlobalConstants(DotAccessDict):
         "server_is_running": "Ask Viridium AI Service is running",
         "missing_required_parameters": "Missing required parameters",
         "error_while_processing_file": "Error while processing file",
+        "invalid_batch": "Request body must contain a non-empty 'items' list",
+        "batch_too_large": "Too many items in batch",
+        "invalid_pipeline": "Invalid pipeline",
+        "invalid_mode": "Invalid mode",
+        "session_not_found": "Analysis session not found or expired",
+        "token_budget_exceeded": "Request exceeds the token budget",
+        "job_queue_full": "Too many analyses waiting, retry later",
     }
 
     api_response_messages = DotAccessDict(api_response_messages)
@@ -129,6 +202,7 @@ class GlobalConstants(DotAccessDict):
         "limitations_and_uncertainties": None
     }
 
+    chat_model_factory = os.getenv("ChatModelFactory")
     model_name = os.getenv("AZURE_MODEL_NAME")
     deployment_name = os.getenv("AZURE_DEPLOYMENT_NAME")
 
@@ -0,0 +1,41 @@
+"""
+Production server settings, picked up by gunicorn from the working directory (see startup.txt).
+
+The app is imported and warmed up once in the master process (preload_app), then forked into
+GlobalConstants.web_workers processes of GlobalConstants.web_threads request threads each, so the
+prompts, schemas, tiktoken encoding and Azure client are built once and shared copy-on-write.
+SQLite connections and background threads must not cross a fork: they are closed before it and
+reopened in each worker.
+
+Per-process state is not shared between workers: sessions for the follow-up endpoint (use sticky
+sessions or WebWorkers=1 if follow-ups matter), /metrics and the in-process single-flight (set
+SingleFlightLockDir to coalesce across workers).
+"""
+from global_constants import GlobalConstants
+
+bind = f"{GlobalConstants.flask_host}:{GlobalConstants.flask_app_port}"
+workers = GlobalConstants.web_workers
+threads = GlobalConstants.web_threads
+worker_class = "gthread"
+preload_app = True
+timeout = GlobalConstants.web_timeout
+graceful_timeout = GlobalConstants.web_graceful_timeout
+
+
+def pre_fork(server, worker):
+    import app
+
+    app.main_routes.before_fork()
+
+
+def post_fork(server, worker):
+    import app
+
+    app.main_routes.after_fork()
+    app.main_routes.start_job_workers()
+
+
+def worker_exit(server, worker):
+    import app
+
+    app.main_routes.drain(GlobalConstants.web_graceful_timeout)
@@ -30,3 +30,9 @@ class MaterialInfo(BaseModel):
     recommendation: str = Field(description="Recommendation of what to do with the material with regards to its PFAS compliance.")
     suggestion: str = Field(description="Suggestion of what to do with the material with regards to its PFAS compliance.")
     limitations_and_uncertainties: str = Field(description="Limitations and uncertainties of material and its PFAS compliance based on the data that could be looked up.")
+
+
+class MaterialScreening(BaseModel):
+    """Chemical composition of the material and its PFAS analysis, answered in one completion."""
+    chemical_composition: ChemicalComposition = Field(description="Chemical composition of the material, with CAS numbers and sources.")
+    analysis: MaterialInfo = Field(description="PFAS analysis of the material, based on that chemical composition.")
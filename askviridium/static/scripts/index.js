@@ -1,3 +1,6 @@
+// Session of the last analysis, used to ask follow-up questions about it
+let sessionId = null;
+
 document.addEventListener('DOMContentLoaded', (event) => {
     const askButton = document.querySelector('.ask-button');
     const sendButton = document.querySelector('.send-button');
@@ -11,12 +14,12 @@ document.addEventListener('DOMContentLoaded', (event) => {
     });
 
     sendButton.addEventListener('click', () => {
-        handleAskAIClick();
+        handleRetryClick();
     });
 
     chatInput.addEventListener('keypress', (event) => {
         if (event.key === 'Enter') {
-            handleAskAIClick();
+            handleRetryClick();
         }
     });
 });
@@ -47,6 +50,7 @@ function handleAskAIClick() {
         })
         .then(data => {
             console.log(data.result);
+            sessionId = data.session_id;
             displayMessage('AI', data.result);
             enableChat();
         })
@@ -70,12 +74,12 @@ function handleRetryClick() {
 
     showSpinner();
 
-    fetch('/v1/retry-ask-viridium-ai', {
+    fetch(`/v1/ask-viridium-ai/${sessionId}/follow-up`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify({ message: message })
+        body: JSON.stringify({ additional_info: message })
         })
         .then(response => {
             if (!response.ok){
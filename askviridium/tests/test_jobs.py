@@ -0,0 +1,72 @@
+import pytest
+
+from ask_viridium_ai.jobs import JobQueue
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), handler=lambda payload: payload, max_attempts=3)
+    yield queue
+    queue.close()
+
+
+def expire_leases(queue):
+    with queue.lock:
+        queue.connection.execute("UPDATE jobs SET lease_expires_at = 0 WHERE status = ?", (JobQueue.RUNNING,))
+
+
+def test_claims_oldest_queued_job_once(job_queue):
+    first = job_queue.enqueue({"material_name": "first"})
+    job_queue.enqueue({"material_name": "second"})
+
+    assert job_queue.claim() == (first, {"material_name": "first"})
+    job_id, _ = job_queue.claim()
+    assert job_id != first
+    assert job_queue.claim() is None
+    assert job_queue.get(first)["status"] == JobQueue.RUNNING
+
+
+def test_live_lease_is_not_reclaimed(job_queue):
+    job_queue.enqueue({"material_name": "running"})
+    job_queue.claim()
+
+    assert job_queue.claim() is None
+
+
+def test_expired_lease_is_reclaimed_then_failed(job_queue):
+    job_id = job_queue.enqueue({"material_name": "crashes its worker"})
+
+    # every claim is lost with its worker, as if the job took the process down
+    for attempt in range(1, 4):
+        assert job_queue.claim() == (job_id, {"material_name": "crashes its worker"})
+        assert job_queue.get(job_id)["attempts"] == attempt
+        expire_leases(job_queue)
+
+    assert job_queue.claim() is None
+    job = job_queue.get(job_id)
+    assert job["status"] == JobQueue.FAILED
+    assert job["attempts"] == 3
+    assert "3 times" in job["error"]
+
+
+def test_failed_job_does_not_block_the_next_one(job_queue):
+    crashing = job_queue.enqueue({"material_name": "crashes its worker"})
+    for _ in range(3):
+        job_queue.claim()
+        expire_leases(job_queue)
+    waiting = job_queue.enqueue({"material_name": "waiting"})
+
+    assert job_queue.claim() == (waiting, {"material_name": "waiting"})
+    assert job_queue.get(crashing)["status"] == JobQueue.FAILED
+
+
+def test_unserialisable_result_fails_the_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), handler=lambda payload: {"value": object()}, poll_interval=0.01)
+    job_id = queue.enqueue({"material_name": "anything"})
+    claimed = queue.claim()
+    queue.finish_safely(claimed[0], JobQueue.DONE, result=queue.handler(claimed[1]))
+
+    job = queue.get(job_id)
+    assert job["status"] == JobQueue.FAILED
+    assert "not JSON serializable" in job["error"]
+    queue.close()
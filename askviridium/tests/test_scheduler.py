@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+
+from utils import scheduler
+from utils.scheduler import LocalQuota, QuotaExceededError, RateBudget, awith_retry, backoff_delay, with_retry
+
+
+class FakeClock:
+    """Time that only moves when something sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def asleep(self, seconds):
+        self.sleep(seconds)
+
+
+class Throttled(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after=None):
+        super().__init__("throttled")
+        self.retry_after = retry_after
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+def failing(error, failures):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise error
+        return "ok"
+
+    return fn, calls
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_reserve_blocks_on_request_limit_until_window_passes(clock):
+    budget = RateBudget("test", requests_per_minute=2, headroom=1.0, clock=clock, sleep=clock.sleep)
+    budget.reserve(10)
+    budget.reserve(10)
+    assert clock.now == 0
+
+    assert budget.try_reserve(10) == (None, 60.0)
+    budget.reserve(10)
+    assert clock.now == pytest.approx(60.0)
+    stats = budget.stats()
+    assert stats["waits"] == 1
+    assert stats["wait_seconds"] == pytest.approx(60.0)
+    assert stats["requests_in_window"] == 1
+
+
+def test_reserve_blocks_on_token_limit_and_settle_releases_tokens(clock):
+    budget = RateBudget("test", tokens_per_minute=100, headroom=1.0, clock=clock, sleep=clock.sleep)
+    first = budget.reserve(60)
+    reservation, wait = budget.try_reserve(60)
+    assert reservation is None and wait == pytest.approx(60.0)
+
+    # the call used fewer tokens than predicted, which frees room in the window
+    budget.settle(first, 10)
+    budget.reserve(60)
+    assert clock.now == 0
+    assert budget.stats()["tokens_in_window"] == 70
+
+
+def test_headroom_lowers_the_limits(clock):
+    budget = RateBudget("test", requests_per_minute=10, tokens_per_minute=1000, headroom=0.5, clock=clock)
+    assert (budget.request_limit, budget.token_limit) == (5, 500)
+
+
+def test_pause_holds_back_every_call(clock):
+    budget = RateBudget("test", clock=clock, sleep=clock.sleep)
+    budget.pause(5)
+    assert budget.try_reserve(1) == (None, 5.0)
+    budget.reserve(1)
+    assert clock.now == pytest.approx(5.0)
+    assert budget.stats()["throttled"] == 1
+
+
+@pytest.mark.parametrize("attempt", range(8))
+def test_backoff_delay_is_within_full_jitter_bounds(attempt):
+    bound = min(30.0, 1.0 * 2 ** attempt)
+    delays = [backoff_delay(attempt, 1.0, 30.0) for _ in range(200)]
+    assert all(0 <= delay <= bound for delay in delays)
+
+
+def test_backoff_delay_draws_up_to_the_capped_bound(monkeypatch):
+    monkeypatch.setattr(scheduler.random, "uniform", lambda low, high: (low, high))
+    assert backoff_delay(0, 1.0, 30.0) == (0, 1.0)
+    assert backoff_delay(3, 1.0, 30.0) == (0, 8.0)
+    assert backoff_delay(10, 1.0, 30.0) == (0, 30.0)
+
+
+def test_with_retry_retries_throttling_then_succeeds(clock):
+    budget = RateBudget("test", clock=clock, sleep=clock.sleep)
+    fn, calls = failing(Throttled(retry_after=2), failures=2)
+
+    assert with_retry(fn, budget, max_attempts=5, sleep=clock.sleep) == "ok"
+    assert len(calls) == 3
+    # the Retry-After of the service is used instead of the backoff, and pauses the budget
+    assert clock.sleeps == [2, 2]
+    assert budget.stats()["throttled"] == 2
+
+
+def test_with_retry_gives_up_after_max_attempts(clock):
+    fn, calls = failing(Throttled(), failures=10)
+
+    with pytest.raises(Throttled):
+        with_retry(fn, max_attempts=4, base_delay=1.0, max_delay=30.0, sleep=clock.sleep)
+    assert len(calls) == 4
+    assert len(clock.sleeps) == 3
+    assert all(0 <= delay <= 2 ** attempt for attempt, delay in enumerate(clock.sleeps))
+
+
+def test_with_retry_does_not_retry_client_errors(clock):
+    fn, calls = failing(BadRequest(), failures=10)
+
+    with pytest.raises(BadRequest):
+        with_retry(fn, max_attempts=4, sleep=clock.sleep)
+    assert len(calls) == 1
+    assert clock.sleeps == []
+
+
+def test_awith_retry_gives_up_after_max_attempts(clock):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        raise Throttled(retry_after=1)
+
+    with pytest.raises(Throttled):
+        asyncio.run(awith_retry(fn, max_attempts=3, sleep=clock.asleep))
+    assert len(calls) == 3
+    assert clock.sleeps == [1, 1]
+
+
+def test_local_quota_rejects_over_quota_calls(clock):
+    quota = LocalQuota(requests_per_minute=2, tokens_per_minute=100, clock=clock)
+    quota.consume(40)
+    quota.consume(40)
+
+    with pytest.raises(QuotaExceededError) as raised:
+        quota.consume(10)
+    assert raised.value.status_code == 429
+    assert raised.value.retry_after == pytest.approx(60.0)
+    assert quota.rejected == 1
+
+    clock.now = 60.0
+    quota.consume(90)
+    with pytest.raises(QuotaExceededError):
+        quota.consume(20)
+    assert quota.rejected == 2
+    assert quota.budget.stats()["tokens_in_window"] == 90
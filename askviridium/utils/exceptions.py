@@ -1,3 +1,15 @@
 class MaxProcessingTimeExceededException(Exception):
     def __init__(self, message="Max processing time limit reached!", details=None):
         super().__init__(message, details)
+
+
+class QueueFullException(Exception):
+    def __init__(self, message="Job queue is full!", details=None):
+        super().__init__(message, details)
+        self.details = details
+
+
+class TokenBudgetExceededException(Exception):
+    def __init__(self, message="Prompt exceeds the token budget!", details=None):
+        super().__init__(message, details)
+        self.details = details
@@ -0,0 +1,361 @@
+"""
+Client-side pacing of Azure OpenAI calls against the deployment's requests-per-minute and tokens-per-minute
+quotas, so that load is queued here instead of coming back as 429s.
+
+A RateBudget per deployment keeps the requests and tokens of the last minute. A call reserves its predicted
+tokens (prompt + max_tokens for every choice) before it is sent and waits while that would exceed the quota;
+the reservation is corrected to the reported usage afterwards. Throttling responses pause the whole budget and
+are retried with jittered exponential backoff by with_retry / awith_retry.
+
+Only the standard library is used at import; the langchain callback is built on demand by scheduler_callback.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+
+RETRYABLE_ERRORS = {"RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError"}
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) where no tokenizer is at hand."""
+    return len(text) // 4 + 1
+
+
+def status_code(error):
+    code = getattr(error, "status_code", None)
+    if code is None and getattr(error, "response", None) is not None:
+        code = getattr(error.response, "status_code", None)
+    return code
+
+
+def is_throttling_error(error):
+    return status_code(error) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_retryable_error(error):
+    code = status_code(error)
+    return is_throttling_error(error) or (code is not None and code >= 500) or type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_after(error):
+    """Seconds the service asked us to wait, from a Retry-After header or attribute, if any."""
+    value = getattr(error, "retry_after", None)
+    response = getattr(error, "response", None)
+    if value is None and response is not None:
+        value = getattr(response, "headers", {}).get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Reservation:
+    __slots__ = ("time", "tokens")
+
+    def __init__(self, time, tokens):
+        self.time = time
+        self.tokens = tokens
+
+
+class RateBudget:
+    """
+    Sliding one-minute window of the requests and tokens sent to one deployment.
+
+    Args:
+        name (str): deployment name, for stats.
+        requests_per_minute (int): request quota of the deployment, 0 for no limit.
+        tokens_per_minute (int): token quota of the deployment, 0 for no limit.
+        headroom (float): share of the quotas actually used, to stay just under them.
+        window (float): length of the window in seconds.
+        clock (callable): monotonic time in seconds; sleep (callable) waits in reserve(). Both are replaced
+            in tests.
+    """
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, headroom=0.9, window=60.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.request_limit = int(requests_per_minute * headroom)
+        self.token_limit = int(tokens_per_minute * headroom)
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.reservations = deque()
+        self.tokens_in_window = 0
+        self.blocked_until = 0.0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+
+    @property
+    def enabled(self):
+        return bool(self.request_limit or self.token_limit)
+
+    def expire(self, now):
+        while self.reservations and self.reservations[0].time <= now - self.window:
+            self.tokens_in_window -= self.reservations.popleft().tokens
+
+    def wait_time(self, tokens, now):
+        """Seconds until a call of this many tokens fits. Must be called with the lock held."""
+        self.expire(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.request_limit and len(self.reservations) >= self.request_limit:
+            oldest = self.reservations[len(self.reservations) - self.request_limit]
+            wait = max(wait, oldest.time + self.window - now)
+        if self.token_limit and self.reservations and self.tokens_in_window + tokens > self.token_limit:
+            # wait until enough of the oldest reservations have left the window; a single call above the
+            # whole limit is let through once the window is empty
+            freed = 0
+            for reservation in self.reservations:
+                freed += reservation.tokens
+                if self.tokens_in_window - freed + tokens <= self.token_limit:
+                    break
+            wait = max(wait, reservation.time + self.window - now)
+        return wait
+
+    def try_reserve(self, tokens):
+        """Returns (reservation, 0) when the call may be sent now, otherwise (None, seconds to wait)."""
+        with self.lock:
+            now = self.clock()
+            wait = self.wait_time(tokens, now) if self.enabled or self.blocked_until else 0.0
+            if wait > 0:
+                return None, wait
+            reservation = Reservation(now, tokens)
+            self.reservations.append(reservation)
+            self.tokens_in_window += tokens
+            return reservation, 0.0
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+
+    def reserve(self, tokens):
+        """Blocks until the call fits in the budget and records it."""
+        waited = 0.0
+        while True:
+            reservation, wait = self.try_reserve(tokens)
+            if reservation is not None:
+                if waited:
+                    self.record_wait(waited)
+                return reservation
+            # re-check often enough to notice settled reservations freeing tokens early
+            wait = min(wait, 1.0)
+            self.sleep(wait)
+            waited += wait
+
+    async def areserve(self, tokens):
+        waited = 0.0
+        while True:
+            reservation, wait = self.try_reserve(tokens)
+            if reservation is not None:
+                if waited:
+                    self.record_wait(waited)
+                return reservation
+            wait = min(wait, 1.0)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def settle(self, reservation, tokens):
+        """Replaces the predicted tokens of a sent call by the tokens it actually used."""
+        if reservation is None or tokens is None:
+            return
+        with self.lock:
+            if self.reservations and reservation.time > self.clock() - self.window:
+                self.tokens_in_window += tokens - reservation.tokens
+            reservation.tokens = tokens
+
+    def pause(self, seconds):
+        """Holds back every call for this deployment, after the service throttled us."""
+        with self.lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+    def stats(self):
+        with self.lock:
+            self.expire(self.clock())
+            return {
+                "requests_in_window": len(self.reservations),
+                "tokens_in_window": self.tokens_in_window,
+                "request_limit": self.request_limit,
+                "token_limit": self.token_limit,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+                "throttled": self.throttled,
+            }
+
+
+budgets = dict()
+budgets_lock = threading.Lock()
+
+
+def get_budget(deployment, requests_per_minute=0, tokens_per_minute=0, headroom=0.9):
+    """Process-wide budget of a deployment, shared by every client that calls it."""
+    with budgets_lock:
+        if deployment not in budgets:
+            budgets[deployment] = RateBudget(deployment, requests_per_minute, tokens_per_minute, headroom)
+        return budgets[deployment]
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # "full jitter": uniform between 0 and the exponential bound, so retrying clients do not synchronise
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def with_retry(fn, budget=None, max_attempts=6, base_delay=1.0, max_delay=30.0, sleep=time.sleep):
+    """
+    Calls fn() and retries throttling, timeout and server errors with jittered exponential backoff. A
+    throttled call also pauses the budget, for the Retry-After the service sent if there was one.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not is_retryable_error(e):
+                raise
+            delay = retry_after(e) or backoff_delay(attempt, base_delay, max_delay)
+            if budget is not None and is_throttling_error(e):
+                budget.pause(delay)
+            sleep(delay)
+
+
+async def awith_retry(coroutine_fn, budget=None, max_attempts=6, base_delay=1.0, max_delay=30.0,
+                      sleep=asyncio.sleep):
+    """Async version of with_retry(); coroutine_fn is called without arguments and awaited."""
+    for attempt in range(max_attempts):
+        try:
+            return await coroutine_fn()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not is_retryable_error(e):
+                raise
+            delay = retry_after(e) or backoff_delay(attempt, base_delay, max_delay)
+            if budget is not None and is_throttling_error(e):
+                budget.pause(delay)
+            await sleep(delay)
+
+
+def default_prompt_tokens(messages, invocation_params):
+    tokens = sum(estimate_tokens(str(getattr(message, "content", message))) + 4 for message in messages)
+    if invocation_params.get("functions"):
+        tokens += estimate_tokens(json.dumps(invocation_params["functions"]))
+    return tokens
+
+
+def scheduler_callback(budget, count_prompt_tokens=default_prompt_tokens, default_max_tokens=1000):
+    """
+    langchain callback handler that reserves budget for every chat or completion call of the model it is
+    attached to (callbacks=[...]), and settles it with the usage in the response.
+
+    Args:
+        budget (RateBudget): budget of the model's deployment.
+        count_prompt_tokens (callable): (messages, invocation_params) -> predicted prompt tokens.
+        default_max_tokens (int): completion tokens assumed when the call does not set max_tokens.
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class SchedulerCallbackHandler(BaseCallbackHandler):
+        def __init__(self):
+            self.reservations = dict()
+            self.lock = threading.Lock()
+
+        def reserve(self, run_id, messages, invocation_params):
+            max_tokens = invocation_params.get("max_tokens") or default_max_tokens
+            tokens = count_prompt_tokens(messages, invocation_params) + max_tokens * (invocation_params.get("n") or 1)
+            reservation = budget.reserve(tokens)
+            with self.lock:
+                self.reservations[run_id] = reservation
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params=None, **kwargs):
+            self.reserve(run_id, [message for batch in messages for message in batch], invocation_params or {})
+
+        def on_llm_start(self, serialized, prompts, *, run_id, invocation_params=None, **kwargs):
+            self.reserve(run_id, prompts, invocation_params or {})
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            with self.lock:
+                reservation = self.reservations.pop(run_id, None)
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            budget.settle(reservation, usage.get("total_tokens"))
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            with self.lock:
+                self.reservations.pop(run_id, None)
+            if is_throttling_error(error):
+                budget.pause(retry_after(error) or 1.0)
+
+    return SchedulerCallbackHandler()
+
+
+class ScheduledEmbeddings:
+    """
+    Wraps an embeddings client (e.g. AzureOpenAIEmbeddings) so every request is paced by the budget and
+    retried on throttling. Documents are sent in batches of batch_size texts.
+    """
+
+    def __init__(self, embeddings, budget, batch_size=16, max_attempts=6, base_delay=1.0, max_delay=30.0):
+        self.embeddings = embeddings
+        self.budget = budget
+        self.batch_size = batch_size
+        self.retry = {"max_attempts": max_attempts, "base_delay": base_delay, "max_delay": max_delay}
+
+    def __getattr__(self, name):
+        return getattr(self.embeddings, name)
+
+    def call(self, fn, texts):
+        def scheduled():
+            reservation = self.budget.reserve(sum(estimate_tokens(text) for text in texts))
+            try:
+                return fn()
+            except Exception as e:
+                if is_throttling_error(e):
+                    self.budget.settle(reservation, 0)
+                raise
+        return with_retry(scheduled, self.budget, **self.retry)
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            vectors.extend(self.call(lambda: self.embeddings.embed_documents(batch), batch))
+        return vectors
+
+    def embed_query(self, text):
+        return self.call(lambda: self.embeddings.embed_query(text), [text])
+
+    async def aembed_documents(self, texts):
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text):
+        return await asyncio.to_thread(self.embed_query, text)
+
+
+class QuotaExceededError(Exception):
+    """Raised by LocalQuota like the service answers an over-quota call: status 429 with a Retry-After."""
+
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class LocalQuota:
+    """
+    Local stand-in for the deployment's quota enforcement, for tests and benchmarks: consume() raises
+    QuotaExceededError when a call would exceed the requests or tokens of the last window.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, window=60.0, clock=time.monotonic):
+        self.budget = RateBudget("local-quota", requests_per_minute, tokens_per_minute, headroom=1.0, window=window,
+                                 clock=clock)
+        self.rejected = 0
+
+    def consume(self, tokens):
+        reservation, wait = self.budget.try_reserve(tokens)
+        if reservation is None:
+            self.rejected += 1
+            raise QuotaExceededError(wait)
+        return reservation
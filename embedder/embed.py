@@ -0,0 +1,151 @@
+"""
+Content-addressed on-disk cache in front of an embeddings client.
+
+Vectors are keyed by a hash of (text, deployment, dimensions), so the same chunk or sentence window is
+embedded once, whichever splitter or experiment asks for it. Only the texts missing from the cache are sent
+to the wrapped client. Each (deployment, dimensions) pair has its own directory holding:
+    keys.bin      16-byte digest of every row
+    vectors.f32   float32 vectors, memory-mapped
+    meta.json     dimension and number of valid rows, written last
+
+    embeddings = CachedEmbeddings(ScheduledEmbeddings(AzureOpenAIEmbeddings(...), budget), "../embeddings_cache")
+    embeddings.embed_documents(texts)
+    print(embeddings.stats())
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+DIGEST_SIZE = 16
+
+
+class CachedEmbeddings:
+    """
+    Args:
+        embeddings: client with embed_documents / embed_query, e.g. a ScheduledEmbeddings.
+        cache_dir (str): root directory of the cache, shared by all deployments.
+        deployment (str): name of the embedding deployment or model; read from the client when not given.
+        dimensions (int): requested output dimensions, if the model supports shortening; read from the client
+            when not given.
+        batch_size (int): misses sent to the client at once; every batch is persisted before the next one.
+    """
+
+    def __init__(self, embeddings, cache_dir, deployment=None, dimensions=None, batch_size=256):
+        self.embeddings = embeddings
+        self.deployment = deployment or getattr(embeddings, "deployment", None) or getattr(embeddings, "model", None)
+        self.dimensions = dimensions or getattr(embeddings, "dimensions", None)
+        self.batch_size = batch_size
+        namespace = hashlib.blake2b(json.dumps([self.deployment, self.dimensions]).encode("utf-8"),
+                                    digest_size=8).hexdigest()
+        self.path = os.path.join(cache_dir, namespace)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.backend_calls = 0
+        self.load()
+
+    def __getattr__(self, name):
+        # only reached for missing attributes; before __init__ has set embeddings (e.g. while unpickling)
+        # looking it up here would recurse forever
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        self.meta = {"deployment": self.deployment, "dimensions": self.dimensions, "dimension": None, "rows": 0}
+        if os.path.exists(self.file("meta.json")):
+            with open(self.file("meta.json")) as file:
+                self.meta = json.load(file)
+        rows = self.meta["rows"]
+        self.rows = dict()
+        if rows:
+            keys = np.fromfile(self.file("keys.bin"), dtype=f"V{DIGEST_SIZE}", count=rows)
+            self.rows = {key.tobytes(): row for row, key in enumerate(keys)}
+        self.map_vectors()
+
+    def map_vectors(self):
+        rows, dimension = self.meta["rows"], self.meta["dimension"]
+        if rows:
+            self.vectors = np.memmap(self.file("vectors.f32"), dtype=np.float32, mode="r", shape=(rows, dimension))
+        else:
+            self.vectors = np.empty((0, dimension or 0), dtype=np.float32)
+
+    def key(self, text):
+        payload = json.dumps([text, self.deployment, self.dimensions]).encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=DIGEST_SIZE).digest()
+
+    def append(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rows = self.meta["rows"]
+        if self.meta["dimension"] is None:
+            self.meta["dimension"] = vectors.shape[1]
+        dimension = self.meta["dimension"]
+
+        os.makedirs(self.path, exist_ok=True)
+        # the tails of an append that did not finish are cut off before writing
+        with open(self.file("keys.bin"), "ab") as file:
+            file.truncate(rows * DIGEST_SIZE)
+            file.write(b"".join(keys))
+        with open(self.file("vectors.f32"), "ab") as file:
+            file.truncate(rows * dimension * 4)
+            file.write(vectors.tobytes())
+
+        self.rows.update({key: rows + offset for offset, key in enumerate(keys)})
+        self.meta["rows"] = rows + len(keys)
+        with open(self.file("meta.json.tmp"), "w") as file:
+            json.dump(self.meta, file)
+        os.replace(self.file("meta.json.tmp"), self.file("meta.json"))
+        self.map_vectors()
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        with self.lock:
+            missing = dict()
+            for key, text in zip(keys, texts):
+                if key not in self.rows:
+                    # duplicates within one call are embedded once
+                    missing.setdefault(key, text)
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        # the client is called without the lock, so several threads can wait on the network at once
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            vectors = self.embeddings.embed_documents([text for _, text in batch])
+            with self.lock:
+                self.backend_calls += 1
+                # another thread may have stored some of these texts in the meantime
+                new = [(key, vector) for (key, _), vector in zip(batch, vectors) if key not in self.rows]
+                if new:
+                    self.append([key for key, _ in new], [vector for _, vector in new])
+
+        with self.lock:
+            vectors = self.vectors
+            return [vectors[self.rows[key]].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text):
+        return await asyncio.to_thread(self.embed_query, text)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.meta["rows"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "backend_calls": self.backend_calls,
+        }
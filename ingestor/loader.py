@@ -0,0 +1,132 @@
+"""
+Parallel PDF parsing on a process pool.
+
+Parsing is CPU-bound, so files are spread over worker processes instead of being parsed one after another
+in the main process. Results come back in the order of the input paths whatever order the workers finish
+in, a file that fails to parse is reported without stopping the others, and the parse time of every file
+is recorded.
+
+    loader = ParallelPdfLoader(paths, workers=8)
+    documents = loader.load()
+    print(loader.report())
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class LoadedFile:
+    def __init__(self, path, documents=None, seconds=0.0, error=None):
+        self.path = path
+        self.documents = documents or []
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        return {"path": self.path, "pages": len(self.documents), "seconds": self.seconds, "error": self.error}
+
+
+def parse_pdf(path):
+    """Runs in a worker process; errors are returned rather than raised so one bad file cannot fail a run."""
+    from langchain_community.document_loaders import PyPDFLoader
+
+    started = time.perf_counter()
+    try:
+        return LoadedFile(path, PyPDFLoader(path).load(), time.perf_counter() - started)
+    except Exception as e:
+        return LoadedFile(path, seconds=time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+
+
+class ParallelPdfLoader:
+    """
+    Args:
+        paths (list): files to parse, in the order their pages are returned.
+        workers (int): worker processes; 1 parses in the calling process. Defaults to the number of cores.
+        parse (callable): path -> LoadedFile, run in the workers; must be a module-level function.
+        max_pending (int): files submitted ahead of the one being returned, which bounds the parsed pages
+            held in memory when iterating. Defaults to twice the number of workers.
+    """
+
+    def __init__(self, paths, workers=None, parse=parse_pdf, max_pending=None):
+        self.paths = list(paths)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.parse = parse
+        self.max_pending = max(1, max_pending or 2 * self.workers)
+        # LoadedFile.to_dict() of every file returned; the pages themselves are not kept once yielded
+        self.files = []
+        self.seconds = 0.0
+
+    def __iter__(self):
+        """Yields a LoadedFile per path, in input order, while later files are still being parsed."""
+        started = time.perf_counter()
+        self.files = []
+        try:
+            if self.workers == 1 or len(self.paths) < 2:
+                for path in self.paths:
+                    loaded = self.parse(path)
+                    self.files.append(loaded.to_dict())
+                    yield loaded
+                return
+
+            pool = ProcessPoolExecutor(max_workers=min(self.workers, len(self.paths)))
+            try:
+                pending = deque()
+                paths = iter(self.paths)
+                for path in paths:
+                    pending.append((path, pool.submit(self.parse, path)))
+                    if len(pending) >= self.max_pending:
+                        break
+                while pending:
+                    path, future = pending.popleft()
+                    try:
+                        loaded = future.result()
+                    except BrokenProcessPool:
+                        # a worker died (e.g. a crash in a native parser) and took every file in flight with
+                        # it: those are parsed again one by one in their own process, the rest in a new pool
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        retry = [path] + [pending_path for pending_path, _ in pending]
+                        pool = ProcessPoolExecutor(max_workers=min(self.workers, len(self.paths)))
+                        pending = deque((retry_path, self.isolated(retry_path)) for retry_path in retry)
+                        path, future = pending.popleft()
+                        loaded = future.result()
+                    self.files.append(loaded.to_dict())
+                    next_path = next(paths, None)
+                    if next_path is not None:
+                        pending.append((next_path, pool.submit(self.parse, next_path)))
+                    yield loaded
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+        finally:
+            self.seconds = time.perf_counter() - started
+
+    def isolated(self, path):
+        """Parses a single file in a process of its own; a crash is reported as that file's error."""
+        future = Future()
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                future.set_result(pool.submit(self.parse, path).result())
+            except BrokenProcessPool as e:
+                future.set_result(LoadedFile(path, error=f"{type(e).__name__}: worker process died"))
+        return future
+
+    def load(self):
+        """Pages of every file that parsed, in input order."""
+        return [document for loaded in self for document in loaded.documents]
+
+    def report(self, slowest=5):
+        parsed = [file for file in self.files if file["error"] is None]
+        return {
+            "files": len(self.files),
+            "failed": [file for file in self.files if file["error"] is not None],
+            "pages": sum(file["pages"] for file in parsed),
+            "seconds": self.seconds,
+            "parse_seconds": sum(file["seconds"] for file in self.files),
+            "workers": self.workers,
+            "slowest": sorted(parsed, key=lambda file: file["seconds"], reverse=True)[:slowest],
+        }
@@ -0,0 +1,234 @@
+"""
+Streaming ingestion: load -> clean -> split -> embed -> store, one file at a time.
+
+Each stage runs in its own thread(s) and hands files to the next one through a bounded queue, so PDFs are
+parsed (on the process pool of ParallelPdfLoader) while earlier files are being embedded, and only a few
+files' pages and chunks are held in memory at any time, however large the corpus. A file's chunks reach
+the store as soon as that file is through, not at the end of the run.
+
+    pipeline = StreamingPipeline(db, embeddings, split_documents, on_stored=lambda batch: ...)
+    counters = pipeline.run(paths)
+"""
+import queue
+import threading
+import time
+
+from preprocessor.cleaner import clean_documents
+from .loader import ParallelPdfLoader
+
+DONE = object()
+
+
+class FileBatch:
+    """One source file on its way through the pipeline."""
+
+    def __init__(self, loaded):
+        # not the LoadedFile itself, which would keep the pages alive after they are split
+        self.path = loaded.path
+        self.documents = loaded.documents
+        self.chunks = None
+        self.vectors = None
+        self.ids = None
+
+    @property
+    def units(self):
+        """Pages until the file is split, chunks afterwards."""
+        return len(self.chunks) if self.chunks is not None else len(self.documents)
+
+
+class StageCounters:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.files = 0
+        self.failed = 0
+        self.units = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.finished = None
+
+    def record(self, units, seconds):
+        with self.lock:
+            self.files += 1
+            self.units += units
+            self.busy_seconds += seconds
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def to_dict(self):
+        elapsed = ((self.finished or time.perf_counter()) - self.started) if self.started else 0.0
+        return {
+            "stage": self.name,
+            "files": self.files,
+            "failed": self.failed,
+            "units": self.units,
+            "busy_seconds": self.busy_seconds,
+            "elapsed_seconds": elapsed,
+            "files_per_second": self.files / elapsed if elapsed else None,
+            "units_per_second": self.units / elapsed if elapsed else None,
+        }
+
+
+class StreamingPipeline:
+    """
+    Args:
+        db: vector store with add_embeddings(texts, embeddings, metadatas, ids), e.g. PGVector or
+            LocalVectorStore.
+        embeddings: client with embed_documents, e.g. CachedEmbeddings.
+        split_documents (callable): pages -> chunks.
+        make_ids (callable): FileBatch -> ids of its chunks; random ids when not given.
+        on_stored (callable): called with every FileBatch once its chunks are stored, e.g. to update a manifest.
+        workers (int): processes PDFs are parsed in, see ParallelPdfLoader.
+        embed_threads (int): files embedded concurrently; embedding mostly waits on the network.
+        queue_size (int): files waiting between two stages.
+    """
+
+    def __init__(self, db, embeddings, split_documents, make_ids=None, on_stored=None, workers=None,
+                 embed_threads=2, queue_size=4):
+        self.db = db
+        self.embeddings = embeddings
+        self.split_documents = split_documents
+        self.make_ids = make_ids
+        self.on_stored = on_stored
+        self.workers = workers
+        self.embed_threads = max(1, embed_threads)
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors = []
+        self.counters = dict()
+        self.loader = None
+
+    def put(self, outbox, item):
+        # a stage that failed stops the others, so nobody blocks on a queue that is no longer read
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, inbox):
+        while not self.stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def clean(self, batch):
+        batch.documents = list(clean_documents(batch.documents))
+        return batch
+
+    def split(self, batch):
+        batch.chunks = self.split_documents(batch.documents) if batch.documents else []
+        batch.documents = None
+        return batch
+
+    def embed(self, batch):
+        batch.vectors = self.embeddings.embed_documents([chunk.page_content for chunk in batch.chunks]) \
+            if batch.chunks else []
+        return batch
+
+    def store(self, batch):
+        if batch.chunks:
+            batch.ids = self.db.add_embeddings(
+                [chunk.page_content for chunk in batch.chunks],
+                batch.vectors,
+                [chunk.metadata for chunk in batch.chunks],
+                self.make_ids(batch) if self.make_ids else None,
+            )
+        if self.on_stored:
+            self.on_stored(batch)
+        batch.chunks = batch.vectors = None
+        return batch
+
+    def source(self, paths, outbox, counters):
+        counters.started = time.perf_counter()
+        try:
+            self.loader = ParallelPdfLoader(paths, self.workers)
+            for loaded in self.loader:
+                if self.stop.is_set():
+                    return
+                if not loaded.ok:
+                    # listed with its error under "failed" in report()
+                    counters.record_failure()
+                    continue
+                counters.record(len(loaded.documents), loaded.seconds)
+                if not self.put(outbox, FileBatch(loaded)):
+                    return
+        except Exception as e:
+            self.fail("load", e)
+        finally:
+            counters.finished = time.perf_counter()
+            self.put(outbox, DONE)
+
+    def stage(self, name, fn, inbox, outbox, counters, running):
+        if counters.started is None:
+            counters.started = time.perf_counter()
+        try:
+            while True:
+                batch = self.get(inbox)
+                if batch is DONE:
+                    # let the other threads of this stage see the end as well; after a failure they see the
+                    # stop event instead, and the inbox may be full with nobody left to read it
+                    if not self.stop.is_set():
+                        self.put(inbox, DONE)
+                    break
+                started = time.perf_counter()
+                batch = fn(batch)
+                counters.record(batch.units if name != "store" else len(batch.ids or []),
+                                time.perf_counter() - started)
+                if outbox is not None and not self.put(outbox, batch):
+                    break
+        except Exception as e:
+            self.fail(name, e)
+        finally:
+            with counters.lock:
+                running[name] -= 1
+                last = running[name] == 0
+            if last:
+                counters.finished = time.perf_counter()
+                if outbox is not None:
+                    self.put(outbox, DONE)
+
+    def fail(self, stage, error):
+        self.errors.append((stage, error))
+        self.stop.set()
+
+    def run(self, paths):
+        """Ingests the files and returns the counters of every stage. Re-raises the first stage error."""
+        stages = [("clean", self.clean, 1), ("split", self.split, 1), ("embed", self.embed, self.embed_threads),
+                  ("store", self.store, 1)]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        self.counters = {"load": StageCounters("load")}
+        running = dict()
+        threads = [threading.Thread(target=self.source, args=(paths, queues[0], self.counters["load"]),
+                                    name="pipeline-load", daemon=True)]
+        for index, (name, fn, count) in enumerate(stages):
+            self.counters[name] = StageCounters(name)
+            running[name] = count
+            outbox = queues[index + 1] if index + 1 < len(stages) else None
+            threads.extend(
+                threading.Thread(target=self.stage, args=(name, fn, queues[index], outbox, self.counters[name], running),
+                                 name=f"pipeline-{name}-{number}", daemon=True)
+                for number in range(count)
+            )
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            stage, error = self.errors[0]
+            raise RuntimeError(f"Ingestion failed in the {stage} stage") from error
+        return self.report()
+
+    def report(self):
+        return {
+            "stages": [counters.to_dict() for counters in self.counters.values()],
+            "failed": self.loader.report()["failed"] if self.loader else [],
+        }
@@ -0,0 +1,190 @@
+"""
+Incremental ingestion of a directory of PDFs into a vector store collection.
+
+A manifest per collection records, for every source file, its size, mtime, content hash and the ids of the
+chunks stored for it, together with a hash of the splitter configuration. A run only loads, splits and
+embeds files that are new or whose content changed, and deletes the chunks of changed and removed files by
+id. A different splitter configuration rebuilds the collection. The files are ingested through the
+StreamingPipeline of pipeline.py, and each is recorded in the manifest as soon as its chunks are stored.
+
+    ingestor = IncrementalIngestor(db, "../docs", "../manifests/recursive.json", config, split)
+    print(ingestor.run())
+"""
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from .pipeline import StreamingPipeline
+
+CHUNK_NAMESPACE = uuid.UUID("6f1c7e62-1f0e-4d39-9a4c-3e6a2b0f5d11")
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def splitter_config(splitter_name, splitter):
+    """The settings of a text splitter that change its output, for the manifest."""
+    settings = {
+        name: value for name, value in sorted(vars(splitter).items())
+        if isinstance(value, (str, int, float, bool, type(None)))
+        or (isinstance(value, (list, tuple)) and all(isinstance(item, (str, int, float)) for item in value))
+    }
+    return {"splitter": splitter_name, "class": type(splitter).__name__, "settings": settings}
+
+
+def chunk_ids(name, content_hash, count):
+    """Stable ids of the chunks of one version of a file, valid as PGVector and LocalVectorStore ids."""
+    return [str(uuid.uuid5(CHUNK_NAMESPACE, f"{name}:{content_hash}:{index}")) for index in range(count)]
+
+
+class Manifest:
+    """
+    Args:
+        path (str): JSON file; replaced atomically on every save, so a run can stop at any point.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.config = None
+        self.files = dict()
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            self.config = data.get("config")
+            self.files = data.get("files", dict())
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as file:
+            json.dump({"config": self.config, "files": self.files}, file, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class IncrementalIngestor:
+    """
+    Args:
+        db: vector store with add_embeddings(texts, embeddings, metadatas, ids), delete(ids) and
+            delete_collection().
+        docs_dir (str): directory scanned for source files.
+        manifest_path (str): manifest of this collection.
+        config (dict): splitter configuration; the collection is rebuilt when it changes.
+        split_documents (callable): pages -> chunks.
+        embeddings: client the chunks are embedded with; the store's own when not given.
+        workers (int): processes the files are parsed in, see ParallelPdfLoader.
+        embed_threads (int): files embedded concurrently, see StreamingPipeline.
+        extensions (tuple): file endings that are ingested.
+    """
+
+    def __init__(self, db, docs_dir, manifest_path, config, split_documents, embeddings=None, workers=None,
+                 embed_threads=2, extensions=(".pdf",)):
+        self.db = db
+        self.docs_dir = docs_dir
+        self.manifest = Manifest(manifest_path)
+        self.config = config_hash(config)
+        self.split_documents = split_documents
+        self.embeddings = embeddings or db.embeddings
+        self.workers = workers
+        self.embed_threads = embed_threads
+        self.extensions = extensions
+
+    def scan(self):
+        """{relative path: os.stat_result} of the source files."""
+        found = dict()
+        for root, _, files in os.walk(self.docs_dir):
+            for name in files:
+                if name.lower().endswith(self.extensions):
+                    path = os.path.join(root, name)
+                    found[os.path.relpath(path, self.docs_dir)] = os.stat(path)
+        return found
+
+    def plan(self, found):
+        """Splits the scanned files into added, changed, removed and unchanged ones."""
+        added, changed, unchanged = [], [], []
+        for name, stat in sorted(found.items()):
+            entry = self.manifest.files.get(name)
+            if entry is None:
+                added.append(name)
+            elif entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                unchanged.append(name)
+            elif file_sha256(os.path.join(self.docs_dir, name)) == entry["sha256"]:
+                # touched but not modified: only the manifest needs the new mtime
+                entry["mtime"] = stat.st_mtime
+                unchanged.append(name)
+            else:
+                changed.append(name)
+        removed = sorted(set(self.manifest.files) - set(found))
+        return added, changed, removed, unchanged
+
+    def remove(self, name):
+        entry = self.manifest.files.pop(name)
+        if entry["chunk_ids"]:
+            self.db.delete(ids=entry["chunk_ids"])
+        self.manifest.save()
+
+    def name(self, batch):
+        return os.path.relpath(batch.path, self.docs_dir)
+
+    def make_ids(self, batch):
+        batch.content_hash = file_sha256(batch.path)
+        return chunk_ids(self.name(batch), batch.content_hash, len(batch.chunks))
+
+    def stored(self, batch, found):
+        name = self.name(batch)
+        stat = found[name]
+        content_hash = getattr(batch, "content_hash", None) or file_sha256(batch.path)
+        self.manifest.files[name] = {
+            "size": stat.st_size, "mtime": stat.st_mtime, "sha256": content_hash, "chunk_ids": batch.ids or [],
+            "ingested_at": time.time(),
+        }
+        self.manifest.save()
+        print(f"Ingested {name} ({len(batch.ids or [])} chunks)")
+
+    def rebuild(self):
+        self.db.delete_collection()
+        # PGVector needs its collection row again before documents can be added
+        if hasattr(self.db, "create_collection"):
+            self.db.create_collection()
+        self.manifest.config = self.config
+        self.manifest.files = dict()
+        self.manifest.save()
+
+    def run(self):
+        started = time.perf_counter()
+        rebuilt = self.manifest.config != self.config
+        if rebuilt:
+            self.rebuild()
+
+        found = self.scan()
+        added, changed, removed, unchanged = self.plan(found)
+        # changed files lose their old chunks first, so a run stopped halfway treats them as new next time
+        for name in removed + changed:
+            self.remove(name)
+        # files that fail to load stay out of the manifest, so they are tried again on the next run
+        pipeline = StreamingPipeline(self.db, self.embeddings, self.split_documents, make_ids=self.make_ids,
+                                     on_stored=lambda batch: self.stored(batch, found), workers=self.workers,
+                                     embed_threads=self.embed_threads)
+        report = pipeline.run([os.path.join(self.docs_dir, name) for name in added + changed])
+        self.manifest.save()
+
+        return {
+            "rebuilt": rebuilt,
+            "added": len(added),
+            "changed": len(changed),
+            "removed": len(removed),
+            "unchanged": len(unchanged),
+            "failed": report["failed"],
+            "chunks_added": sum(stage["units"] for stage in report["stages"] if stage["stage"] == "store"),
+            "stages": report["stages"],
+            "seconds": time.perf_counter() - started,
+        }
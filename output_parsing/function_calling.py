@@ -9,6 +9,8 @@ from langchain_core.utils.function_calling import convert_to_openai_function
 from langchain_openai import AzureChatOpenAI
 from langchain_core.output_parsers.openai_functions import JsonOutputFunctionsParser
 
+from askviridium.utils.scheduler import get_budget, scheduler_callback, with_retry
+
 dotenv.load_dotenv()
 
 
@@ -43,6 +45,8 @@ os.environ["OPENAI_API_VERSION"] = "2024-02-01"
 model_name = 'gpt-3.5-turbo'
 
 deployment_name = "langchain-splitting-test"
+budget = get_budget(deployment_name, int(os.getenv("LLM_REQUESTS_PER_MINUTE", 0)),
+                    int(os.getenv("LLM_TOKENS_PER_MINUTE", 0)))
 
 template = """You are an expert at extracting data from given text.
 Don't try to make up or guess the answer if you don't know the answer.\n
@@ -63,6 +67,8 @@ llm = AzureChatOpenAI(
     model_name=model_name,
     temperature=0,
     max_tokens=800,
+    max_retries=0,
+    callbacks=[scheduler_callback(budget)],
 )
 
 dataextract_function = [
@@ -83,9 +89,9 @@ print(f"Loaded {len(documents)} documents from {file_path}")
 
 # NOT PASSING FULL CONTEXT HERE DUE TO TOKEN LIMIT. IDEALLY, THE FINAL JSON BODY NEEDS TO BE EDITED WITH INFORMATION
 # FROM ALL PAGES IN THE DOCUMENT.
-result = dataextract_chain.invoke({"context": [doc.page_content for doc in documents[:4]],
-                                   "query": "Return information about the contents of the document. Give chemical "
-                                            "names and CAS numbers as well.",
-                                   "example": example})
+result = with_retry(lambda: dataextract_chain.invoke({"context": [doc.page_content for doc in documents[:4]],
+                                                     "query": "Return information about the contents of the document. "
+                                                              "Give chemical names and CAS numbers as well.",
+                                                     "example": example}), budget)
 
 print(result)
@@ -0,0 +1,29 @@
+"""
+Clean-up of the text PyPDFLoader extracts from safety data sheets, before it is split.
+
+Text extracted from PDFs carries layout artifacts: words hyphenated across line breaks, ligatures and
+non-breaking spaces, runs of spaces from table columns, and pages without any text (scans, blank pages).
+"""
+import re
+import unicodedata
+
+HYPHENATED_LINE_BREAK = re.compile(r"(\w)-\n(\w)")
+SPACES = re.compile(r"[ \t\f\v]+")
+BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+def clean_text(text):
+    text = unicodedata.normalize("NFKC", text or "")
+    text = text.replace("\x00", "").replace("\r\n", "\n").replace("\r", "\n")
+    text = HYPHENATED_LINE_BREAK.sub(r"\1\2", text)
+    text = SPACES.sub(" ", text)
+    text = BLANK_LINES.sub("\n\n", text)
+    return "\n".join(line.strip() for line in text.split("\n")).strip()
+
+
+def clean_documents(documents, min_characters=1):
+    """Yields the documents with cleaned page_content, leaving out pages with less text than min_characters."""
+    for document in documents:
+        document.page_content = clean_text(document.page_content)
+        if len(document.page_content) >= min_characters:
+            yield document
@@ -0,0 +1,51 @@
+"""
+Text splitters of the chunking experiments ("recursive", "semantic", "section_aware"), shared by the
+batch and the streaming ingestion.
+"""
+
+SECTION_HEADERS = [
+    "Identification", "Product Identifier", "Product Identification", "Section 1",
+    "Product and company identification", "Section (1[0-6]|[1-9])", "1[0-6]|[1-9] .", "1[0-6]|[1-9].",
+    "Hazard Identification", "Hazards Identification", "Section 2",
+    "Composition", "Ingredients", "Information on Ingredients", "Section 3",
+    "First Aid", "First Aid Measures", "Section 4",
+    "Fire Fighting", "Fire Fighting Measures", "Section 5",
+    "Accidental Release", "Accidental Release Measures", "Section 6",
+    "Handling", "Storage", "Handling and Storage", "Section 7",
+    "Exposure Controls", "Personal Protection", "Exposure Controls/Personal Protection", "Section 8",
+    "Physical Properties", "Chemical Properties", "Physical and Chemical Properties", "Section 9",
+    "Stability", "Reactivity", "Stability and Reactivity", "Section 10",
+    "Toxicological Information", "Toxicology", "Section 11",
+    "Ecological Information", "Ecology", "Section 12",
+    "Disposal", "Disposal Considerations", "Section 13",
+    "Transport Information", "Transport", "Section 14",
+    "Regulatory Information", "Regulations", "Section 15",
+    "Other Information", "Other", "Section 16"
+]
+
+
+def make_splitter(splitter_name, embeddings=None):
+    """
+    Args:
+        splitter_name (str): "recursive", "semantic" or "section_aware".
+        embeddings: used by the semantic splitter to find breakpoints between sentences.
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    if splitter_name == "recursive":
+        return RecursiveCharacterTextSplitter()
+    if splitter_name == "semantic":
+        from langchain_experimental.text_splitter import SemanticChunker
+
+        return SemanticChunker(embeddings, breakpoint_threshold_type="interquartile", breakpoint_threshold_amount=1.5, buffer_size=3)
+    if splitter_name == "section_aware":
+        return RecursiveCharacterTextSplitter(is_separator_regex=True, separators=SECTION_HEADERS)
+    raise ValueError(f"Unknown splitter {splitter_name!r}")
+
+
+def split_documents(splitter, documents):
+    """Chunks of the documents, each prefixed with its source file so retrieval results name the SDS."""
+    split_docs = splitter.split_documents(documents)
+    for split_doc in split_docs:
+        split_doc.page_content = split_doc.metadata["source"] + split_doc.page_content
+    return split_docs
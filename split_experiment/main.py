@@ -1,92 +1,154 @@
 import os
+from functools import cached_property
 from time import perf_counter
 
-import cohere
 import dotenv
-from langchain_openai.embeddings import AzureOpenAIEmbeddings
-from langchain_openai import AzureOpenAI
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_postgres.vectorstores import PGVector, DistanceStrategy
+from askviridium.utils.scheduler import ScheduledEmbeddings, get_budget, scheduler_callback, with_retry
 from .sheets.sheets import Spreadsheet
 
 dotenv.load_dotenv()
 
 
 class SplittingTest:
+    """
+    Clients (cohere, Azure OpenAI, the vector store, Google Sheets) and their heavy dependencies are created
+    on first use, so constructing a SplittingTest, e.g. on every Streamlit rerun, stays cheap.
+
+    VECTOR_STORE picks where the chunks are stored: "pgvector" (default, needs DATABASE_URL) or "local", the
+    in-process store of store/vstore.py kept in VECTOR_STORE_DIR. Embeddings are cached in EMBEDDINGS_CACHE_DIR.
+    """
+
     def __init__(self, splitter_name: str):
         self.connection = os.getenv("DATABASE_URL")
-        self.cohere_client = cohere.Client(os.getenv("COHERE_API_KEY"))
+        self.vector_store = os.getenv("VECTOR_STORE") or "pgvector"
+        self.vector_store_dir = os.getenv("VECTOR_STORE_DIR") or "../vectorstore"
+        self.embeddings_cache_dir = os.getenv("EMBEDDINGS_CACHE_DIR") or "../embeddings_cache"
+        # what ingestor/uploading.py has stored per collection, to ingest only new or changed PDFs
+        self.manifest_dir = os.getenv("INGEST_MANIFEST_DIR") or "../manifests"
+        # processes PDFs are parsed in, all cores when unset
+        self.loader_workers = int(os.getenv("LOADER_WORKERS") or 0) or None
+        # files embedded at once while later ones are still being parsed and split
+        self.embed_threads = int(os.getenv("EMBED_THREADS") or 2)
         self.spreadsheet_id = os.getenv("SPREADSHEET_ID")
         self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
         self.docs_dir = "../docs"
         self.collection_name = self.splitter_name = splitter_name
-        self.embedding_function = AzureOpenAIEmbeddings(deployment="langchain-splitting-test1")
-        self.llm = AzureOpenAI(deployment_name="langchain-splitting-test", temperature=0.2)
+        self.documents = []
+        self.split_docs = []
+        self.splitter = None
+        self.checkpoints = {"easy": 3, "moderate": 13, "hard": 23}
+        # Azure OpenAI quotas of the two deployments, shared with every other client in the process
+        self.embedding_budget = get_budget("langchain-splitting-test1",
+                                           int(os.getenv("EMBEDDINGS_REQUESTS_PER_MINUTE", 0)),
+                                           int(os.getenv("EMBEDDINGS_TOKENS_PER_MINUTE", 0)))
+        self.llm_budget = get_budget("langchain-splitting-test",
+                                     int(os.getenv("LLM_REQUESTS_PER_MINUTE", 0)),
+                                     int(os.getenv("LLM_TOKENS_PER_MINUTE", 0)))
+
+    @cached_property
+    def cohere_client(self):
+        import cohere
+
+        return cohere.Client(os.getenv("COHERE_API_KEY"))
 
-        self.db = PGVector(
+    @cached_property
+    def embedding_function(self):
+        from langchain_openai.embeddings import AzureOpenAIEmbeddings
+        from embedder.embed import CachedEmbeddings
+
+        # retries are done by the scheduler, with backoff that also holds back the other callers
+        scheduled = ScheduledEmbeddings(AzureOpenAIEmbeddings(deployment="langchain-splitting-test1", max_retries=0),
+                                        self.embedding_budget)
+        # chunks and sentence windows seen by an earlier run are not embedded again
+        return CachedEmbeddings(scheduled, self.embeddings_cache_dir)
+
+    @cached_property
+    def llm(self):
+        from langchain_openai import AzureOpenAI
+
+        return AzureOpenAI(deployment_name="langchain-splitting-test", temperature=0.2, max_retries=0,
+                           callbacks=[scheduler_callback(self.llm_budget)])
+
+    @cached_property
+    def db(self):
+        if self.vector_store == "local":
+            from store.vstore import LocalVectorStore
+
+            return LocalVectorStore(self.embedding_function, self.collection_name, self.vector_store_dir)
+
+        from langchain_postgres.vectorstores import PGVector, DistanceStrategy
+
+        return PGVector(
             embeddings=self.embedding_function,
             collection_name=self.collection_name,
             connection=self.connection,
             use_jsonb=True,
             distance_strategy=DistanceStrategy.EUCLIDEAN,
         )
-        self.documents = []
-        self.split_docs = []
-        self.splitter = None
-        self.checkpoints = {"easy": 3, "moderate": 13, "hard": 23}
-        self.writer = Spreadsheet(spreadsheet_id=self.spreadsheet_id)
+
+    @cached_property
+    def writer(self):
+        return Spreadsheet(spreadsheet_id=self.spreadsheet_id)
+
+    @cached_property
+    def ingestor(self):
+        from ingestor.uploading import IncrementalIngestor, splitter_config
+
+        return IncrementalIngestor(
+            self.db,
+            self.docs_dir,
+            os.path.join(self.manifest_dir, f"{self.collection_name}.json"),
+            splitter_config(self.splitter_name, self.make_splitter()),
+            self.split_documents,
+            embeddings=self.embedding_function,
+            workers=self.loader_workers,
+            embed_threads=self.embed_threads,
+        )
 
     def load_documents(self):
-        file_paths = [os.path.join(self.docs_dir, file) for file in os.listdir(self.docs_dir) if file.endswith(".pdf")]
+        from ingestor.loader import ParallelPdfLoader
 
-        for file_path in file_paths:
-            loader = PyPDFLoader(file_path)
-            documents = loader.load()
-            print(f"Loaded {len(documents)} documents from {file_path}")
-            self.documents.extend(documents)
+        file_paths = sorted(os.path.join(self.docs_dir, file) for file in os.listdir(self.docs_dir)
+                            if file.endswith(".pdf"))
+
+        # parsed across processes, pages still come back in file order
+        loader = ParallelPdfLoader(file_paths, self.loader_workers)
+        for loaded in loader:
+            if loaded.ok:
+                print(f"Loaded {len(loaded.documents)} documents from {loaded.path} in {loaded.seconds:.2f}s")
+                self.documents.extend(loaded.documents)
+            else:
+                print(f"Failed to load {loaded.path}: {loaded.error}")
+        report = loader.report()
+        print(f"Loaded {report['pages']} pages from {report['files']} files in {report['seconds']:.2f}s "
+              f"with {report['workers']} workers, {len(report['failed'])} failed")
+
+    def make_splitter(self):
+        from preprocessor.splitter import make_splitter
+
+        if self.splitter is None:
+            # only the semantic splitter embeds, the others do not need the client
+            embeddings = self.embedding_function if self.splitter_name == "semantic" else None
+            self.splitter = make_splitter(self.splitter_name, embeddings)
+        return self.splitter
+
+    def split_documents(self, documents):
+        from preprocessor.splitter import split_documents
+
+        return split_documents(self.make_splitter(), documents)
 
     def preprocess_documents(self):
         chkpt = perf_counter()
-        if self.splitter_name == "recursive":
-            self.splitter = RecursiveCharacterTextSplitter()
-        elif self.splitter_name == "semantic":
-            self.splitter = SemanticChunker(self.embedding_function, breakpoint_threshold_type="interquartile", breakpoint_threshold_amount=1.5, buffer_size=3)
-        elif self.splitter_name == "section_aware":
-            section_headers = [
-                "Identification", "Product Identifier", "Product Identification", "Section 1",
-                "Product and company identification", "Section (1[0-6]|[1-9])", "1[0-6]|[1-9] .", "1[0-6]|[1-9].",
-                "Hazard Identification", "Hazards Identification", "Section 2",
-                "Composition", "Ingredients", "Information on Ingredients", "Section 3",
-                "First Aid", "First Aid Measures", "Section 4",
-                "Fire Fighting", "Fire Fighting Measures", "Section 5",
-                "Accidental Release", "Accidental Release Measures", "Section 6",
-                "Handling", "Storage", "Handling and Storage", "Section 7",
-                "Exposure Controls", "Personal Protection", "Exposure Controls/Personal Protection", "Section 8",
-                "Physical Properties", "Chemical Properties", "Physical and Chemical Properties", "Section 9",
-                "Stability", "Reactivity", "Stability and Reactivity", "Section 10",
-                "Toxicological Information", "Toxicology", "Section 11",
-                "Ecological Information", "Ecology", "Section 12",
-                "Disposal", "Disposal Considerations", "Section 13",
-                "Transport Information", "Transport", "Section 14",
-                "Regulatory Information", "Regulations", "Section 15",
-                "Other Information", "Other", "Section 16"
-            ]
-            self.splitter = RecursiveCharacterTextSplitter(is_separator_regex=True, separators=section_headers)
-
-        self.split_docs = self.splitter.split_documents(self.documents)
+        self.split_docs = self.split_documents(self.documents)
         print(f"{self.splitter_name} split time: {perf_counter() - chkpt}")
 
-        for split_doc in self.split_docs:
-            split_doc.page_content = split_doc.metadata["source"] + split_doc.page_content
-
         filename = f"splits/{self.splitter_name}.json"
         print(f"Preprocessing finished. {len(self.split_docs)} splits created, stored in {filename}")
 
     def store_documents(self):
         self.db.add_documents(self.split_docs)
         print(f"Documents stored ({self.splitter_name})!")
+        print(f"Embedding cache: {self.embedding_function.stats()}")
 
     def delete_collection(self):
         self.db.delete_collection()
@@ -104,7 +166,7 @@ class SplittingTest:
 
         retrieval_log["reranked_documents"] = reranked_docs or "None"
 
-        result = self.llm.invoke(
+        prompt = (
             f"You are an expert Material Safety Document Analyser assistant that helps people"
             + "analyse Material Safety and regulation documents."
             + f" Context: {reranked_docs}"
@@ -112,13 +174,21 @@ class SplittingTest:
             + f" Question: {query}. Make sure there are full stops after every sentence."
             + "Don't use numerical numbering. Just return one answer (can be descriptive depending upon the question)."
         )
+        result = with_retry(lambda: self.llm.invoke(prompt), self.llm_budget)
         return result, reranked_docs[:3]
 
-    def setup(self):
-        self.delete_collection()
-        self.load_documents()
-        self.preprocess_documents()
-        self.store_documents()
+    def setup(self, rebuild: bool = False):
+        """
+        Brings the collection up to date with docs_dir: only new or changed PDFs are loaded, split and
+        embedded, and chunks of changed or deleted ones are removed. rebuild=True starts from scratch.
+        Files stream through the ingestion stages, so the corpus is never held in memory as a whole.
+        """
+        if rebuild:
+            self.ingestor.rebuild()
+            print("Collection deleted!")
+
+        print(f"Ingestion ({self.splitter_name}): {self.ingestor.run()}")
+        print(f"Embedding cache: {self.embedding_function.stats()}")
 
     def rerank_documents(self, documents, query):
         results = self.cohere_client.rerank(query=query, documents=documents, top_n=8, model="rerank-multilingual-v2.0",
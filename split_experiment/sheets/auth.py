@@ -1,20 +1,47 @@
 from __future__ import print_function
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+
+import os
+from functools import lru_cache
 
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
 ]
 
-try:
-    credentials = service_account.Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
-except ImportError:
-    credentials = service_account.Credentials.from_service_account_file('sheets/credentials.json', scopes=SCOPES)
-    pass
-except FileNotFoundError:
-    credentials = service_account.Credentials.from_service_account_file('split_experiment/sheets/credentials.json', scopes=SCOPES)
-    pass
-
-spreadsheet_service = build('sheets', 'v4', credentials=credentials)
-drive_service = build('drive', 'v3', credentials=credentials)
+# depending on the working directory the experiment is started from
+CREDENTIALS_PATHS = ['credentials.json', 'sheets/credentials.json', 'split_experiment/sheets/credentials.json']
+
+
+# The Google clients are built on first use rather than at import, so importing the sheets helpers
+# (e.g. through SplittingTest) neither needs credentials.json nor pays for the discovery documents.
+@lru_cache(maxsize=None)
+def get_credentials():
+    from google.oauth2 import service_account
+
+    for path in CREDENTIALS_PATHS:
+        if os.path.exists(path):
+            return service_account.Credentials.from_service_account_file(path, scopes=SCOPES)
+    raise FileNotFoundError(f"No Google service account credentials found in {CREDENTIALS_PATHS}")
+
+
+@lru_cache(maxsize=None)
+def get_spreadsheet_service():
+    from googleapiclient.discovery import build
+
+    return build('sheets', 'v4', credentials=get_credentials())
+
+
+@lru_cache(maxsize=None)
+def get_drive_service():
+    from googleapiclient.discovery import build
+
+    return build('drive', 'v3', credentials=get_credentials())
+
+
+def __getattr__(name):
+    # keeps `from split_experiment.sheets.auth import spreadsheet_service` working, built on that access
+    if name == 'spreadsheet_service':
+        return get_spreadsheet_service()
+    if name == 'drive_service':
+        return get_drive_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,7 +2,7 @@ from __future__ import print_function
 
 import re
 
-from split_experiment.sheets.auth import spreadsheet_service
+from split_experiment.sheets.auth import get_spreadsheet_service
 
 
 class Spreadsheet:
@@ -11,7 +11,7 @@ class Spreadsheet:
 
     def read_ranges(self, sheet_name: str, ranges: list[str]):
         range_names = [sheet_name + "!" + range for range in ranges]
-        result = spreadsheet_service.spreadsheets().values().batchGet(
+        result = get_spreadsheet_service().spreadsheets().values().batchGet(
             spreadsheetId=self.spreadsheet_id, ranges=range_names).execute()
         ranges = result.get('valueRanges', [])
         print('{0} ranges retrieved.'.format(len(ranges)))
@@ -48,6 +48,6 @@ class Spreadsheet:
             'valueInputOption': 'USER_ENTERED',
             'data': data
         }
-        result = spreadsheet_service.spreadsheets().values().batchUpdate(
+        result = get_spreadsheet_service().spreadsheets().values().batchUpdate(
             spreadsheetId=self.spreadsheet_id, body=body).execute()
         print('{0} cells updated.'.format(result.get('totalUpdatedCells')))
@@ -0,0 +1,348 @@
+"""
+In-process vector store, a drop-in alternative to PGVector for the splitter experiments.
+
+Each collection is a directory holding the vectors as a raw float32 file that is memory-mapped for search,
+a documents.jsonl sidecar with the text and metadata of every row, and a collection.json describing both.
+Small collections are searched exactly with one matrix product; above ivf_threshold rows an IVF index
+(k-means centroids, rows grouped by nearest centroid) is built and only the nprobe closest lists are
+searched. By default nprobe grows with the number of lists (1/16 of them, at least 8), so a query scores
+about 6% of the rows at any collection size instead of a shrinking share; recall() measures what that costs
+against the exact search for a set of queries, e.g. before trading recall for speed with a smaller nprobe.
+
+    store = LocalVectorStore(embeddings, "recursive", "../vectorstore")
+    store.add_documents(docs)
+    store.similarity_search("What is the UN number of ethanol?", k=20)
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+EUCLIDEAN = "euclidean"
+COSINE = "cosine"
+
+
+def kmeans(vectors, clusters, iterations=10, sample_size=50000, seed=0):
+    """Centroids of a k-means (Lloyd) clustering, fitted on a random sample of at most sample_size rows."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids)
+        for cluster in range(clusters):
+            members = vectors[assignments == cluster]
+            # an empty cluster is restarted on a random row
+            centroids[cluster] = members.mean(axis=0) if len(members) else vectors[rng.integers(len(vectors))]
+    return centroids
+
+
+def nearest(vectors, centroids, batch_size=8192):
+    """Index of the closest centroid of every row, in batches to bound the distance matrix."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+        distances = centroid_norms[None, :] - 2 * batch @ centroids.T
+        assignments[start:start + batch_size] = distances.argmin(axis=1)
+    return assignments
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Args:
+        embeddings: langchain Embeddings used for documents and queries.
+        collection_name (str): one directory per collection below persist_dir.
+        persist_dir (str): where the collections are kept.
+        distance_strategy (str): "euclidean" (scores are distances, like PGVector's EUCLIDEAN) or "cosine"
+            (scores are cosine distances).
+        ivf_threshold (int): collections with at least this many rows are searched through the IVF index.
+        nprobe (int): IVF lists searched per query; more is slower and closer to the exact result. Defaults to
+            1/16 of the lists, at least 8.
+    """
+
+    def __init__(self, embeddings, collection_name, persist_dir, distance_strategy=EUCLIDEAN, ivf_threshold=20000,
+                 nprobe=None):
+        self.embedding_function = embeddings
+        self.collection_name = collection_name
+        self.persist_dir = persist_dir
+        self.distance_strategy = distance_strategy
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.lock = threading.RLock()
+        self.load()
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    @property
+    def path(self):
+        return os.path.join(self.persist_dir, self.collection_name)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        """Maps the persisted collection, or starts an empty one."""
+        with self.lock:
+            self.info = {"dimension": None, "rows": 0, "distance_strategy": self.distance_strategy}
+            if os.path.exists(self.file("collection.json")):
+                with open(self.file("collection.json")) as file:
+                    self.info = json.load(file)
+            self.ids = []
+            self.texts = []
+            self.metadatas = []
+            if os.path.exists(self.file("documents.jsonl")):
+                with open(self.file("documents.jsonl"), encoding="utf-8") as file:
+                    # rows past info["rows"] belong to an add that did not finish
+                    for _, line in zip(range(self.info["rows"]), file):
+                        row = json.loads(line)
+                        self.ids.append(row["id"])
+                        self.texts.append(row["text"])
+                        self.metadatas.append(row["metadata"])
+                    unfinished = file.readline() != ""
+                if unfinished:
+                    self.write_documents()
+            self.deleted = np.zeros(self.info["rows"], dtype=bool)
+            if os.path.exists(self.file("deleted.npy")):
+                deleted = np.load(self.file("deleted.npy"))[:self.info["rows"]]
+                self.deleted[:len(deleted)] = deleted
+            self.positions = {row_id: row for row, row_id in enumerate(self.ids) if not self.deleted[row]}
+            self.map_vectors()
+            self.norms = (np.asarray(self.vectors) ** 2).sum(axis=1)
+            self.ivf = None
+            if os.path.exists(self.file("ivf.npz")):
+                with np.load(self.file("ivf.npz")) as ivf:
+                    self.ivf = {"centroids": ivf["centroids"], "assignments": ivf["assignments"]}
+
+    def write_documents(self):
+        with open(self.file("documents.jsonl.tmp"), "w", encoding="utf-8") as file:
+            for row_id, text, metadata in zip(self.ids, self.texts, self.metadatas):
+                file.write(json.dumps({"id": row_id, "text": text, "metadata": metadata}) + "\n")
+        os.replace(self.file("documents.jsonl.tmp"), self.file("documents.jsonl"))
+
+    def map_vectors(self):
+        rows, dimension = self.info["rows"], self.info["dimension"]
+        if rows:
+            self.vectors = np.memmap(self.file("vectors.f32"), dtype=np.float32, mode="r", shape=(rows, dimension))
+        else:
+            self.vectors = np.empty((0, dimension or 0), dtype=np.float32)
+
+    def save_info(self):
+        os.makedirs(self.path, exist_ok=True)
+        np.save(self.file("deleted.npy"), self.deleted)
+        # written last and atomically: it decides how many rows of the other files are valid
+        with open(self.file("collection.json.tmp"), "w") as file:
+            json.dump(self.info, file)
+        os.replace(self.file("collection.json.tmp"), self.file("collection.json"))
+
+    @property
+    def live_rows(self):
+        return len(self.positions)
+
+    def add_vectors(self, vectors, texts, metadatas=None, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or not len(vectors):
+            return []
+        if self.distance_strategy == COSINE:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        metadatas = metadatas or [dict() for _ in texts]
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+
+        with self.lock:
+            if self.info["dimension"] is None:
+                self.info["dimension"] = vectors.shape[1]
+            elif vectors.shape[1] != self.info["dimension"]:
+                raise ValueError(f"Expected vectors of dimension {self.info['dimension']}, got {vectors.shape[1]}")
+            # re-adding an id replaces its row, like an upsert
+            self.delete([row_id for row_id in ids if row_id in self.positions], save=False)
+
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.file("vectors.f32"), "ab") as file:
+                # drop the tail of an add that did not finish
+                file.truncate(self.info["rows"] * self.info["dimension"] * 4)
+                file.write(vectors.tobytes())
+            with open(self.file("documents.jsonl"), "a", encoding="utf-8") as file:
+                for row_id, text, metadata in zip(ids, texts, metadatas):
+                    file.write(json.dumps({"id": row_id, "text": text, "metadata": metadata}) + "\n")
+
+            first = self.info["rows"]
+            self.ids.extend(ids)
+            self.texts.extend(texts)
+            self.metadatas.extend(metadatas)
+            self.positions.update({row_id: first + offset for offset, row_id in enumerate(ids)})
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(ids), dtype=bool)])
+            self.info["rows"] = first + len(ids)
+            self.save_info()
+            self.map_vectors()
+            self.norms = np.concatenate([self.norms, (vectors ** 2).sum(axis=1)])
+            if self.ivf is not None:
+                self.ivf["assignments"] = np.concatenate(
+                    [self.ivf["assignments"], nearest(vectors, self.ivf["centroids"])]
+                )
+                self.save_ivf()
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None,
+                  **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_vectors(self.embeddings.embed_documents(texts), texts, metadatas, ids)
+
+    def add_embeddings(self, texts: Iterable[str], embeddings: List[List[float]], metadatas: Optional[List[dict]] = None,
+                       ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        """Adds texts that are already embedded, with the same signature as PGVector.add_embeddings."""
+        return self.add_vectors(embeddings, list(texts), metadatas, ids)
+
+    def delete(self, ids: Optional[List[str]] = None, save=True, **kwargs: Any) -> Optional[bool]:
+        """Marks rows as deleted; they are dropped from the files when the collection is compacted."""
+        with self.lock:
+            for row_id in ids or []:
+                row = self.positions.pop(row_id, None)
+                if row is not None:
+                    self.deleted[row] = True
+            if save and ids:
+                self.save_info()
+                if self.deleted.sum() > self.info["rows"] // 4:
+                    self.compact()
+        return True
+
+    def delete_where(self, **metadata):
+        """Deletes every row whose metadata has all the given values, e.g. delete_where(source=path)."""
+        with self.lock:
+            ids = [self.ids[row] for row in self.positions.values()
+                   if all(self.metadatas[row].get(key) == value for key, value in metadata.items())]
+            self.delete(ids)
+        return len(ids)
+
+    def compact(self):
+        """Rewrites the collection without its deleted rows."""
+        with self.lock:
+            keep = np.flatnonzero(~self.deleted)
+            vectors = np.array(self.vectors[keep]) if len(keep) else None
+            texts = [self.texts[row] for row in keep]
+            metadatas = [self.metadatas[row] for row in keep]
+            ids = [self.ids[row] for row in keep]
+            dimension = self.info["dimension"]
+            self.delete_collection()
+            self.info["dimension"] = dimension
+            if vectors is not None:
+                # the stored vectors are already normalised for cosine; normalising twice changes nothing
+                self.add_vectors(vectors, texts, metadatas, ids)
+
+    def delete_collection(self):
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.load()
+
+    def save_ivf(self):
+        np.savez(self.file("ivf.npz"), centroids=self.ivf["centroids"], assignments=self.ivf["assignments"])
+
+    def build_ivf(self):
+        """Clusters the live rows into about 4 * sqrt(n) lists."""
+        with self.lock:
+            live = np.flatnonzero(~self.deleted)
+            clusters = max(1, min(len(live), int(4 * np.sqrt(len(live)))))
+            centroids = kmeans(self.vectors[live], clusters)
+            self.ivf = {"centroids": centroids, "assignments": nearest(self.vectors, centroids)}
+            self.save_ivf()
+
+    def candidates(self, query):
+        """Rows to score for a query: all of them, or the members of the nprobe nearest IVF lists."""
+        if self.live_rows < self.ivf_threshold:
+            return None
+        if self.ivf is None or len(self.ivf["assignments"]) != self.info["rows"] \
+                or len(self.ivf["centroids"]) < int(2 * np.sqrt(self.live_rows)):
+            # rebuilt once the collection has grown to four times the size the index was built for
+            self.build_ivf()
+        centroids = self.ivf["centroids"]
+        distances = ((centroids - query) ** 2).sum(axis=1)
+        nprobe = self.probes(len(centroids))
+        probe = np.argpartition(distances, nprobe - 1)[:nprobe]
+        return np.flatnonzero(np.isin(self.ivf["assignments"], probe))
+
+    def probes(self, lists):
+        return min(lists, self.nprobe or max(8, lists // 16))
+
+    def recall(self, queries, k=20):
+        """
+        Share of the exact k nearest rows that the IVF search returns, averaged over the query vectors. The
+        index is used even below ivf_threshold, so the tradeoff can be checked before a collection gets there.
+        """
+        with self.lock:
+            threshold = self.ivf_threshold
+            try:
+                found = []
+                for query in queries:
+                    self.ivf_threshold = np.inf
+                    exact = {row for row, _ in self.search(query, k)}
+                    self.ivf_threshold = 0
+                    approximate = {row for row, _ in self.search(query, k)}
+                    found.append(len(exact & approximate) / len(exact) if exact else 1.0)
+            finally:
+                self.ivf_threshold = threshold
+        return float(np.mean(found)) if found else None
+
+    def search(self, query, k):
+        """(row, distance) of the k nearest live rows."""
+        query = np.asarray(query, dtype=np.float32)
+        if self.distance_strategy == COSINE:
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self.lock:
+            if not self.live_rows or k <= 0:
+                return []
+            rows = self.candidates(query)
+            vectors = self.vectors if rows is None else self.vectors[rows]
+            norms = self.norms if rows is None else self.norms[rows]
+            distances = norms - 2 * (vectors @ query) + float(query @ query)
+            deleted = self.deleted if rows is None else self.deleted[rows]
+            distances[deleted] = np.inf
+            if not len(distances):
+                return []
+
+            k = min(k, len(distances))
+            top = np.argpartition(distances, k - 1)[:k]
+            top = top[np.argsort(distances[top])]
+            top = top[np.isfinite(distances[top])]
+            found = top if rows is None else rows[top]
+            distances = np.maximum(distances[top], 0)
+        if self.distance_strategy == COSINE:
+            # squared euclidean distance of unit vectors is twice the cosine distance
+            return [(int(row), float(distance) / 2) for row, distance in zip(found, distances)]
+        return [(int(row), float(np.sqrt(distance))) for row, distance in zip(found, distances)]
+
+    def document(self, row):
+        return Document(page_content=self.texts[row], metadata=self.metadatas[row])
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        return [(self.document(row), distance) for row, distance in self.search(embedding, k)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embeddings.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        if self.distance_strategy == COSINE:
+            return self._cosine_relevance_score_fn
+        return self._euclidean_relevance_score_fn
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding, metadatas: Optional[List[dict]] = None,
+                   collection_name: str = "default", persist_dir: str = "vectorstore", **kwargs: Any):
+        store = cls(embedding, collection_name, persist_dir, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
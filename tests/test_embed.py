@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from embedder.embed import CachedEmbeddings
+
+
+class CountingEmbeddings:
+    deployment = "text-embedding-3-small"
+    dimensions = 4
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), float(index), 0.5, -1.0] for index, text in enumerate(texts)]
+
+
+def test_only_misses_reach_the_client(tmp_path):
+    client = CountingEmbeddings()
+    embeddings = CachedEmbeddings(client, str(tmp_path))
+
+    first = embeddings.embed_documents(["a", "bb", "a"])
+    assert client.calls == [["a", "bb"]]
+
+    second = embeddings.embed_documents(["bb", "ccc", "a"])
+    assert client.calls[1] == ["ccc"]
+    assert second[0] == first[1] and second[2] == first[0]
+    assert embeddings.stats() == {"entries": 3, "hits": 3, "misses": 3, "hit_rate": 0.5, "backend_calls": 2}
+
+
+def test_vectors_persist_across_reopen(tmp_path):
+    vectors = CachedEmbeddings(CountingEmbeddings(), str(tmp_path), batch_size=2).embed_documents(["a", "bb", "ccc"])
+
+    client = CountingEmbeddings()
+    reopened = CachedEmbeddings(client, str(tmp_path))
+    assert sorted(os.listdir(reopened.path)) == ["keys.bin", "meta.json", "vectors.f32"]
+    assert reopened.embed_documents(["ccc", "a", "bb"]) == [vectors[2], vectors[0], vectors[1]]
+    assert client.calls == []
+    assert reopened.stats()["entries"] == 3
+
+
+def test_unfinished_append_is_cut_off_on_reopen(tmp_path):
+    embeddings = CachedEmbeddings(CountingEmbeddings(), str(tmp_path))
+    embeddings.embed_documents(["a"])
+    # rows written after meta.json are not counted, and are overwritten by the next append
+    with open(embeddings.file("keys.bin"), "ab") as file:
+        file.write(b"x" * 7)
+
+    client = CountingEmbeddings()
+    reopened = CachedEmbeddings(client, str(tmp_path))
+    assert reopened.embed_documents(["bb", "a"])[0] == [2.0, 0.0, 0.5, -1.0]
+    assert CachedEmbeddings(CountingEmbeddings(), str(tmp_path)).stats()["entries"] == 2
+
+
+@pytest.mark.parametrize("options", [{"deployment": "text-embedding-3-large"}, {"dimensions": 2}])
+def test_cache_is_keyed_on_deployment_and_dimensions(tmp_path, options):
+    CachedEmbeddings(CountingEmbeddings(), str(tmp_path)).embed_documents(["a"])
+
+    client = CountingEmbeddings()
+    other = CachedEmbeddings(client, str(tmp_path), **options)
+    other.embed_documents(["a"])
+    assert client.calls == [["a"]]
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_attributes_are_read_from_the_client(tmp_path):
+    embeddings = CachedEmbeddings(CountingEmbeddings(), str(tmp_path))
+    assert embeddings.calls == []
+
+    # without embeddings set, e.g. while unpickling, lookups fail instead of recursing
+    bare = CachedEmbeddings.__new__(CachedEmbeddings)
+    with pytest.raises(AttributeError):
+        bare.deployment
@@ -0,0 +1,143 @@
+import functools
+import gc
+import threading
+import weakref
+
+import pytest
+
+import ingestor.pipeline as pipeline
+from ingestor.loader import LoadedFile, ParallelPdfLoader
+
+
+class Document:
+    def __init__(self, page_content, metadata):
+        self.page_content = page_content
+        self.metadata = metadata
+
+
+class FakeLoader:
+    def __init__(self, paths, workers=None):
+        self.paths = paths
+
+    def __iter__(self):
+        for path in self.paths:
+            yield LoadedFile(path, [Document(f"{path} page {page}", {"source": path}) for page in range(3)])
+
+    def report(self):
+        return {"failed": []}
+
+
+class FakeStore:
+    def __init__(self):
+        self.texts = []
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        self.texts.extend(texts)
+        return ids or [str(index) for index in range(len(texts))]
+
+
+class FakeEmbeddings:
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.calls += 1
+            if self.fail_after is not None and self.calls > self.fail_after:
+                raise ValueError("embedding failed")
+        return [[0.0, 1.0] for _ in texts]
+
+
+def run_with_timeout(streaming, paths, timeout=10):
+    outcome = dict()
+
+    def target():
+        try:
+            outcome["report"] = streaming.run(paths)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pipeline did not finish"
+    return outcome
+
+
+class TrackedParse:
+    """parse function for ParallelPdfLoader that keeps weak references to every page it returns."""
+
+    def __init__(self):
+        self.pages = []
+
+    def __call__(self, path):
+        if path.endswith("broken.pdf"):
+            return LoadedFile(path, error="PdfReadError: broken")
+        documents = [Document(f"{path} page {page}", {"source": path}) for page in range(3)]
+        self.pages.extend(weakref.ref(document) for document in documents)
+        return LoadedFile(path, documents, 0.01)
+
+
+@pytest.fixture
+def fake_loader(monkeypatch):
+    monkeypatch.setattr(pipeline, "ParallelPdfLoader", FakeLoader)
+
+
+@pytest.mark.usefixtures("fake_loader")
+def test_stores_every_file():
+    store = FakeStore()
+    stored = []
+    streaming = pipeline.StreamingPipeline(store, FakeEmbeddings(), list, on_stored=stored.append, queue_size=1)
+    outcome = run_with_timeout(streaming, [f"file{index}.pdf" for index in range(20)])
+
+    assert "error" not in outcome
+    assert len(store.texts) == 60
+    # files are embedded on two threads, so they may reach the store out of order
+    assert sorted(batch.path for batch in stored) == sorted(f"file{index}.pdf" for index in range(20))
+    counters = {stage["stage"]: stage for stage in outcome["report"]["stages"]}
+    assert counters["load"]["files"] == counters["store"]["files"] == 20
+    assert counters["store"]["units"] == 60
+
+
+@pytest.mark.usefixtures("fake_loader")
+@pytest.mark.parametrize("fail_after", [0, 1, 3, 7])
+def test_failing_stage_stops_the_run(fail_after):
+    for _ in range(20):
+        streaming = pipeline.StreamingPipeline(FakeStore(), FakeEmbeddings(fail_after), list, embed_threads=3,
+                                               queue_size=1)
+        outcome = run_with_timeout(streaming, [f"file{index}.pdf" for index in range(30)])
+
+        assert isinstance(outcome.get("error"), RuntimeError)
+        assert "embed stage" in str(outcome["error"])
+        assert isinstance(outcome["error"].__cause__, ValueError)
+
+
+def test_loader_does_not_keep_yielded_pages():
+    parse = TrackedParse()
+    loader = ParallelPdfLoader(["a.pdf", "broken.pdf", "b.pdf"], workers=1, parse=parse)
+    for loaded in loader:
+        del loaded
+    gc.collect()
+
+    assert parse.pages and all(page() is None for page in parse.pages)
+    report = loader.report()
+    assert report["files"] == 3
+    assert report["pages"] == 6
+    assert [failed["path"] for failed in report["failed"]] == ["broken.pdf"]
+
+
+def test_pipeline_does_not_keep_stored_pages(monkeypatch):
+    parse = TrackedParse()
+    monkeypatch.setattr(pipeline, "ParallelPdfLoader", functools.partial(ParallelPdfLoader, parse=parse))
+    paths = [f"file{index}.pdf" for index in range(10)] + ["broken.pdf"]
+    streaming = pipeline.StreamingPipeline(FakeStore(), FakeEmbeddings(), list, workers=1, queue_size=1)
+    outcome = run_with_timeout(streaming, paths)
+    gc.collect()
+
+    assert "error" not in outcome
+    assert len(parse.pages) == 30 and all(page() is None for page in parse.pages)
+    counters = {stage["stage"]: stage for stage in outcome["report"]["stages"]}
+    assert counters["load"]["failed"] == 1
+    assert [failed["path"] for failed in outcome["report"]["failed"]] == ["broken.pdf"]
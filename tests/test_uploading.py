@@ -0,0 +1,160 @@
+import functools
+import json
+import os
+
+import pytest
+
+import ingestor.pipeline as pipeline
+from ingestor.loader import LoadedFile, ParallelPdfLoader
+from ingestor.uploading import IncrementalIngestor, chunk_ids, file_sha256
+
+CONFIG = {"splitter": "lines", "chunk_size": 100}
+
+
+class Document:
+    def __init__(self, page_content, metadata):
+        self.page_content = page_content
+        self.metadata = metadata
+
+
+def parse_text(path):
+    """Stands in for parse_pdf: every line of the file is a page."""
+    with open(path) as file:
+        lines = file.read().splitlines()
+    return LoadedFile(path, [Document(line, {"source": path, "page": page}) for page, line in enumerate(lines)])
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+
+class FakeStore:
+    def __init__(self):
+        self.embeddings = FakeEmbeddings()
+        self.rows = dict()
+        # every write in order, to check that old chunks are gone before new ones arrive
+        self.log = []
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        self.log.append(("add", list(ids)))
+        self.rows.update({id_: (text, metadata) for id_, text, metadata in zip(ids, texts, metadatas)})
+        return ids
+
+    def delete(self, ids=None):
+        self.log.append(("delete", list(ids)))
+        for id_ in ids:
+            del self.rows[id_]
+
+    def delete_collection(self):
+        self.log.append(("delete_collection", None))
+        self.rows = dict()
+
+
+@pytest.fixture(autouse=True)
+def text_loader(monkeypatch):
+    monkeypatch.setattr(pipeline, "ParallelPdfLoader", functools.partial(ParallelPdfLoader, parse=parse_text))
+
+
+@pytest.fixture
+def docs(tmp_path):
+    docs = tmp_path / "docs"
+    (docs / "sub").mkdir(parents=True)
+    write(docs / "a.pdf", "a one\na two")
+    write(docs / "b.pdf", "b one\nb two\nb three")
+    write(docs / "sub" / "c.pdf", "c one")
+    write(docs / "notes.txt", "not ingested")
+    return docs
+
+
+def write(path, text, mtime=1_700_000_000):
+    path.write_text(text)
+    os.utime(path, (mtime, mtime))
+
+
+def ingest(store, docs, tmp_path, config=CONFIG):
+    ingestor = IncrementalIngestor(store, str(docs), str(tmp_path / "manifests" / "lines.json"), config, list,
+                                   workers=1)
+    return ingestor.run()
+
+
+def manifest(tmp_path):
+    with open(tmp_path / "manifests" / "lines.json") as file:
+        return json.load(file)
+
+
+def manifest_ids(tmp_path):
+    return {id_ for entry in manifest(tmp_path)["files"].values() for id_ in entry["chunk_ids"]}
+
+
+def summary(report):
+    return {key: report[key] for key in ("rebuilt", "added", "changed", "removed", "unchanged", "chunks_added")}
+
+
+def test_first_run_ingests_every_file(docs, tmp_path):
+    store = FakeStore()
+    report = ingest(store, docs, tmp_path)
+
+    assert summary(report) == {"rebuilt": True, "added": 3, "changed": 0, "removed": 0, "unchanged": 0,
+                               "chunks_added": 6}
+    files = manifest(tmp_path)["files"]
+    assert sorted(files) == ["a.pdf", "b.pdf", os.path.join("sub", "c.pdf")]
+    assert files["a.pdf"]["chunk_ids"] == chunk_ids("a.pdf", file_sha256(docs / "a.pdf"), 2)
+    assert set(store.rows) == manifest_ids(tmp_path)
+
+
+def test_rerun_only_ingests_the_difference(docs, tmp_path):
+    store = FakeStore()
+    ingest(store, docs, tmp_path)
+    old_a = manifest(tmp_path)["files"]["a.pdf"]["chunk_ids"]
+    old_b = manifest(tmp_path)["files"]["b.pdf"]["chunk_ids"]
+    store.log.clear()
+    store.embeddings.texts.clear()
+
+    write(docs / "a.pdf", "a one\na two\na three", mtime=1_700_000_100)
+    (docs / "b.pdf").unlink()
+    write(docs / "d.pdf", "d one")
+    # touched without being modified
+    os.utime(docs / "sub" / "c.pdf", (1_700_000_200, 1_700_000_200))
+    report = ingest(store, docs, tmp_path)
+
+    assert summary(report) == {"rebuilt": False, "added": 1, "changed": 1, "removed": 1, "unchanged": 1,
+                               "chunks_added": 4}
+    assert sorted(store.embeddings.texts) == ["a one", "a three", "a two", "d one"]
+    # the chunks of the removed and the changed file are deleted before anything is added
+    assert store.log[:2] == [("delete", old_b), ("delete", old_a)]
+    assert [operation for operation, _ in store.log[2:]] == ["add", "add"]
+
+    files = manifest(tmp_path)["files"]
+    assert sorted(files) == ["a.pdf", "d.pdf", os.path.join("sub", "c.pdf")]
+    assert files[os.path.join("sub", "c.pdf")]["mtime"] == 1_700_000_200
+    assert set(store.rows) == manifest_ids(tmp_path)
+    assert sorted(text for text, _ in store.rows.values()) == ["a one", "a three", "a two", "c one", "d one"]
+
+
+def test_unchanged_tree_is_not_ingested_again(docs, tmp_path):
+    store = FakeStore()
+    ingest(store, docs, tmp_path)
+    store.log.clear()
+
+    report = ingest(store, docs, tmp_path)
+    assert summary(report) == {"rebuilt": False, "added": 0, "changed": 0, "removed": 0, "unchanged": 3,
+                               "chunks_added": 0}
+    assert store.log == []
+
+
+def test_splitter_config_change_rebuilds_the_collection(docs, tmp_path):
+    store = FakeStore()
+    ingest(store, docs, tmp_path)
+    store.log.clear()
+
+    report = ingest(store, docs, tmp_path, config=dict(CONFIG, chunk_size=50))
+    assert summary(report) == {"rebuilt": True, "added": 3, "changed": 0, "removed": 0, "unchanged": 0,
+                               "chunks_added": 6}
+    assert store.log[0] == ("delete_collection", None)
+    assert set(store.rows) == manifest_ids(tmp_path)
+    assert len(store.rows) == 6